@@ -9,10 +9,11 @@ DG: A rewrite of Elena's aptest script.
  apogee_data.APOGEERaw.ap_test, which uses quickred files
 """
 
+import textwrap
+
 import numpy as np
-import fitsio
+
 from argparse import ArgumentParser
-from pathlib import Path
 from sdssobstools import apogee_data, sdss_paths
 
 __version__ = '3.2.1'
@@ -22,22 +23,28 @@ class ApogeeFlat:
     def __init__(self, args):
         self.args = args
         # self.args.verbose = True
-        master_path = (Path(apogee_data.__file__).absolute().parent.parent
-                       / "dat/master_dome_flat.fits.gz")
-        if not master_path.exists():
-            master_path = (Path(apogee_data.__file__).absolute(
-            ).parent.parent.parent / "dat/master_dome_flat.fits.gz")
-        master_data = fitsio.read(master_path.as_posix())
-        self.ap_master = np.median(master_data[:, 550:910], axis=1)
+        self.ap_master = apogee_data.master_dome_flat_col()
 
     def run_inputs(self):
-        for i, sjd in enumerate(self.args.sjds):
-            for exp in self.args.exps[i]:
-                ap_img = apogee_data.APOGEERaw(sdss_paths.ap_archive /
-                                               f"{sjd}/apR-a-{exp}.apz",
-                                               self.args)
-                ap_img.ap_test((550, 910), master_col=self.ap_master,
-                               plot=self.args.plot, print_it=True)
+        """Reads every flat of the inputs at once, and compares them all to
+        the master flat in one batch"""
+        images = [apogee_data.APOGEERaw(sdss_paths.ap_archive /
+                                        f"{sjd}/apR-a-{exp}.apz", self.args)
+                  for i, sjd in enumerate(self.args.sjds)
+                  for exp in self.args.exps[i]]
+        slabs = apogee_data.read_flat_slabs(
+            [img.quickred_path() for img in images], (550, 910))
+        results = apogee_data.dome_flat_results(np.median(slabs, axis=2),
+                                                self.ap_master)
+        for i, img in enumerate(images):
+            print(textwrap.fill('Missing Fibers: {}'.format(
+                results['missing'][i]), 80))
+            print(textwrap.fill('Faint Fibers: {}'.format(
+                results['faint'][i]), 80))
+            print()
+            if self.args.plot:
+                apogee_data.plot_flux_ratio(results['flux_ratio'][i],
+                                            img.exp_id)
 
 
 def parse_args():
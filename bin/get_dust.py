@@ -7,7 +7,6 @@ Changelog:
 2020-06-20  DG  Moving main contents into a function for import functionality
  """
 import argparse
-from astropy.time import Time
 from pathlib import Path
 from bin import sjd, influx_fetch
 from sdssobstools import sdss_paths
@@ -28,6 +27,7 @@ def parse_args():
                         help='print incremental dust data')
     args = parser.parse_args()
 
+    from astropy.time import Time
     if (not args.mjd) and (not args.start_time and not args.end_time):
         args.start_time = Time(sjd.sjd(), format="mjd")
         args.end_time = Time.now()
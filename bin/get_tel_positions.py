@@ -2,9 +2,7 @@
 
 import click
 import numpy as np
-import matplotlib.pyplot as plt
 from collections.abc import Iterable
-from astropy.time import Time
 from pathlib import Path
 from bin import influx_fetch, sjd
 from sdssobstools import sdss_paths
@@ -13,32 +11,28 @@ from sdssobstools import sdss_paths
 @click.command()
 @click.option("-m", "--mjd", type=int, default=sjd.sjd())
 @click.option("-p", "--plot", is_flag=True)
-def main(mjd: int, plot):
+@click.option("-n", "--max-points", type=int, default=5000,
+              help="The most points of each offset to query, which sets their"
+                   " windowPeriod from the length of the night. 0 queries"
+                   " every second")
+def main(mjd: int, plot, max_points: int):
+    from astropy.time import Time
     tstart = Time(mjd, format="mjd")
     tend = Time(mjd + 0.5, format="mjd")
     tend = Time.now() if Time.now() < tend else tend
     flux_dir = Path(sdss_paths.__file__).absolute().parent.parent / "flux"
     fields_fil = flux_dir / "jaeger_fields.flux"
 
-    field_times = []
-    fields = []
-    fields_qry = influx_fetch.query(fields_fil.open('r').read(), tstart, tend)
-    for table in fields_qry:
-        for row in table.records:
-            field_times.append(row.get_time())
-            fields.append(row.get_value())
-    field_times = Time(field_times, format='datetime')
-    fields = np.array(fields)
+    field_times, fields = influx_fetch.join_fields(influx_fetch.query_arrays(
+        fields_fil.open('r').read(), tstart, tend))
+    field_times = influx_fetch.to_time(field_times)
     fields = fields[field_times.argsort()]
     field_times = field_times[field_times.argsort()]
 
     scis_fil = flux_dir / "science_exposures.flux"
-    sci_times = []
-    scis_qry = influx_fetch.query(scis_fil.open('r').read(), tstart, tend)
-    for table in scis_qry:
-        for row in table.records:
-            sci_times.append(row.get_time())
-    sci_times = Time(sci_times, format='datetime')
+    sci_times, _ = influx_fetch.join_fields(influx_fetch.query_arrays(
+        scis_fil.open('r').read(), tstart, tend))
+    sci_times = influx_fetch.to_time(sci_times)
     sci_times = sci_times[sci_times.argsort()]
 
     target_times = []
@@ -50,44 +44,25 @@ def main(mjd: int, plot):
             target_fields.append(field)
 
     offsets_fil = flux_dir / "offsets.flux"
-    offs_query = influx_fetch.query(
-        offsets_fil.open('r').read(), tstart, tend, "1s", timeout=60000)
-
-    offs = {}
-
-    for table in offs_query:
-        for row in table.records:
-            if row.get_field() in offs.keys():
-                offs[row.get_field()].append(row.get_value())
-                offs['t' + row.get_field()].append(row.get_time())
-            else:
-                offs[row.get_field()] = [row.get_value()]
-                offs['t' + row.get_field()] = [row.get_time()]
-    for key in offs.keys():
-        if key[0] == 't':
-            offs[key] = Time(offs[key], format='datetime')
-        else:
-            offs[key] = np.array(offs[key])
+    offs = influx_fetch.query_arrays(
+        offsets_fil.open('r').read(), tstart, tend,
+        "auto" if max_points else "1s", timeout=60000,
+        max_points=max_points or None)
 
     tcc_fil = flux_dir / "tcc_positions.flux"
 
-    tcc_qry = influx_fetch.query(
+    tcc_qry = influx_fetch.query_arrays(
         tcc_fil.open('r').read(), tstart, tend, "1s"
     )
-    for table in tcc_qry:
-        for row in table.records:
-            if row.get_field() in offs.keys():
-                offs[row.get_field()].append(row.get_value())
-                offs['t' + row.get_field()].append(row.get_time())
-            else:
-                offs[row.get_field()] = [row.get_value()]
-                offs['t' + row.get_field()] = [row.get_time()]
-    for key in offs.keys():
-        if key[0] == 't':
-            offs[key] = Time(offs[key], format='datetime')
+    for field, (times, values) in tcc_qry.items():
+        if field in offs:
+            offs[field] = (np.concatenate([offs[field][0], times]),
+                           np.concatenate([offs[field][1], values]))
         else:
-            offs[key] = np.array(offs[key])
+            offs[field] = (times, values)
+    offs = influx_fetch.time_table(offs)
     if plot:
+        import matplotlib.pyplot as plt
         fig, ax = plt.subplots(1, 1, figsize=(6, 4))
         # ax.plot_date(offs['tobjArcOff_0_P'].plot_date, offs['objArcOff_0_P'],
         #  'k-',
@@ -56,4 +56,11 @@ WAVEMID: Alias for wave_mid.py
 x_mid.py: Computes XMID offsets
 XMID: Alias for x_mid.py
 """
-print(doc)
+
+
+def main():
+    print(doc)
+
+
+if __name__ == '__main__':
+    main()
@@ -7,42 +7,32 @@ that can be imported as well as run through a CLI
 Author: Dylan Gatlin
 """
 import os
-import platform
+import csv
+import io
+import re
+import sys
 import argparse
+import functools
+import socket
+import threading
 
-import subprocess as sub
+import numpy as np
 
 from pathlib import Path
-from influxdb_client import InfluxDBClient
-from astropy.time import Time
+from urllib.parse import urlparse
 
 from bin import sjd
+from sdssobstools import profiling, query_plan
 
 __version__ = "3.0.0"
 __author__ = "Dylan Gatlin"
 
 
-def ping(host):
-    """
-    Returns True if host (str) responds to a ping request.
-     Remember that a host may not respond to a ping (ICMP) request even if the
-     host name is valid.
-    """
-
-    # Option for the number of packets as a function of
-    param = '-n' if platform.system().lower() == 'windows' else '-c'
-
-    # Building the command. Ex: "ping -c 1 google.com"
-    command = ['ping', param, '1', "-W", "0.5", host]
-    tstart = Time.now()
-    x = sub.run(command, stdout=sub.PIPE)
-    return x.returncode == 0
-
-
+@functools.lru_cache(maxsize=1)
 def get_key():
     """Finds a file called .influx.key that has 3 lines, a user id, an org id,
     and a token, each on its own line. The file can be in the current directory
-    or the home directory
+    or the home directory. It is only read once, until close is called
     TODO: Put an influx.key somewhere that all observers can use it.
     """
     if "INFLUXDB_V2_TOKEN" in os.environ.keys():
@@ -63,35 +53,490 @@ def get_key():
     return user_id, org_id, token
 
 
+# The InfluxDB servers to try, in order. The last one is used when none of
+# them accept a connection
+servers = ["http://sdss5-webapp.apo.nmsu.edu:9999", "http://localhost:9999"]
+probe_timeout = 0.5  # Seconds to wait for a server to accept a connection
+
+# Clients made by get_client and the server chosen by get_url, which are only
+# used by the process that made them, since a forked process can't share their
+# connections
+_clients = {}
+_url = None
+_pid = None
+_lock = threading.Lock()
+
+
+# Query results on disk, see query_cache. None to always query, which is the
+# default so that scripts that import this one don't write to a cache they
+# didn't ask for. sloan_log sets it unless it is run with --no-cache
+result_cache = None
+
+
+def reachable(url, timeout=probe_timeout):
+    """Returns True if the host of url accepts a TCP connection on its port
+    within timeout seconds. Unlike the ping command, this doesn't start a
+    process or need ICMP to be allowed"""
+    parsed = urlparse(url)
+    port = parsed.port or (443 if parsed.scheme == 'https' else 80)
+    try:
+        with socket.create_connection((parsed.hostname, port), timeout=timeout):
+            return True
+    except OSError:
+        return False
+
+
+def _check_pid():
+    """Forgets the clients and server of the parent of a forked process"""
+    global _url, _pid
+    if _pid != os.getpid():
+        _clients.clear()
+        _url = None
+        _pid = os.getpid()
+
+
+def get_url():
+    """The URL of the first server that accepts a connection, which is only
+    probed for the first time it is asked for in each process"""
+    global _url
+    with _lock:
+        _check_pid()
+        if _url is None:
+            for url in servers:
+                if reachable(url):
+                    _url = url
+                    break
+            else:
+                _url = servers[-1]
+        return _url
+
+
 def get_client(org_id, token, timeout=20000):
-    if ping("sdss5-webapp.apo.nmsu.edu"):
-        client = InfluxDBClient(url="http://sdss5-webapp.apo.nmsu.edu:9999",
-                                token=token, org=org_id, timeout=timeout)
-    else:
-        # print("Did not reach 10.25.1.221")
-        client = InfluxDBClient(url="http://localhost:9999", token=token,
-                                org=org_id, timeout=timeout)
-    return client.query_api()
+    """Returns a query API for org_id, from a client that is made the first
+    time it is asked for in each process and then reused, so its connections
+    are kept alive between queries. Clients are kept by url, org, and token,
+    and by timeout, which a client is made with"""
+    url = get_url()
+    key = (url, org_id, token, timeout)
+    with _lock:
+        _check_pid()
+        if key not in _clients:
+            from influxdb_client import InfluxDBClient
+            _clients[key] = InfluxDBClient(url=url, token=token, org=org_id,
+                                           timeout=timeout)
+        return _clients[key].query_api()
+
+
+def close():
+    """Closes every client of this process, and forgets the server, so the
+    next query probes for it again. Worker processes should call this before
+    they exit"""
+    global _url
+    with _lock:
+        if _pid == os.getpid():
+            for client in _clients.values():
+                client.close()
+        _clients.clear()
+        _url = None
+    get_key.cache_clear()
+
+
+# The windowPeriods that interval="auto" chooses from, and their seconds
+auto_periods = {'1s': 1, '2s': 2, '5s': 5, '10s': 10, '15s': 15, '30s': 30,
+                '1m': 60, '2m': 120, '5m': 300, '10m': 600, '15m': 900,
+                '30m': 1800, '1h': 3600, '2h': 7200, '6h': 21600,
+                '12h': 43200, '1d': 86400}
+auto_points = 1000  # The most windows of a series with interval="auto"
+
+_duration = re.compile(r'(\d+(?:\.\d*)?)(ms|s|m|h|d|w)')
+_units = {'ms': 1e-3, 's': 1, 'm': 60, 'h': 3600, 'd': 86400, 'w': 604800}
+
+
+def duration_seconds(duration):
+    """The seconds of a Flux duration such as 1m30s, or of a number"""
+    if not isinstance(duration, str):
+        return float(duration)
+    parts = _duration.findall(duration)
+    if not parts or ''.join(n + unit for n, unit in parts) != duration:
+        raise ValueError(f"Can't read the duration {duration!r}")
+    return sum(float(n) * _units[unit] for n, unit in parts)
+
+
+def window_period(start, end, resolution=None, max_points=None):
+    """The windowPeriod for a query from start to end, the shortest of
+    auto_periods that gives a series at most max_points windows (auto_points
+    by default) and is no shorter than resolution (a duration or seconds),
+    the finest that the caller needs. Short windows get every second, and
+    long ones stay within the budget, so their responses stay small"""
+    max_points = auto_points if max_points is None else max_points
+    if max_points <= 0:
+        raise ValueError(f"max_points must be positive, not {max_points}")
+    needed = (end - start).sec / max_points
+    if resolution is not None:
+        needed = max(needed, duration_seconds(resolution))
+    for period, seconds in auto_periods.items():
+        if seconds >= needed:
+            return period
+    return period
+
+
+def resolve_interval(interval, start, end, resolution=None, max_points=None):
+    """interval, or window_period's choice with resolution and max_points if
+    it is auto"""
+    if interval == "auto":
+        return window_period(start, end, resolution, max_points)
+    return interval
+
+
+def render(flux_script, start, end, interval):
+    """flux_script with its window variables filled in"""
+    query = flux_script
+    query = query.replace("v.timeRangeStart", f"{start.isot}Z")
+    query = query.replace("v.timeRangeStop", f"{end.isot}Z")
+    query = query.replace("v.windowPeriod",
+                          resolve_interval(interval, start, end))
+    return query
+
+
+def _lookup(kind, count, query, start, end, interval, verbose):
+    """The result_cache key of a rendered query, or None if there is no
+    cache, and its cached result, or None if it must be fetched. count gives
+    the number of rows of a result"""
+    if result_cache is None:
+        return None, None
+    cache_key = result_cache.key(query, start.isot, end.isot, interval, kind)
+    with profiling.span('influx.cache') as counts:
+        result = result_cache.get(cache_key, end.unix, kind)
+        if result is not None:
+            counts['rows'] = count(result)
+    if result is not None and verbose >= 1:
+        print(query)
+        print(f"Read from {result_cache.path(cache_key, kind)}")
+    return cache_key, result
+
+
+def _keep(kind, cache_key, result):
+    """Caches a fetched result, unless there is no cache"""
+    if cache_key is not None:
+        try:
+            result_cache.put(cache_key, result, kind)
+        except OSError as e:
+            print(f"Couldn't cache a query result: {e}")
 
 
-def query(flux_script, start, end, interval="1s", timeout=20000, verbose=False):
+def _run(kind, fetch, count, flux_script, start, end, interval, timeout,
+         verbose, resolution=None, max_points=None):
+    """Renders flux_script, and returns its result from result_cache, or
+    from fetch(query_api, query, org), which is then cached. count gives the
+    number of rows of a result"""
+    from astropy.time import Time
+    interval = resolve_interval(interval, start, end, resolution, max_points)
+    query = render(flux_script, start, end, interval)
+    cache_key, result = _lookup(kind, count, query, start, end, interval,
+                                verbose)
+    if result is not None:
+        return result
     user, org, token = get_key()
     if verbose:
         print(f"org: {org}, key: {token}")
     client = get_client(org_id=org, token=token, timeout=timeout)
-    query = flux_script
-    query = query.replace("v.timeRangeStart", f"{start.isot}Z")
-    query = query.replace("v.timeRangeStop", f"{end.isot}Z")
-    query = query.replace("v.windowPeriod", interval)
     before = Time.now()
-    result = client.query(query=query, org=org)
+    with profiling.span('influx.query') as counts:
+        result = fetch(client, query, org)
+        if profiling.enabled():
+            counts['rows'] = count(result)
     after = Time.now()
+    _keep(kind, cache_key, result)
     if verbose >= 1:
         print(query)
         print(f"Query time: {(after - before).sec}s")
     return result
 
 
+def query(flux_script, start, end, interval="1s", timeout=20000, verbose=False,
+          resolution=None, max_points=None):
+    """Runs flux_script from start to end (astropy Times) with a windowPeriod
+    of interval, or of window_period's choice for "auto", given resolution
+    and max_points, and returns its tables. Results are cached in
+    result_cache, which can answer for a past window without a key or a
+    connection"""
+    return _run('tables',
+                lambda client, query, org: client.query(query=query, org=org),
+                lambda tables: sum(len(table.records) for table in tables),
+                flux_script, start, end, interval, timeout, verbose,
+                resolution, max_points)
+
+
+def to_ns(times):
+    """RFC3339 UTC time strings as int64 nanoseconds since 1970"""
+    return np.array([t.rstrip('Z') for t in times],
+                    dtype='datetime64[ns]').astype(np.int64)
+
+
+def to_time(times):
+    """int64 nanoseconds since 1970 as an astropy Time in UTC. It is made from
+    calendar fields, since astropy parses datetime64 as strings, and unix or
+    jd values would put a leap second in the wrong place"""
+    from astropy.time import Time
+    times = np.asarray(times, dtype=np.int64).astype('datetime64[ns]')
+    days = times.astype('datetime64[D]')
+    months = days.astype('datetime64[M]')
+    years = months.astype('datetime64[Y]')
+    minutes, ns = np.divmod((times - days).astype(np.int64), 60 * 10 ** 9)
+    out = Time({'year': years.astype(np.int64) + 1970,
+                'month': (months - years).astype(np.int64) + 1,
+                'day': (days - months).astype(np.int64) + 1,
+                'hour': minutes // 60, 'minute': minutes % 60,
+                'second': ns / 1e9}, format='ymdhms', scale='utc')
+    out.format = 'datetime'
+    return out
+
+
+def _typed(values, datatype):
+    """A column of an annotated CSV as an array of its datatype. Empty
+    numbers become NaN"""
+    if datatype.startswith('dateTime'):
+        return to_ns(values)
+    if datatype == 'boolean':
+        return np.array(values) == 'true'
+    if datatype in ('double', 'long', 'unsignedLong'):
+        if '' in values:
+            return np.array([v if v else 'nan' for v in values], dtype=float)
+        return np.array(values).astype(
+            {'double': float, 'long': np.int64,
+             'unsignedLong': np.uint64}[datatype])
+    return np.array(values, dtype=str)
+
+
+def parse_csv(rows, lower=False, measurements=False):
+    """Reads the rows of an annotated CSV query response (lists of strings),
+    and returns a dictionary of (times, values) arrays by _field, in the
+    order that fields first appear. Times are int64 nanoseconds since 1970,
+    and values have the datatype of _value. Rows of a field from more than one
+    table are joined in the order they came, and with lower, fields are
+    lowercase, so fields that only differ by case are joined too. With
+    measurements, the keys are (_measurement, _field) instead"""
+    rows = iter(rows)
+    times = {}
+    values = {}
+    datatypes = {}
+    annotations = None
+    header = None
+    for row in rows:
+        if len(row) == 0 or not any(row):  # A blank line ends a table
+            header = None
+            continue
+        if row[0] == '#datatype':
+            annotations = row
+            header = None
+            continue
+        if row[0].startswith('#'):
+            continue
+        if header is None:
+            header = row
+            if 'error' in header and '_value' not in header:
+                error = next(rows, [])
+                raise RuntimeError(f"InfluxDB query failed: {error}")
+            i_time = header.index('_time')
+            i_value = header.index('_value')
+            i_field = header.index('_field') if '_field' in header else None
+            i_measurement = (header.index('_measurement')
+                             if '_measurement' in header else None)
+            datatype = (annotations[i_value] if annotations is not None
+                        else 'string')
+            continue
+        field = '_value' if i_field is None else row[i_field]
+        if lower:
+            field = field.lower()
+        if measurements:
+            field = ('' if i_measurement is None else row[i_measurement],
+                     field)
+        if field not in times:
+            times[field] = []
+            values[field] = []
+            datatypes[field] = datatype
+        times[field].append(row[i_time])
+        values[field].append(row[i_value])
+    return {field: (to_ns(times[field]),
+                    _typed(values[field], datatypes[field]))
+            for field in times}
+
+
+def query_arrays(flux_script, start, end, interval="1s", timeout=20000,
+                 verbose=False, lower=False, resolution=None, max_points=None):
+    """Runs flux_script like query, but streams the response as annotated CSV
+    and returns parse_csv's dictionary of (times, values) arrays by field,
+    without making a FluxRecord for each row"""
+    return _run(
+        'arrays' + ('_lower' if lower else ''),
+        lambda client, query, org: parse_csv(
+            iter(client.query_csv(query, org=org)), lower),
+        lambda arrays: sum(len(t) for t, _ in arrays.values()),
+        flux_script, start, end, interval, timeout, verbose, resolution,
+        max_points)
+
+
+def query_merged(requests, timeout=20000, verbose=False):
+    """Runs a list of query_plan.Requests in as few queries as
+    query_plan.plan can merge them into, and returns the arrays of each
+    request, as query_arrays would have returned them"""
+    out = [None] * len(requests)
+    requests = [request._replace(interval=resolve_interval(
+        request.interval, request.start, request.end, request.resolution,
+        request.max_points)) for request in requests]
+    for group in query_plan.plan(requests):
+        arrays = _run(
+            'arrays_merged',
+            lambda client, query, org: parse_csv(
+                iter(client.query_csv(query, org=org)), measurements=True),
+            lambda arrays: sum(len(t) for t, _ in arrays.values()),
+            group.flux_script, group.start, group.end, group.interval,
+            timeout, verbose)
+        for i, section in zip(group.members,
+                              query_plan.demux(group, arrays)):
+            out[i] = section
+    return out
+
+
+def get_async_client(org_id, token, timeout=20000):
+    """An InfluxDBClientAsync for the server of get_url. Unlike get_client's,
+    it belongs to the event loop it is used in, so it isn't kept. It needs
+    the async extra of influxdb-client (aiohttp)"""
+    from influxdb_client.client.influxdb_client_async import (
+        InfluxDBClientAsync)
+    return InfluxDBClientAsync(url=get_url(), token=token, org=org_id,
+                               timeout=timeout)
+
+
+class AsyncSession:
+    """One async client shared by the queries of an event loop. It is only
+    made when the first query that isn't cached needs it, so cached windows
+    still don't need a key or a connection"""
+
+    def __init__(self, timeout=20000):
+        self.timeout = timeout
+        self.client = None
+        self.org = None
+
+    def query_api(self):
+        if self.client is None:
+            user, self.org, token = get_key()
+            self.client = get_async_client(self.org, token, self.timeout)
+        return self.client.query_api(), self.org
+
+    async def close(self):
+        if self.client is not None:
+            await self.client.close()
+            self.client = None
+
+
+async def aquery(flux_script, start, end, interval="1s", timeout=20000,
+                 verbose=False, lower=False, session=None, resolution=None,
+                 max_points=None):
+    """query_arrays as a coroutine, so many queries can wait on the server at
+    once in one thread. session is an AsyncSession to share, or None to make
+    one for this query"""
+    kind = 'arrays' + ('_lower' if lower else '')
+    interval = resolve_interval(interval, start, end, resolution, max_points)
+    query = render(flux_script, start, end, interval)
+    cache_key, result = _lookup(kind,
+                                lambda arrays: sum(len(t) for t, _ in
+                                                   arrays.values()),
+                                query, start, end, interval, verbose)
+    if result is not None:
+        return result
+    own = session is None
+    if own:
+        session = AsyncSession(timeout)
+    try:
+        api, org = session.query_api()
+        text = await api.query_raw(query, org=org)
+    finally:
+        if own:
+            await session.close()
+    result = parse_csv(csv.reader(io.StringIO(text)), lower)
+    _keep(kind, cache_key, result)
+    if verbose >= 1:
+        print(query)
+    return result
+
+
+async def _gather(requests, deadline, timeout, verbose):
+    import asyncio
+    session = AsyncSession(timeout)
+    names = list(requests)
+    tasks = []
+    for name in names:
+        request = requests[name]
+        seconds = (deadline.get(name) if isinstance(deadline, dict)
+                   else deadline)
+        tasks.append(asyncio.wait_for(
+            aquery(request.flux_script, request.start, request.end,
+                   request.interval, timeout, verbose, request.lower,
+                   session, request.resolution, request.max_points), seconds))
+    try:
+        done = await asyncio.gather(*tasks, return_exceptions=True)
+    finally:
+        await session.close()
+    results = {}
+    errors = {}
+    for name, result in zip(names, done):
+        if isinstance(result, BaseException):
+            errors[name] = result
+        else:
+            results[name] = result
+    return results, errors
+
+
+def gather_queries(requests, deadline=5, timeout=20000, verbose=False):
+    """Runs a dictionary of query_plan.Requests by name at once in an event
+    loop in this thread, and returns a dictionary of the arrays of each that
+    finished, as query_arrays would have returned them, and a dictionary of
+    the exceptions of those that didn't. A query that hasn't finished
+    deadline seconds after they started (a number, or a dictionary of them
+    by name, where None is no deadline) is cancelled, and its exception is an
+    asyncio.TimeoutError. Callers use the results they have, and can print
+    the rest with report"""
+    import asyncio
+    with profiling.span('influx.gather') as counts:
+        results, errors = asyncio.run(_gather(requests, deadline, timeout,
+                                              verbose))
+        counts['queries'] = len(requests)
+        counts['rows'] = sum(len(t) for arrays in results.values()
+                             for t, _ in arrays.values())
+    return results, errors
+
+
+def report(errors, file=None):
+    """Prints the queries that gather_queries couldn't finish, to stderr"""
+    import asyncio
+    file = sys.stderr if file is None else file
+    for name, error in errors.items():
+        if isinstance(error, asyncio.TimeoutError):
+            print(f"The {name} query missed its deadline", file=file)
+        else:
+            print(f"The {name} query failed: {error!r}", file=file)
+
+
+def join_fields(arrays):
+    """The times and values of every field in query_arrays' arrays, one
+    field after another"""
+    if len(arrays) == 0:
+        return np.array([], dtype=np.int64), np.array([])
+    return (np.concatenate([times for times, _ in arrays.values()]),
+            np.concatenate([values for _, values in arrays.values()]))
+
+
+def time_table(arrays):
+    """query_arrays' arrays as one dictionary, of values by field and of
+    astropy Times by 't' + field"""
+    table = {}
+    for field, (times, values) in arrays.items():
+        table[f"t{field}"] = to_time(times)
+        table[field] = values
+    return table
+
+
 def parse_args():
     parser = argparse.ArgumentParser()
     parser.add_argument("-m", "--mjd", type=float, help="SJD of observations")
@@ -101,12 +546,15 @@ def parse_args():
                         " for astropy.time to parse, preferable isot")
     parser.add_argument("-f", "--file", nargs='+', help="A file path of a .flux"
                         " influxdb query file")
-    parser.add_argument("-i", "--interval", default="1m", help="Time interval")
+    parser.add_argument("-i", "--interval", default="1m", help="Time interval,"
+                        " or auto to choose one from the length of the"
+                        " window")
     parser.add_argument("-v", "--verbose", action="store_true",
                         help="Verbose debugging")
 
     args = parser.parse_args()
 
+    from astropy.time import Time
     if (not args.mjd) and (not args.start_time and not args.end_time):
         args.start_time = Time(sjd.sjd(), format="mjd") - 0.3
         args.end_time = Time.now()
@@ -126,6 +574,7 @@ def parse_args():
 
 
 def main(args=None):
+    from astropy.time import Time
     if args is None:
         args = parse_args()
     user_id, org_id, token = get_key()
@@ -138,9 +587,7 @@ def main(args=None):
             if f_path.exists():
                 with f_path.open('r') as fil:
                     query = fil.read()
-        query = query.replace("v.timeRangeStart", f"{args.start_time.isot}Z")
-        query = query.replace("v.timeRangeStop", f"{args.end_time.isot}Z")
-        query = query.replace("v.windowPeriod", args.interval)
+        query = render(query, args.start_time, args.end_time, args.interval)
         if args.verbose:
             print(query)
         query_result = client.query(org=org_id, query=query)
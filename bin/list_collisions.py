@@ -2,43 +2,41 @@
 
 import re
 import gzip
-import time
 import click
 import tqdm
+import concurrent.futures
 
-import multiprocessing as mp
 import numpy as np
 
-from astropy.time import Time
 from pathlib import Path
 
-from sdssobstools import sdss_paths
+from sdssobstools import query_plan, sdss_paths
 from bin import influx_fetch
 
 
-def get_designs(time_1, time_2, out_dict: dict={}):
-    out_dict["Success"] = False
+def designs_request(time_1, time_2):
+    """The query_plan.Request of the designs loaded from a day before time_1
+    to time_2"""
     q_path = Path(influx_fetch.__file__
                   ).parent.parent / "flux/jaeger_designs.flux"
     if not q_path.exists():
         raise FileNotFoundError(
             f"Could not file Flux query at {q_path.absolute()}")
     with q_path.open('r') as fil:
-        query = fil.read()
-        
-    results = influx_fetch.query(query, time_1 - 1, time_2)
+        return query_plan.Request(fil.read(), time_1 - 1, time_2)
+
+
+def get_designs(time_1, time_2, out_dict: dict={}, results=None):
+    out_dict["Success"] = False
+    if results is None:
+        results = influx_fetch.query_arrays(
+            *designs_request(time_1, time_2)[:4])
     if len(results) == 0:
         return
     
-    times = []
-    designs = []
-    for result in results:
-        for row in result.records:
-            times.append(row.get_time())
-            designs.append(row.get_value())
-    
-    out_dict["Times"] = Time(times, format="datetime")
-    out_dict["Designs"] = np.array(designs)
+    times, designs = influx_fetch.join_fields(results)
+    out_dict["Times"] = influx_fetch.to_time(times)
+    out_dict["Designs"] = designs
     sorter = out_dict["Times"].argsort()
     out_dict["Times"] = out_dict["Times"][sorter]
     out_dict["Designs"] = out_dict["Designs"][sorter]
@@ -46,10 +44,10 @@ def get_designs(time_1, time_2, out_dict: dict={}):
 
 
 @click.command()
-@click.option("-1", "--t1", "time_1", default=Time.now() - 20,
+@click.option("-1", "--t1", "time_1", default=None,
               help="The start time, preferably in isot or SJD format."
               " By default, it's 20 days ago.")
-@click.option("-2", "--t2", "time_2", default=Time.now(),
+@click.option("-2", "--t2", "time_2", default=None,
               help="The end time, preferably in isot or SJD format. By default,"
               " it is today")
 @click.option("-c", "--collisions", is_flag=True, default=True,
@@ -63,8 +61,13 @@ def get_designs(time_1, time_2, out_dict: dict={}):
 @click.option("-v", "--verbose", count=True, help="Verbose debugging")
 def main(time_1, time_2, collisions, do_designs, outofrange, individuals,
          verbose: int):
+    from astropy.time import Time
     run_collisions = collisions
     run_outofrange = outofrange
+    if time_1 is None:
+        time_1 = Time.now() - 20
+    if time_2 is None:
+        time_2 = Time.now()
     try:
         time_1 = Time(time_1)
     except ValueError:
@@ -76,10 +79,11 @@ def main(time_1, time_2, collisions, do_designs, outofrange, individuals,
     
     tstart = Time.now()
     if do_designs:
-        designs_dict = mp.Manager().dict()
-        design_p = mp.Process(target=get_designs,
-                              args=(time_1, time_2, designs_dict))
-        design_p.start()
+        # The query waits on the server while the logs are read
+        pool = concurrent.futures.ThreadPoolExecutor(1)
+        design_future = pool.submit(
+            influx_fetch.gather_queries,
+            {"designs": designs_request(time_1, time_2)}, deadline=6)
 
     re_iso = re.compile("\d{4}-\d{2}-\d{2} \d{2}:\d{2}:\d{2}")
     targets = []
@@ -132,18 +136,18 @@ def main(time_1, time_2, collisions, do_designs, outofrange, individuals,
                 d["Times"].append(time_str)
                 d["Robots"].append(int(d["RERobot"].search(match).group(0)))
     if do_designs:
+        results, errors = design_future.result()
+        pool.shutdown()
         tend = Time.now()
-        dt = (tstart - tend).sec
-        while design_p.is_alive() and dt < 6:
-            tend = Time.now()
-            dt = (tstart - tend).sec
-            time.sleep(1)
-        design_p.join(6)
         dt = (tend - tstart).sec
         if verbose:
             print(f"Influx query took {dt}s")
- 
-        if not designs_dict["Success"]:
+        influx_fetch.report(errors)
+        designs_dict = {}
+        if "designs" in results:
+            get_designs(time_1, time_2, designs_dict,
+                        results=results["designs"])
+        if not designs_dict.get("Success"):
             raise TimeoutError("Couldn't complete InfluxDB query")
     
     for d in targets:
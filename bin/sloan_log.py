@@ -16,25 +16,34 @@ In order to run it locally, you will need to either have access to /data, or
  /data/apogee/archive. You'll also need setup local forwarding for InfluxDB
 """
 import argparse
-import multiprocessing
+import concurrent.futures
+import contextlib
+import cProfile
+import csv
+import functools
+import io
+import json
 import sys
-import textwrap
+import time
+import traceback
 import warnings
-import fitsio
 
 import numpy as np
 try:
-    from bin import m4l, telescope_status, get_dust
+    from bin import sjd
 except ImportError as e:
     raise ImportError('Please add ObserverTools/bin to your PYTHONPATH:'
                       '\n    {}'.format(e))
 from pathlib import Path
 from tqdm import tqdm
-from astropy.time import Time
 
-from sdssobstools import apogee_data, log_support, boss_data, sdss_paths
+from sdssobstools import (apogee_data, boss_data, sdss_paths, exposure_cache,
+                          exposure_table, night_log, profiling, query_cache,
+                          telemetry)
 
-from bin import sjd
+# astropy, scipy, influxdb_client, and the telemetry scripts are slow to
+# import, so they're imported in the methods that use them, and sections
+# like -b start quickly
 
 if sys.version_info.major < 3:
     raise Exception('Interpretter must be python 3.5 or newer')
@@ -50,6 +59,68 @@ ap_dir = sdss_paths.ap_archive
 b_dir = sdss_paths.boss
 
 
+def read_apogee(image, args):
+    """Reads an APOGEE exposure and returns a small dictionary of everything
+    Logging needs from it, including dome flat results and dither offsets. It
+    is a module-level function so that it can be run in a process pool. If
+    the exposure is still being written, it returns None.
+    """
+    img = apogee_data.APOGEERaw(image, args, 1)
+    if img.lead is None:
+        return None
+    rec = {'file': img.file.name, 'exp_id': img.exp_id,
+           'date_obs': img.date_obs, 'field_id': img.field_id,
+           'design_id': img.design_id, 'config_id': img.config_id,
+           'lead': img.lead, 'exp_type': img.exp_type, 'dither': img.dither,
+           'n_read': img.n_read, 'seeing': img.seeing, 'kind': None}
+    if '-a-' not in img.file.name:
+        return rec
+    if img.exp_type == 'Domeflat':
+        # The quickred is read with every other flat in fit_flats
+        path = img.quickred_path()
+        rec['kind'] = 'Domeflat'
+        rec['quickred'] = None if path is None else Path(path).as_posix()
+        # Without a quickred file, it's worth trying again on the next run
+        rec['complete'] = path is not None
+    elif 'Arc' in img.exp_type:
+        rec['kind'] = 'Arc'
+        rec['lamp'] = None
+        if 'ThAr' in img.exp_type:
+            line_fit = ((60, 70), 1105, 40, 1.27)
+            rec['lamp'] = 'ThAr'
+        elif 'UNe' in img.exp_type:
+            line_fit = ((60, 70), 1190, 30, 3)
+            rec['lamp'] = 'UNe'
+    elif 'Object' in img.exp_type:
+        # TODO check an object image for a good FWHM (last
+        # input)
+        rec['kind'] = 'Object'
+        # line_fit = ((30, 35), 1090, 40, 2)
+        line_fit = ((30, 35), 1100, 40, 2)
+    if rec['kind'] == 'Object' or rec.get('lamp') is not None:
+        # The line is fit later with every other exposure, in fit_offsets
+        fibers, w0, dw, sigma = line_fit
+        profile = img.line_profile(fibers, w0, dw)
+        rec['w0'] = w0
+        rec['sigma'] = sigma
+        rec['line_x'] = None if profile is None else profile[0]
+        rec['line'] = None if profile is None else profile[1]
+        rec['complete'] = profile is not None
+    return rec
+
+
+def read_boss(image):
+    """Reads a BOSS exposure and returns a small dictionary of everything
+    Logging needs from it. Like read_apogee, it can be run in a process pool.
+    """
+    img = boss_data.BOSSRaw(image)
+    return {'exp_id': img.exp_id, 'date_obs': img.date_obs,
+            'field_id': img.field_id, 'design_id': img.design_id,
+            'config_id': img.config_id, 'lead': img.lead,
+            'dither': img.dither, 'flavor': img.flavor,
+            'exp_time': img.exp_time, 'hartmann': img.hartmann}
+
+
 class Logging:
     """
     A tool to produce a ton of various outputs used for logging. This tool uses
@@ -76,38 +147,69 @@ class Logging:
 
     """
 
-    def __init__(self, ap_images, m_images, args):
+    def __init__(self, ap_images, m_images, args, night_telemetry=None):
         self.ap_images = ap_images
         self.b_images = m_images
         self.args = args
-        # Dictionary keys that begin with c are of len(carts_in_a_night),
-        # keys that begin with i are of len(images_in_a_night), keys that begin
-        # with d are of len(dome_flats) (which is not always the same as carts,
-        # keys that begin with a are of len(apogee_arcs), which is usually 4 in
-        # a full night (morning and evening cals), keys that begin with h are of
-        # len(hartmanns), which is usually a few longer than len(carts). Each
-        # first letter is used to choose which sorting key to use. There must be
-        # a Time key for each new letter, and a new sorter argument must be
-        # added to self.sort. All of these dictionary items begin as lists,
-        # and are converted to np.arrays or astropy.time.Times in self.sort.
-        self.data = {'dField': [], 'dTime': [], 'dConfig': [], 'cLead': [],
-                     "dDesign": [], "dTimes": []}
-        self.ap_data = {'dDesign': [], "dConfig": [], 'dTime': [],
-                        'iTime': [], 'iID': [],
-                        'iSeeing': [], 'iDetector': [], 'iDither': [],
-                        'iNRead': [], 'iEType': [], 'iDesign': [],
-                        "iDesign": [], "iConfig": [],
-                        'fDesign': [], 'fTime': [], 'fMissing': [], 'fFaint': [],
-                        'fNMissing': [], 'fNFaint': [], 'fRatio': [], 'aTime': [],
+        # Records of every image that has been read, see read_apogee and
+        # read_boss. They're kept so that the tables below can be rebuilt
+        # when new images arrive in --follow mode. Records that read_apogee
+        # couldn't complete, like a dome flat without its quickred file yet,
+        # are kept in ap_incomplete instead, and their images are read again
+        # by the next parse_images
+        self.ap_records = []
+        self.b_records = []
+        self.read_paths = set()
+        self.ap_incomplete = {}
+        self.reset_tables()
+        self.morning_filter = None
+        self.cache = None
+        cache_dir = getattr(self.args, 'cache_dir', None)
+        if cache_dir and not getattr(self.args, 'no_cache', False):
+            self.cache = exposure_cache.ExposureCache(
+                cache_dir, self.args.sjd,
+                rebuild=getattr(self.args, 'rebuild_cache', False))
+
+        # The InfluxDB queries of p_summary, p_data, and log_support, which
+        # run already started them when it was given, and their results
+        self.telemetry = (telemetry.Telemetry(args) if night_telemetry is None
+                          else night_telemetry)
+        self.support = {"offsets": "", "focus": "", "weather": "",
+                        "hartmann": ""}
+
+    @property
+    def ap_master(self):
+        """The master dome flat column for ap_test, only loaded for APOGEE"""
+        return apogee_data.master_dome_flat_col()
+
+    def reset_tables(self):
+        """Empties the exposure tables and data dictionaries so that they can
+        be filled again"""
+        # Every exposure is a row of ap_table or b_table (see
+        # sdssobstools/exposure_table.py), and self.sort turns them into
+        # the data dictionaries. Dictionary keys that begin with i are of
+        # len(images_in_a_night), keys that begin with d (or c) are per field
+        # and are computed from the i keys with a GroupBy, keys that begin
+        # with f are of len(dome_flats), keys that begin with a are of
+        # len(apogee_arcs), which is usually 4 in a full night (morning and
+        # evening cals), keys that begin with o are of len(apogee_objects),
+        # and keys that begin with h are of len(hartmanns), which is usually a
+        # few longer than len(fields). Each first letter is used to choose
+        # which sorting key to use. There must be a Time key for each new
+        # letter, and a new sorter argument must be added to self.sort. The
+        # f, a, o, and h items begin as lists, and are converted to np.arrays
+        # or astropy.time.Times in self.sort.
+        self.ap_table = exposure_table.ExposureTable(
+            exposure_table.apogee_dtype, len(self.ap_records))
+        self.b_table = exposure_table.ExposureTable(
+            exposure_table.boss_dtype, len(self.b_records))
+        self.data = {}
+        self.ap_data = {'fDesign': [], 'fTime': [], 'fMissing': [],
+                        'fFaint': [], 'fNMissing': [], 'fNFaint': [],
+                        'fRatio': [], 'fField': [], 'aTime': [],
                         'aOffset': [], 'aID': [], 'aLamp': [], 'oTime': [],
-                        'oOffset': [], 'oDither': [], "dField": [],
-                        "iField": [], "fField": []}
-        self.b_data = {'dDesign': [], "dConfig": [], 'dTime': [], "dField": [],
-                       'iTime': [], 'iID': [],
-                       'iDetector': [], 'iDither': [],
-                       'iEType': [], 'idt': [], 'iField': [], 'iHart': [],
-                       'iDesign': [], "iConfig": [], 'hTime': [],
-                       "hField": []}
+                        'oOffset': [], 'oDither': []}
+        self.b_data = {'hTime': [], "hField": []}
         # These values are not known from the header and must be created
         # after self.sort. N for number, AP or B for APOGEE or BOSS, and NSE
         # for BOSS dithers, and AB for APOGEE dithers, dt for boss exposure
@@ -117,298 +219,308 @@ class Logging:
                             'dNBE': [], 'dNBC': [], 'dBdt': [], 'dNB': [],
                             'dAPSummary': [],
                             'dBSummary': []}
-        master_path = (Path(apogee_data.__file__).absolute().parent.parent
-                       / "dat/master_dome_flat.fits.gz")
-        if not master_path.exists():
-            master_path = (Path(apogee_data.__file__).absolute(
-            ).parent.parent.parent / "dat/master_dome_flat.fits.gz")
-        master_data = fitsio.read(master_path.as_posix())
-        self.ap_master = np.median(master_data[:, 550:910], axis=1)
-        self.morning_filter = None
-        self.ap_image = None
-        
-        self.support = multiprocessing.Manager().dict()
-        self.support["offsets"] = ""
-        self.support["focus"] = ""
-        self.support["weather"] = ""
-        self.support["hartmann"] = ""
-
-    def ap_test(self, img):
-        """Calls aptest on hub, this could certainly be replaced in the near
-        future.
-        """
-        # This is from ap_test
-        self.args.plot = False
-        missing, faint, flux_ratio = img.ap_test((550, 910), self.ap_master)
+
+    def ap_test(self, rec):
+        """Stores the dome flat results of an APOGEE exposure record, which
+        were computed by read_apogee using the quickred ap_test"""
         if self.args.verbose:
-            print('Exposure {}'.format(img.exp_id))
-            print(missing, faint)
-        n_missing = 0
-        n_faint = 0
-        for miss in missing:
-            if isinstance(miss, bytes) or isinstance(miss, str):
-                if 'bundle' in miss:
-                    n_missing += 30
-                else:
-                    n_missing += abs(eval(miss))
-            else:
-                n_missing += 1
-        for fain in faint:
-            if isinstance(fain, bytes) or isinstance(fain, str):
-                if 'bundle' in fain:
-                    n_faint += 30
-                else:
-                    n_faint += np.abs(eval(fain))
+            print('Exposure {}'.format(rec['exp_id']))
+            print(rec['missing'], rec['faint'])
+        self.ap_data['fNMissing'].append(rec['n_missing'])
+        self.ap_data['fNFaint'].append(rec['n_faint'])
+        self.ap_data['fMissing'].append(rec['missing'])
+        self.ap_data['fFaint'].append(rec['faint'])
+        self.ap_data['fRatio'].append(rec['flux_ratio'])
+        self.ap_data['fDesign'].append(rec['design_id'])
+        self.ap_data['fField'].append(rec['field_id'])
+        self.ap_data['fTime'].append(rec['date_obs'])
+
+    def read_images(self, reader, images, fit=None, **kwargs):
+        """Runs reader on every image and returns the records in the same
+        order as images. Records already in self.cache are not read again. If
+        args.jobs is more than 1, the headers are read in a process pool,
+        which helps a lot when /data is mounted over NFS. fit, if given, is
+        run on the new records before they are cached"""
+        records = [None] * len(images)
+        to_read = list(range(len(images)))
+        if self.cache is not None:
+            to_read = []
+            for i, image in enumerate(images):
+                records[i] = self.cache.get(image)
+                if records[i] is None:
+                    to_read.append(i)
+            if self.args.verbose:
+                print(f"{len(images) - len(to_read)} records read from"
+                      f" {self.cache.path}")
+        new_images = [images[i] for i in to_read]
+        jobs = getattr(self.args, 'jobs', 1) or 1
+        noprogress = getattr(self.args, 'noprogress', False)
+        name = reader.__name__
+        reader = functools.partial(reader, **kwargs)
+        with profiling.span(name) as counts:
+            counts['files'] = len(new_images)
+            counts['cached'] = len(images) - len(new_images)
+            if profiling.enabled():
+                counts['bytes'] = sum(Path(image).stat().st_size
+                                      for image in new_images)
+            if jobs <= 1 or len(new_images) <= 1:
+                new_records = [reader(image) for image in
+                               tqdm(new_images, disable=noprogress)]
             else:
-                n_faint += 1
-        # return (n_missing, n_faint, missing, faint, img.cart_id,
-        #         img.isot)
-        self.ap_data['fNMissing'].append(n_missing)
-        self.ap_data['fNFaint'].append(n_faint)
-        self.ap_data['fMissing'].append(missing)
-        self.ap_data['fFaint'].append(faint)
-        self.ap_data['fRatio'].append(flux_ratio)
-        self.ap_data['fDesign'].append(img.design_id)
-        self.ap_data['fField'].append(img.field_id)
-        self.ap_data['fTime'].append(img.isot)
+                chunksize = max(1, len(new_images) // (jobs * 4))
+                with concurrent.futures.ProcessPoolExecutor(jobs) as pool:
+                    new_records = list(tqdm(pool.map(reader, new_images,
+                                                     chunksize=chunksize),
+                                            total=len(new_images),
+                                            disable=noprogress))
+        if fit is not None:
+            fit(new_records)
+        for i, rec in zip(to_read, new_records):
+            records[i] = rec
+            if (self.cache is not None) and (rec is not None):
+                if rec.get('complete', True):
+                    self.cache.put(images[i], rec)
+        if self.cache is not None:
+            self.cache.commit()
+        return records
 
     def parse_images(self):
-        """Goes through every image in ap_images and m_images to put them in
-        dictionaries."""
+        """Reads every image in ap_images and b_images that hasn't been read
+        yet, and then puts all of their records in dictionaries. In --follow
+        mode, it is called again with each new list of images, so only the new
+        ones are read, along with those that were still being written. Returns
+        the number of images that have new or more complete records"""
+        self.reset_tables()
+        # Files may have been written since the last run
+        sdss_paths.refresh_listings()
+        n_updated = 0
         if self.args.apogee:
-            print('Reading APOGEE Data ({})'.format(len(self.ap_images)))
-            img = None
-            for image in tqdm(self.ap_images):
-                img = apogee_data.APOGEERaw(image, self.args, 1)
-                # img.parse_layer(1)
-                if img.lead is None:  # If the first exposure is still
+            self.ap_images = list(self.ap_images)
+            new_images = [image for image in self.ap_images
+                          if image not in self.read_paths]
+            print('Reading APOGEE Data ({})'.format(len(new_images)))
+            records = self.read_images(read_apogee, new_images,
+                                       fit=self.fit_flats, args=self.args)
+            with profiling.span('fit_offsets'):
+                self.fit_offsets(records)
+            for image, rec in zip(new_images, records):
+                if rec is None:  # If the first exposure is still
                     # writing, plate_id will be empty and without this if,
                     # it would fail. With this if, it will skip the plate
                     print(f"Skipping {image}")
                     continue
-                if (img.exp_type == 'Domeflat') and ('-a-' in img.file.name):
-                    self.ap_test(img)
-                elif ('Arc' in img.exp_type) and ('-a-' in img.file.name):
-                    self.ap_data['aTime'].append(img.isot)
-                    self.ap_data['aID'].append(img.exp_id)
-                    if 'ThAr' in img.exp_type:
-                        self.ap_data['aOffset'].append(
-                            img.compute_offset((60, 70), 1105, 40, 1.27))
-                        self.ap_data['aLamp'].append('ThAr')
-                    elif 'UNe' in img.exp_type:
-                        self.ap_data['aOffset'].append(
-                            img.compute_offset((60, 70), 1190, 30, 3))
-                        self.ap_data['aLamp'].append('UNe')
-                    else:
-                        print("Couldn't parse the arc image: {} with exposure"
-                              " type {}".format(img.file, img.exp_type))
-                        self.ap_data["aTime"].pop()
-                        self.ap_data["aID"].pop()
-                elif ('Object' in img.exp_type) and ('-a-' in img.file.name):
-                    # TODO check an object image for a good FWHM (last
-                    # input)
-                    self.ap_data['oTime'].append(img.isot)
-                    self.ap_data['oOffset'].append(
-                        # img.compute_offset((30, 35), 1090, 40, 2))
-                        img.compute_offset((30, 35), 1100, 40, 2))
-                    self.ap_data['oDither'].append(img.dither)
-
-                if img.field_id not in self.data['dField']:
-                    self.data['dField'].append(img.field_id)
-                    self.data['dDesign'].append(set([img.design_id]))
-                    self.data['dConfig'].append(set([img.config_id]))
-                    self.data['dTime'].append(img.isot)
-                    self.data['dTimes'].append([img.isot])
-                    try:
-                        self.data['cLead'].append(img.lead)
-                    except AttributeError:
-                        self.data["cLead"].append("")
-                else:
-                    i = self.data['dField'].index(img.field_id)
-                    # If a design has multiple configs, take the lowest (first)
-                    self.data["dDesign"][i].add(img.design_id)
-                    self.data["dConfig"][i].add(img.config_id)
-                    if img.isot < self.data['dTime'][i]:
-                        self.data['dTime'].pop(i)
-                        self.data['dTime'].insert(i, img.isot)
-                    for i, d in enumerate(self.data["dDesign"]):
-                        if d == img.design_id:
-                            self.data["dTimes"][i] = min(self.data["dTimes"][i],
-                                                         img.isot)
-                if img.field_id not in self.ap_data['dField']:
-                    self.ap_data['dField'].append(img.field_id)
-                    self.ap_data['dDesign'].append(set([img.design_id]))
-                    self.ap_data['dConfig'].append(set([img.config_id]))
-                    self.ap_data['dTime'].append(img.isot)
-                else:
-                    i = self.ap_data['dField'].index(img.field_id)
-                    self.ap_data["dDesign"][i].add(img.design_id)
-                    self.ap_data["dConfig"][i].add(img.config_id)
-                    if img.isot < self.ap_data['dTime'][i]:
-                        self.ap_data['dTime'].pop(i)
-                        self.ap_data['dTime'].insert(i, img.isot)
-                detectors = []
-                arch_dir = sdss_paths.ap_archive / f"{self.args.sjd}/"
-                # red_dir = Path('/data/apogee/quickred/{}/'.format(
-                #     self.args.sjd))
-                # This used to see if quickred processed, but others preferred
-                # to see if the archive image was written
-                arch_name = 'apR-a-{}.apz'.format(img.exp_id)
-                if (arch_dir / arch_name).exists():
-                    detectors.append('a')
-                # elif (red_dir / arch_name.replace('1D', '2D')).exists():
-                # detectors.append('2')
+                if rec.get('complete', True):
+                    self.read_paths.add(image)
+                    self.ap_records.append(rec)
+                    self.ap_incomplete.pop(image, None)
+                    n_updated += 1
                 else:
-                    detectors.append('x')
-                if (arch_dir / arch_name.replace('-a-', '-b-')).exists():
-                    detectors.append('b')
-                # elif (red_dir / arch_name.replace('-a-', '-b-').replace(
-                # '1D', '2D')).exists():
-                # detectors.append('2')
-                else:
-                    detectors.append('x')
-                if (arch_dir / arch_name.replace('-a-', '-c-')).exists():
-                    detectors.append('c')
-                # elif (red_dir / arch_name.replace('-a-', '-c-').replace(
-                # '1D', '2D')).exists():
-                # detectors.append('2')
-                else:
-                    detectors.append('x')
-                self.ap_data['iTime'].append(img.isot)
-                self.ap_data['iID'].append(img.exp_id)
-                self.ap_data['iSeeing'].append(img.seeing)
-                self.ap_data['iDetector'].append('-'.join(detectors))
-                self.ap_data['iDither'].append(img.dither)
-                self.ap_data['iNRead'].append(img.n_read)
-                self.ap_data['iEType'].append(img.exp_type)
-                self.ap_data['iDesign'].append(img.design_id)
-                self.ap_data["iField"].append(img.field_id)
-                self.ap_data['iConfig'].append(img.config_id)
-            if img is not None:
-                self.ap_image = img
+                    n_updated += image not in self.ap_incomplete
+                    self.ap_incomplete[image] = rec
+            self.ap_table.reserve(len(self.ap_records)
+                                  + len(self.ap_incomplete))
+            for rec in self.ap_records + list(self.ap_incomplete.values()):
+                self.add_apogee(rec)
         if self.args.boss:
-            print('Reading BOSS Data ({})'.format(len(self.b_images)))
-            for image in tqdm(self.b_images):
-                img = boss_data.BOSSRaw(image)
-                if img.field_id not in self.data['dField']:
-                    self.data['dField'].append(img.field_id)
-                    self.data['dDesign'].append(set([img.design_id]))
-                    self.data['dConfig'].append(set([img.config_id]))
-                    self.data['dTimes'].append([img.isot])
-                    try:
-                        self.data['cLead'].append(img.lead)
-                    except AttributeError:
-                        self.data["cLead"].append("")
-                    self.data['dTime'].append(img.isot)
-                else:
-                    i = self.data['dField'].index(img.field_id)
-                    self.data["dDesign"][i].add(img.design_id)
-                    self.data["dConfig"][i].add(img.config_id)
-                    if img.isot < self.data['dTime'][i]:
-                        self.data['dTime'].pop(i)
-                        self.data['dTime'].insert(i, img.isot)
-                    for i, d in enumerate(self.data["dDesign"]):
-                        if d == img.design_id:
-                            self.data["dTimes"][i] = min(self.data["dTimes"][i],
-                                                         img.isot)
-                            
-                if img.field_id not in self.b_data['dField']:
-                    self.b_data['dField'].append(img.field_id)
-                    self.b_data["dDesign"].append(set([img.design_id]))
-                    self.b_data["dConfig"].append(set([img.config_id]))
-                    self.b_data['dTime'].append(img.isot)
-                else:
-                    i = self.b_data['dField'].index(img.field_id)
-                    self.b_data["dDesign"][i].add(img.config_id)
-                    self.b_data["dConfig"][i].add(img.config_id)
-                    if img.isot < self.b_data['dTime'][i]:
-                        self.b_data['dTime'].pop(i)
-                        self.b_data['dTime'].insert(i, img.isot)
-                self.b_data['iTime'].append(img.isot)
-                self.b_data['iID'].append(img.exp_id)
-                # self.b_data['iSeeing'].append(img.seeing)
-                self.b_data['iDither'].append(img.dither)
-                self.b_data['iEType'].append(img.flavor)
-                self.b_data['idt'].append(img.exp_time)
-                self.b_data['iDesign'].append(img.design_id)
-                self.b_data['iHart'].append(img.hartmann)
-                if img.hartmann == "Left":
-                    self.b_data["hTime"].append(img.isot)
-                    self.b_data["hField"].append(img.field_id)
-                self.b_data['iConfig'].append(img.config_id)
-                self.b_data["iField"].append(img.field_id)
-
-                sos_files = []
-                # img_mjd = int(Time(img.isot).mjd)
-                # All boss exposures write as splog, but manga writes different
-                red_dir = sdss_paths.sos / f"{self.args.sjd}"
-                red_fil = red_dir / 'splog-r1-{:0>8}.log'.format(img.exp_id)
-                try:
-                    red_fil.exists()
-                except OSError:
-                    pass
-                if red_fil.exists():
-                    sos_files.append('r1')
-                else:
-                    sos_files.append('xx')
-                if (red_fil.parent / red_fil.name.replace('r1', 'b1')).exists():
-                    sos_files.append('b1')
-                else:
+            self.b_images = list(self.b_images)
+            new_images = [image for image in self.b_images
+                          if image not in self.read_paths]
+            print('Reading BOSS Data ({})'.format(len(new_images)))
+            records = self.read_images(read_boss, new_images)
+            self.read_paths.update(new_images)
+            self.b_records += records
+            n_updated += len(new_images)
+            self.b_table.reserve(len(self.b_records))
+            for rec in self.b_records:
+                self.add_boss(rec)
+        return n_updated
+
+    def fit_flats(self, records):
+        """Reads the quickred files of the dome flat records from read_apogee
+        that haven't been compared yet, all in one batch, compares their
+        median columns to the master flat, and sets their missing and faint
+        fibers"""
+        flats = [rec for rec in records
+                 if (rec is not None) and ('quickred' in rec)
+                 and ('flux_ratio' not in rec)]
+        if len(flats) == 0:
+            return
+        with profiling.span('fit_flats') as counts:
+            counts['files'] = len(flats)
+            slabs = apogee_data.read_flat_slabs(
+                [rec['quickred'] for rec in flats],
+                jobs=getattr(self.args, 'jobs', 1) or 1)
+            results = apogee_data.dome_flat_results(np.median(slabs, axis=2),
+                                                    self.ap_master)
+        for i, rec in enumerate(flats):
+            rec['missing'] = results['missing'][i]
+            rec['faint'] = results['faint'][i]
+            rec['n_missing'] = int(results['n_missing'][i])
+            rec['n_faint'] = int(results['n_faint'][i])
+            rec['flux_ratio'] = results['flux_ratio'][i]
+
+    @staticmethod
+    def fit_offsets(records):
+        """Fits the lines of the arc and object records from read_apogee
+        that don't have an offset yet, in one batch per line and window, and
+        sets their offsets"""
+        batches = {}
+        for rec in records:
+            if (rec is None) or ('offset' in rec) or ('w0' not in rec):
+                continue
+            if rec['line'] is None:
+                rec['offset'] = np.nan
+                continue
+            key = (rec['w0'], rec['sigma'], int(rec['line_x'][0]),
+                   len(rec['line_x']))
+            batches.setdefault(key, []).append(rec)
+        for (w0, sigma, _, _), batch in batches.items():
+            centers = apogee_data.fit_line_centers(
+                [rec['line'] for rec in batch], batch[0]['line_x'], w0, sigma)
+            for rec, center in zip(batch, centers):
+                rec['offset'] = center - w0
+                apogee_data.check_offset(rec['exp_id'], rec['offset'], w0)
+
+    def add_apogee(self, rec):
+        """Adds an APOGEE exposure record from read_apogee to ap_table and the
+        dome flat, arc, and object lists"""
+        if rec['kind'] == 'Domeflat':
+            self.ap_test(rec)
+        elif rec['kind'] == 'Arc':
+            if rec['lamp'] is None:
+                print("Couldn't parse the arc image: {} with exposure"
+                      " type {}".format(rec['file'], rec['exp_type']))
+            else:
+                self.ap_data['aTime'].append(rec['date_obs'])
+                self.ap_data['aID'].append(rec['exp_id'])
+                self.ap_data['aOffset'].append(rec['offset'])
+                self.ap_data['aLamp'].append(rec['lamp'])
+        elif rec['kind'] == 'Object':
+            self.ap_data['oTime'].append(rec['date_obs'])
+            self.ap_data['oOffset'].append(rec['offset'])
+            self.ap_data['oDither'].append(rec['dither'])
+
+        # Detector files are only looked for again if one was missing
+        if 'x' in rec.get('detectors', 'x'):
+            # This used to see if quickred processed, but others preferred
+            # to see if the archive image was written
+            arch_dir = sdss_paths.ap_archive / f"{self.args.sjd}"
+            rec['detectors'] = '-'.join(
+                chip if sdss_paths.exists(
+                    arch_dir / f"apR-{chip}-{rec['exp_id']}.apz") else 'x'
+                for chip in 'abc')
+        self.ap_table.append(rec)
+
+    def add_boss(self, rec):
+        """Adds a BOSS exposure record from read_boss to b_table and the
+        hartmann lists"""
+        if rec['hartmann'] == "Left":
+            self.b_data["hTime"].append(rec['date_obs'])
+            self.b_data["hField"].append(rec['field_id'])
+
+        if 'x' in rec.get('detectors', 'x'):
+            # All boss exposures write as splog, but manga writes different.
+            # r1 and b1 are always shown, r2 and b2 only if they exist
+            red_dir = sdss_paths.sos / f"{self.args.sjd}"
+            sos_files = []
+            for camera in ('r1', 'b1', 'r2', 'b2'):
+                if sdss_paths.exists(
+                        red_dir / f"splog-{camera}-{rec['exp_id']:0>8}.log"):
+                    sos_files.append(camera)
+                elif camera.endswith('1'):
                     sos_files.append('xx')
-                if (red_fil.parent / red_fil.name.replace('r1', 'r2')).exists():
-                    sos_files.append('r2')
-                # else:
-                #     m_detectors.append('xx')
-                if (red_fil.parent / red_fil.name.replace('r1', 'b2')).exists():
-                    sos_files.append('b2')
-                # else:
-                #     m_detectors.append('xx')
-                self.b_data['iDetector'].append('-'.join(sos_files))
+            rec['detectors'] = '-'.join(sos_files)
+        self.b_table.append(rec)
+
+    @staticmethod
+    def to_time(times):
+        """Converts a datetime64 column to an astropy Time, only for what
+        needs one, like comparing to telemetry times"""
+        from astropy.time import Time
+        times = Time(np.asarray(times, dtype='M8[ns]'), format='datetime64')
+        times.format = 'isot'
+        return times
+
+    def field_table(self, fields, times, designs, configs, leads=None):
+        """Reduces the exposure columns to one row per field, sorted by the
+        time of the first exposure of each field. Returns a data dictionary of
+        d keys, and cLead if leads are given"""
+        groups = exposure_table.GroupBy(fields)
+        table = {'dField': groups.keys,
+                 'dTime': times[groups.argmin(times)],
+                 'dDesign': groups.sets(designs),
+                 'dConfig': groups.sets(configs)}
+        if leads is not None:
+            table['cLead'] = leads[groups.first]
+        sorter = table['dTime'].argsort(kind='stable')
+        for key, item in table.items():
+            table[key] = item[sorter]
+        return table
 
     def sort(self):
-        """Sorts self.ap_data by design time and by image time and converts to
-        arrays"""
+        """Sorts the exposure tables by image time into self.ap_data and
+        self.b_data, and computes the per-field tables from them. Every Time
+        key is a datetime64[ns] array (see exposure_table.parse_times), and the
+        i and d keys get a UTC key of HH:MM:SS strings for printing"""
+        ap_rows = self.ap_table.rows
+        b_rows = self.b_table.rows
         # Data
-        for key, item in self.data.items():
-            if 'Time' in key and "Times" not in key:
-                try:
-                    self.data[key] = Time(item)
-                except ValueError:
-                    self.data[key] = Time(item, format='isot')
+        self.data = self.field_table(
+            np.concatenate((ap_rows['field_id'], b_rows['field_id'])),
+            exposure_table.parse_times(np.concatenate((ap_rows['date_obs'],
+                                                       b_rows['date_obs']))),
+            np.concatenate((ap_rows['design_id'], b_rows['design_id'])),
+            np.concatenate((ap_rows['config_id'], b_rows['config_id'])),
+            np.concatenate((ap_rows['lead'], b_rows['lead'])))
+
+        self.data['dUTC'] = exposure_table.hms(self.data['dTime'])
+
+        ap_times = exposure_table.parse_times(ap_rows['date_obs'])
+        ap_fields = self.field_table(
+            ap_rows['field_id'], ap_times, ap_rows['design_id'],
+            ap_rows['config_id'])
+        self.ap_data.update(ap_fields)
+        ap_img_sorter = ap_times.argsort(kind='stable')
+        ap_rows = ap_rows[ap_img_sorter]
+        self.ap_data.update({'iTime': ap_times[ap_img_sorter],
+                             'iMJD': exposure_table.to_mjd(
+                                 ap_times[ap_img_sorter]),
+                             'iUTC': exposure_table.hms(
+                                 ap_times[ap_img_sorter]),
+                             'iID': ap_rows['exp_id'],
+                             'iSeeing': ap_rows['seeing'],
+                             'iDetector': ap_rows['detectors'],
+                             'iDither': ap_rows['dither'],
+                             'iNRead': ap_rows['n_read'],
+                             'iEType': ap_rows['exp_type'],
+                             'iDesign': ap_rows['design_id'],
+                             'iField': ap_rows['field_id'],
+                             'iConfig': ap_rows['config_id']})
+        for key, item in self.ap_data.items():
+            if key[0] in 'di':
+                continue
+            if 'Time' in key:
+                self.ap_data[key] = exposure_table.parse_times(item)
+            elif key in ('fMissing', 'fFaint'):
+                # A list of fiber runs for each flat, which differ in length
+                # and mix ints and strings, so they are kept as they are
+                column = np.empty(len(item), dtype=object)
+                for j, runs in enumerate(item):
+                    column[j] = list(runs)
+                self.ap_data[key] = column
             else:
-                self.data[key] = np.array(item)
-        data_sort = self.data['dTime'].argsort()
-        for key, item in self.data.items():
-            self.data[key] = item[data_sort]
-
+                self.ap_data[key] = np.array(item)
+        ap_dome_sorter = self.ap_data['fTime'].argsort(kind='stable')
+        ap_arc_sorter = self.ap_data['aTime'].argsort(kind='stable')
+        ap_obj_sorter = self.ap_data['oTime'].argsort(kind='stable')
+        for key, item in self.ap_data.items():
+            if key[0] == 'f':
+                self.ap_data[key] = item[ap_dome_sorter]
+            elif key[0] == 'a':
+                self.ap_data[key] = item[ap_arc_sorter]
+            elif key[0] == 'o':
+                self.ap_data[key] = item[ap_obj_sorter]
         if self.args.apogee:
-            for key, item in self.ap_data.items():
-                if 'Time' in key:
-                    try:
-                        self.ap_data[key] = Time(item)
-                    except ValueError:
-                        self.ap_data[key] = Time(item, format='isot')
-                    except AttributeError:
-                        print(f"Could not read key {key} as time\n"
-                              f"{self.ap_data[key]}")
-                else:
-                    self.ap_data[key] = np.array(item)
-            ap_design_sorter = self.ap_data['dTime'].argsort()
-            ap_img_sorter = self.ap_data['iTime'].argsort()
-            ap_dome_sorter = self.ap_data['fTime'].argsort()
-            ap_arc_sorter = self.ap_data['aTime'].argsort()
-            ap_obj_sorter = self.ap_data['oTime'].argsort()
-            for key, item in self.ap_data.items():
-                if key[0] == 'd':
-                    self.ap_data[key] = item[ap_design_sorter]
-                elif key[0] == 'i':
-                    self.ap_data[key] = item[ap_img_sorter]
-                elif key[0] == 'f':
-                    self.ap_data[key] = item[ap_dome_sorter]
-                elif key[0] == 'a':
-                    self.ap_data[key] = item[ap_arc_sorter]
-                elif key[0] == 'o':
-                    self.ap_data[key] = item[ap_obj_sorter]
             if self.args.morning:
                 was_dark = False
                 prev_time = 0
@@ -425,55 +537,62 @@ class Logging:
                             prev_time = t
                             if self.args.verbose:
                                 print('Morning lower limit: {}'.format(
-                                    prev_time))
+                                    exposure_table.iso([prev_time])[0]))
                     else:
                         was_dark = False
-                upper = Time(self.args.sjd + 1, format='mjd')
+                upper = exposure_table.from_mjd(self.args.sjd + 1)
                 if lower is None:
                     raise Exception('Morning cals not completed for this date')
                 self.morning_filter = ((lower <= self.ap_data['iTime'])
                                        & (self.ap_data['iTime'] <= upper))
 
-        if self.args.boss:
-            for key, item in self.b_data.items():
-                if 'Time' in key:
-                    try:
-                        self.b_data[key] = Time(item)
-                    except ValueError:
-                        self.b_data[key] = Time(item, format='isot')
-                else:
-                    self.b_data[key] = np.array(item)
-            b_design_sorter = self.b_data['dTime'].argsort()
-            b_img_sorter = self.b_data['iTime'].argsort()
-            b_h_sorter = self.b_data['hTime'].argsort()
-            for key, item in self.b_data.items():
-                if key[0] == 'c':
-                    self.b_data[key] = item[b_design_sorter]
-                elif key[0] == 'i':
-                    self.b_data[key] = item[b_img_sorter]
-                elif key[0] == 'h':
-                    self.b_data[key] = item[b_h_sorter]
+
+        b_times = exposure_table.parse_times(b_rows['date_obs'])
+        b_fields = self.field_table(
+            b_rows['field_id'], b_times, b_rows['design_id'],
+            b_rows['config_id'])
+        self.b_data.update(b_fields)
+        b_img_sorter = b_times.argsort(kind='stable')
+        b_rows = b_rows[b_img_sorter]
+        self.b_data.update({'iTime': b_times[b_img_sorter],
+                            'iMJD': exposure_table.to_mjd(
+                                b_times[b_img_sorter]),
+                            'iUTC': exposure_table.hms(b_times[b_img_sorter]),
+                            'iID': b_rows['exp_id'],
+                            'iDither': b_rows['dither'],
+                            'iEType': b_rows['flavor'],
+                            'idt': b_rows['exp_time'],
+                            'iDesign': b_rows['design_id'],
+                            'iHart': b_rows['hartmann'],
+                            'iConfig': b_rows['config_id'],
+                            'iField': b_rows['field_id'],
+                            'iDetector': b_rows['detectors']})
+        self.b_data['hTime'] = exposure_table.parse_times(
+            self.b_data['hTime'])
+        self.b_data['hField'] = np.array(self.b_data['hField'])
+        b_h_sorter = self.b_data['hTime'].argsort(kind='stable')
+        self.b_data['hTime'] = self.b_data['hTime'][b_h_sorter]
+        self.b_data['hField'] = self.b_data['hField'][b_h_sorter]
+
+        # Rows of each field in the i keys, in the order of
+        # self.data['dField'], used for the counts of count_dithers
+        self.ap_groups = exposure_table.GroupBy(self.ap_data['iField'],
+                                                self.data['dField'])
+        self.b_groups = exposure_table.GroupBy(self.b_data['iField'],
+                                               self.data['dField'])
 
     def count_dithers(self):
-        for i, field in enumerate(self.data['dField']):
-            self.design_data["dNAPA"].append(np.sum(
-                (self.ap_data['iField'] == field)
-                & (self.ap_data['iDither'] == 'A')
-                & (self.ap_data['iEType'] == 'Object')))
-            self.design_data["dNAPB"].append(np.sum(
-                (self.ap_data['iField'] == field)
-                & (self.ap_data['iDither'] == 'B')
-                & (self.ap_data['iEType'] == 'Object')))
-            self.design_data["dNB"].append(np.sum(
-                (self.b_data['iField'] == field)
-                & (self.b_data['iEType'] == 'Science')))
-            if self.design_data["dNB"][-1] != 0:
-                self.design_data["dBdt"].append(np.max(
-                    self.b_data['idt'][
-                        (self.b_data['iField'] == field)
-                        & (self.b_data['iEType'] == 'Science')]))
-            else:
-                self.design_data["dBdt"].append(0)
+        ap_objects = self.ap_data['iEType'] == 'Object'
+        b_science = self.b_data['iEType'] == 'Science'
+        self.design_data['dNAPA'] = self.ap_groups.count(
+            ap_objects & (self.ap_data['iDither'] == 'A'))
+        self.design_data['dNAPB'] = self.ap_groups.count(
+            ap_objects & (self.ap_data['iDither'] == 'B'))
+        self.design_data['dNB'] = self.b_groups.count(b_science)
+        self.design_data['dBdt'] = self.b_groups.max(self.b_data['idt'],
+                                                     b_science)
+        self.design_data['dAPSummary'] = []
+        self.design_data['dBSummary'] = []
 
         for i, field in enumerate(self.data['dField']):
             """To determine the number of apogee a dithers per design (cNAPA),
@@ -496,74 +615,17 @@ class Logging:
             else:
                 self.design_data['dBSummary'].append('No BOSS')
 
-    def hartmann_parse(self, time):
-        output = '{}\n'.format(time.isot[:19])
-        inputs = []
-        for key in ["r1PistonMove_steps", "b1RingMove", "sp1AverageMove_steps",
-                    "sp1Residuals_deg", "sp1Temp_median"]:
-            time_delta =(self.support["harts"]['t' + key] - time).sec
-            x = self.support["harts"][key][(time_delta < 120)
-                                           & (time_delta > 0)]
-            if len(x) == 0:
-                inputs.append(np.nan)
-            else:
-                inputs.append(x[-1])
-        output += f"r1 Steps: {inputs[0]:>5.0f}, b1 Ring: {inputs[1]:>4.1f}\n"
-        output += f"Average Move:{inputs[2]:>5.0f}, Residuals:"
-        output += f" {inputs[3]:>4.1f}, Temp: {inputs[4]:>4.1f}\n"
-        return output
+    def p_text(self, *sections):
+        """Prints sections of the text log, from a night_log.NightLog"""
+        night_log.write_text(night_log.NightLog.from_logging(self, sections),
+                             sys.stdout)
 
     def p_summary(self):
-        print('=' * 80)
-        print('{:^80}'.format('Observing Summary'))
-        print('=' * 80)
-        print(f"{'Time':>8} {'Field':>6} {'Cadence':<24}"
-              f" {'APOGEE':<9} {'BOSS':<7} {'Completion':<10}")
-        for i, field in enumerate(self.data['dField']):
-            try:
-                line = (f"{self.data['dTimes'][i][0].isot[11:19]:>8}"
-                        f" {field:>6} {'':>24}"
-                        f" {self.design_data['dAPSummary'][i]:<9}"
-                        f" {self.design_data['dBSummary'][i]:<7}")
-                print(line)
-            except (IndexError, TypeError) as e:
-                continue
-        print()
-        if len(self.ap_data["fRatio"]) > 0:
-            flux_ratio = np.nanmean(np.array(self.ap_data["fRatio"]), axis=0)
-            avg = np.nanmean(flux_ratio)
-            missing = flux_ratio < 0.2
-            faint = (flux_ratio < 0.7) & (0.2 <= flux_ratio)
-            bright = ~missing & ~faint
-            i_missing = np.where(missing)[0].astype(int) + 1
-            i_faint = np.where(faint)[0].astype(int) + 1
-            i_bright = np.where(bright)[0]
-            if self.ap_image is not None:
-                missing_bundles = self.ap_image.create_bundles(i_missing)
-                faint_bundles = self.ap_image.create_bundles(i_faint)
-                print("APOGEE Dome Flats\n"
-                      f"Missing Fibers: {missing_bundles}\n"
-                      f"Faint fibers: {faint_bundles}\n"
-                      f"Average Throughput: {avg:.3f}")
-                print()
-            else:
-                print("No APOGEE Dome Flats")
-
-        print('### Notes:\n')
-        start_time = Time(self.args.sjd, format="mjd")
-        end_time = Time(self.args.sjd + 1, format="mjd")
-        dust_sum = get_dust.get_dust(start_time, end_time, self.args.verbose)
-        print('- Integrated Dust Counts: ~{:5.0f} dust-hrs'.format(
-            dust_sum - dust_sum % 100))
-        print('\n')
-
-        # print('=' * 80)
-        # print('{:^80}'.format('Comments Timeline'))
-        # print('=' * 80)
-        # print()
+        self.p_text('summary')
 
     @staticmethod
     def get_window(data, i, design):
+        from astropy.time import Time
         try:
             window = ((data['iTime']
                        >= data['dTime'][i])
@@ -575,7 +637,8 @@ class Logging:
         except IndexError:
             try:
                 window = ((data['iTime'] >= data['dTime'][i])
-                          & (data['iTime'] < Time.now() + 0.3)
+                          & (data['iTime'] < exposure_table.from_mjd(
+                              Time.now().mjd + 0.3))
                           & (data["iDesign"][i] == design)
                           )
             except IndexError:
@@ -584,246 +647,25 @@ class Logging:
         return window
 
     def p_data(self):
-        start = Time(self.args.sjd - 0.3, format='mjd')
-        end = Time(self.args.sjd + 1, format='mjd') - 0.3
-        end = Time.now() if Time.now() < end else end
-        tel = log_support.LogSupport(start, end, self.args)
-        tel.get_hartmann(self.support)
-
-        print('=' * 80)
-        print('{:^80}'.format('Data Log'))
-        print('=' * 80 + '\n')
-        for i, field in enumerate(self.data['dField']):
-            print('### Field {}\n'.format(field))
-            if field in self.ap_data['dField']:
-                ap_design = np.where(field == self.ap_data['dField'])[0][0]
-
-                print('# APOGEE')
-                print('{:<5} {:<8} {:>}-{:<6} {:<8} {:<12} {:<4} {:<6} {:<5}'
-                      ' {:<4}'.format('MJD', 'UTC', "Design", "Config",
-                                      'Exposure', 'Type',
-                                      'Dith', 'Reads', 'Arch',
-                                      'Seeing'))
-                print('-' * 80)
-                # window = self.get_window(self.ap_data, ap_design, design)
-                window = self.ap_data["iField"] == field
-                for (mjd, iso, des, conf, exp_id, exp_type, dith, nread,
-                     detectors, see) in zip(
-                    self.ap_data['iTime'][window].mjd + 0.3,
-                    self.ap_data['iTime'][window].iso,
-                    self.ap_data["iDesign"][window],
-                    self.ap_data["iConfig"][window],
-                    self.ap_data['iID'][window],
-                    self.ap_data['iEType'][window],
-                    self.ap_data['iDither'][window],
-                    self.ap_data['iNRead'][window],
-                    self.ap_data['iDetector'][window],
-                    self.ap_data['iSeeing'][window]
-                ):
-                    print('{:<5.0f} {:0>8} {:>6.0f}-{:<6.0f} {:<8.0f} {:<12}'
-                          ' {:<4} {:>5} {:<5}'
-                          ' {:>4.1f}'.format(int(mjd), iso[11:19], des, conf,
-                                             exp_id, exp_type,
-                                             dith, nread, detectors, see))
-                print()
-                if field in self.ap_data['dField']:
-                    for j, dome in enumerate(self.ap_data['fField']):
-                        if dome == field:
-                            print(self.ap_data['fTime'][j].iso)
-                            print(textwrap.fill('Missing fibers: {}'.format(
-                                self.ap_data['fMissing'][j]), 80))
-                            print(textwrap.fill('Faint fibers: {}'.format(
-                                self.ap_data['fFaint'][j]), 80))
-                            print(f"Average Throughput:"
-                                  f" {np.nanmean(self.ap_data['fRatio'][j]):.2f}")
-                            print()
-
-            if field in self.b_data['dField']:
-                print('# BOSS')
-                print('{:<5} {:<8} {:>6}-{:<6} {:<8} {:<7} {:<5} {:<5} {:<5}'
-                      ''.format('MJD', 'UTC', "Design", "Config", 'Exposure',
-                                'Type', 'SOS', 'ETime', 'Hart'))
-                print('-' * 80)
-                # i is an index for data, but it will disagree with b_data
-                # if there is an apogee-onlydesign
-                b_field = np.where(field == self.b_data['dField'])[0][0]
-                # window = self.get_window(self.b_data, b_design, design)
-                window = self.b_data["iField"] == field
-                for (mjd, iso, design, conf, exp_id, exp_type,
-                     detectors, etime, hart) in zip(
-                    self.b_data['iTime'][window].mjd + 0.3,
-                    self.b_data['iTime'][window].iso,
-                    self.b_data["iDesign"][window],
-                    self.b_data["iConfig"][window],
-                    self.b_data['iID'][window],
-                    self.b_data['iEType'][window],
-                    self.b_data['iDetector'][window],
-                    self.b_data['idt'][window],
-                    self.b_data['iHart'][window],
-                ):
-                    try:
-                        print('{:<5.0f} {:0>8} {:>6.0f}-{:<6.0f} {:0>8.0f} {:<7}'
-                          ' {:<5}'
-                          ' {:>5.0f} {:<5}'
-                          ''.format(int(mjd), iso[11:19], design, conf, exp_id,
-                                    exp_type.strip(), detectors, etime,
-                                    hart))
-                    except Exception as e:
-                        print(int(mjd), iso[11:19])
-                hwindow = self.b_data["hField"] == field
-                for t in self.b_data["hTime"][hwindow]:
-                    print(self.hartmann_parse(t))
-                print()
+        self.p_text('data')
 
     def p_boss(self):
-        print('=' * 80)
-        print('{:^80}'.format('BOSS Data Summary'))
-        print('=' * 80 + '\n')
-        print('{:<5} {:<8} {:<20} {:<8} {:<7} {:<5} {:<5} {:<5}'
-              ''.format('MJD', 'UTC', 'Field-Design-Config', 'Exposure', 'Type',
-                        'SOS', 'ETime', 'Hart'))
-        print('-' * 80)
-        for (mjd, iso, field, design, config, exp_id, exp_type, 
-             detectors, etime,
-             hart) in zip(self.b_data['iTime'].mjd + 0.3,
-                          self.b_data['iTime'].iso,
-                          self.b_data['iField'],
-                          self.b_data["iDesign"],
-                          self.b_data['iConfig'],
-                          self.b_data['iID'],
-                          self.b_data['iEType'],
-                          self.b_data['iDetector'],
-                          self.b_data['idt'],
-                          self.b_data['iHart']):
-            try:
-                print('{:<5.0f} {:>8} {:>6.0f}-{:>6}-{:<6.0f} {:0>8.0f} {:<7}'
-                  ' {:<5}'
-                  ' {:>5.0f} {:<5}'
-                  ''.format(int(mjd), iso[11:19], field, design, config, exp_id,
-                            exp_type.strip(), detectors, etime, hart))
-            except TypeError:
-                 continue
-        print()
+        self.p_text('boss')
 
     def p_apogee(self):
-        print('=' * 80)
-        print('{:^80}'.format('APOGEE Data Summary'))
-        print('=' * 80 + '\n')
-        print('{:<5} {:<8} {:<20} {:<8} {:<12} {:<4} {:<5} {:<5}'
-              ''.format('MJD', 'UTC', ' Field-Design-Config', 'Exposure', 'Type',
-                        'Dith', 'Reads', 'Arch'))
-        print('-' * 80)
-        if self.args.morning:
-            for (mjd, iso, field, design, config, exp_id, exp_type, dith, nread,
-                 detectors) in zip(
-                self.ap_data['iTime'].mjd[self.morning_filter] + 0.3,
-                self.ap_data['iTime'].iso[self.morning_filter],
-                self.ap_data["iField"][self.morning_filter],
-                self.ap_data["iDesign"][self.morning_filter],
-                self.ap_data["iConfig"][self.morning_filter],
-                self.ap_data['iID'][self.morning_filter],
-                self.ap_data['iEType'][self.morning_filter],
-                self.ap_data['iDither'][self.morning_filter],
-                self.ap_data['iNRead'][self.morning_filter],
-                self.ap_data['iDetector'][self.morning_filter],
-            ):
-                print('{:<5.0f} {:>8} {:>6.0f}-{:>6.0f}-{:<6.0f} {:<8.0f} {:<12} {:<4}'
-                      ' {:>5}'
-                      ' {:<5}'
-                      ''.format(int(mjd), iso[11:19], field, design, config,
-                                exp_id, exp_type,
-                                dith, nread, detectors))
-
-        else:
-            for (mjd, iso, field, design, config, exp_id, exp_type, dith, nread,
-                 detectors) in zip(
-                self.ap_data['iTime'].mjd,
-                self.ap_data['iTime'].iso,
-                self.ap_data["iField"],
-                self.ap_data["iDesign"],
-                self.ap_data["iConfig"],
-                self.ap_data['iID'], self.ap_data['iEType'],
-                self.ap_data['iDither'], self.ap_data['iNRead'],
-                self.ap_data['iDetector'],
-            ):
-                # print('{:<5.0f} {:>8} {:>2.0f}-{:<5.0f} {:<8.0f} {:<12} {:<4}'
-                #       ' {:>6}'
-                #       ' {:<8}'
-                #       ' {:>6.1f}'.format(int(mjd), iso[11:19], design, plate,
-                #                          exp_id, exp_type,
-                #                          dith, nread, detectors, see))
-                print('{:<5.0f} {:>8} {:>6.0f}-{:>6.0f}-{:<6.0f} {:<8.0f} {:<12} {:<4}'
-                      ' {:>5}'
-                      ' {:<5}'
-                      ''.format(int(mjd), iso[11:19], field, design, config,
-                                exp_id, exp_type,
-                                dith, nread, detectors))
-
-        # Usually, there are 4 ThAr and 4 UNe arcs in a night, and they're
-        # assumed to be alternating ThAr UNe ThAr UNe. When you grab every
-        # other, you'll have only one type, that's the first slicing, and the
-        # second slicing is that you only care about the diffs between two
-        # dithers taken back to back.
-        wrapper = textwrap.TextWrapper(80)
-        thar_str = 'ThAr Offsets: {}'.format(
-            ['{:.2f}'.format(f) for f in np.diff(
-                self.ap_data['aOffset'][self.ap_data['aLamp'] == 'ThAr'])])
-        print('\n'.join(wrapper.wrap(thar_str)))
-        une_str = 'UNe Offsets: {}'.format(
-            ['{:.2f}'.format(f) for f in np.diff(
-                self.ap_data['aOffset'][self.ap_data['aLamp'] == 'UNe'])])
-        print('\n'.join(wrapper.wrap(une_str)))
-        if len(self.ap_data['oOffset']) > 1:
-            # Put it under an if in case we didn't open.
-            did_move = self.ap_data["oDither"][:-
-                                               1] != self.ap_data["oDither"][1:]
-            rel_offsets = np.abs(self.ap_data['oOffset'][1:][did_move]
-                                 - self.ap_data["oOffset"][:-1][did_move])
-            obj_str = ('Object Offsets: Max: {:.2f}, Min: {:.2f}, Mean: {:.2f}'
-                       ''.format(np.nanmax(rel_offsets), np.nanmin(rel_offsets),
-                                 np.nanmean(rel_offsets)))
-            # ['{:>6.3f}'.format(f) for f in np.diff(
-            #     self.ap_data['oOffset'])])
-            print('\n'.join(wrapper.wrap(obj_str)))
-        # obj_offsets = []
-        # prev_dither = None
-        # prev_f = 0.
-        # for d, f in zip(self.ap_data['oDither'], self.ap_data['oOffset']):
-        #     if d != prev_dither:
-        #         obj_offsets.append('{:.3f}'.format(f - prev_f))
-        #     prev_dither = d
-        #     prev_f = f
-        # obj_str = 'Object Offsets: {}'.format(obj_offsets)
-        print('\n')
+        self.p_text('apogee')
 
     def log_support(self):
         print('=' * 80)
         print(f"{'Log Support':^80}")
         print('=' * 80)
-        start = Time(self.args.sjd - 0.3, format='mjd')
-        end = Time(self.args.sjd + 0.7, format='mjd')
-        end = Time.now() if Time.now() < end else end
-        sup = log_support.LogSupport(start, end, self.args)
-        sup.set_callbacks()
-        offsets = multiprocessing.Process(target=sup.get_offsets,
-                                          args=(self.support,))
-        focus = multiprocessing.Process(target=sup.get_focus,
-                                        args=(self.support,))
-        weather = multiprocessing.Process(target=sup.get_weather,
-                                          args=(self.support,))
-        if "harts" not in self.support.keys():
-            hartmann = multiprocessing.Process(target=sup.get_hartmann,
-                                               args=(self.support,))
-            hartmann.start()
-        offsets.start()
-        focus.start()
-        weather.start()
         # If these queries are timing out, you have an issue in Influx
-        offsets.join()
-        focus.join()
-        weather.join()
-        if "harts" not in self.support.keys():
-            hartmann.join()
+        try:
+            self.support.update(self.telemetry.get('hartmann'))
+        except Exception:
+            print('The hartmann query failed:', file=sys.stderr)
+            traceback.print_exc()
+        self.support.update(self.telemetry.get('log_support'))
         print(self.support["offsets"])
         print(self.support["focus"])
         print(self.support["weather"])
@@ -835,6 +677,7 @@ class Logging:
         print('{:^80}'.format('Mirror Numbers'))
         print('=' * 80 + '\n')
         try:
+            from bin import m4l
             mirror_nums = m4l.mirrors()
             print(mirror_nums)
         except (ConnectionRefusedError, TimeoutError) as me:
@@ -846,13 +689,14 @@ class Logging:
         print('{:^80}'.format('Telescope Status'))
         print('=' * 80 + '\n')
         try:
+            from bin import telescope_status
             status = telescope_status.query()
             print(status)
         except OSError as oe:
             print(f"Couldn't get telescope status:\n{oe}")
 
 
-def parse_args():
+def parse_args(argv=None):
     parser = argparse.ArgumentParser()
     parser.add_argument('--today', action='store_true', default=True,
                         help="Whether or not you want to search for today's"
@@ -876,6 +720,20 @@ def parse_args():
                         help='Print APOGEE Summary')
     parser.add_argument('-l', '--log-support', action='store_true',
                         help='Print 4 log support sections')
+    parser.add_argument('-j', '--jobs', type=int, default=4,
+                        help='Number of processes used to read image headers,'
+                             ' 1 reads them serially')
+    parser.add_argument('--cache-dir', default=exposure_cache.default_dir,
+                        type=Path,
+                        help='Directory of the per-night header cache, and'
+                             ' of InfluxDB results in influx/, default is'
+                             ' ~/.cache/sdss-obstools')
+    parser.add_argument('--no-cache', action='store_true',
+                        help='Read every image and query InfluxDB instead of'
+                             ' using the caches')
+    parser.add_argument('--rebuild-cache', action='store_true',
+                        help='Empty the header cache for this night and read'
+                             ' every image again')
     parser.add_argument('-n', '--noprogress', action='store_true',
                         help='Show no progress in processing images. WARNING:'
                              ' Might be slower, but it could go either way.')
@@ -885,26 +743,64 @@ def parse_args():
                         help='Only output apogee morning cals')
     parser.add_argument('-v', '--verbose', action='store_true',
                         help='Increased printing for debugging')
+    parser.add_argument('--follow', nargs='?', type=float, const=60.,
+                        metavar='SECONDS',
+                        help='Keep running, check for new exposures every'
+                             ' SECONDS (default 60), and reprint the summary,'
+                             ' data, and APOGEE and BOSS sections. Only new'
+                             ' exposures are read. Ctrl-C to stop')
+    parser.add_argument('-o', '--output', nargs='+', type=Path, default=[],
+                        metavar='PATH',
+                        help='Also write the night log to each PATH, in the'
+                             ' format of its extension: .txt for the printed'
+                             ' sections, or .json, .csv (exposures only), or'
+                             ' .html for every table')
+    parser.add_argument('--mjd-range', type=int, nargs=2, metavar=('A', 'B'),
+                        help='Log every night from SJD A to B (inclusive)'
+                             ' instead of one, in a pool of --range-jobs'
+                             ' processes. Each night gets its own files: the'
+                             ' -o paths, which must contain {sjd}, or'
+                             ' sloan_log_{sjd}.txt, which gets everything'
+                             ' that would be printed')
+    parser.add_argument('--range-jobs', type=int, default=4, metavar='N',
+                        help='Nights logged at once with --mjd-range, each'
+                             ' reads its images with -j / N processes')
+    parser.add_argument('--range-summary', type=Path, metavar='PATH',
+                        help='Also write a summary of every night in'
+                             ' --mjd-range to PATH, as .json, .csv, or text')
+    parser.add_argument('--profile', action='store_true',
+                        help='Time each stage and log support query, count'
+                             ' the files, bytes, and rows they read, and'
+                             ' print a report to stderr')
+    parser.add_argument('--profile-trace', type=Path, metavar='PATH',
+                        help='Also write the --profile spans to PATH as a'
+                             ' JSON trace for chrome://tracing or Perfetto')
+    parser.add_argument('--cprofile', type=Path, metavar='PATH',
+                        help='Also run cProfile and dump its stats to PATH,'
+                             ' for pstats or snakeviz. Processes that read'
+                             ' images or query InfluxDB are not included')
     parser.add_argument('--legacy-aptest', action='store_true',
                         help='Use utr_cdr images for aptest instead of'
                              ' quickred for the ap_test')
-    args = parser.parse_args()
+    args = parser.parse_args(argv)
+    if args.mjd_range:
+        if args.follow:
+            parser.error('--follow cannot be used with --mjd-range')
+        if args.mjd_range[0] > args.mjd_range[1]:
+            parser.error('--mjd-range A B needs A <= B')
+        if not args.output:
+            args.output = [Path('sloan_log_{sjd}.txt')]
+        for path in args.output:
+            if '{sjd}' not in str(path):
+                parser.error(f'-o {path} must contain {{sjd}} with'
+                             f' --mjd-range')
     return args
 
 
-def main():
-    args = parse_args()
-    if args.mjd:
-        args.sjd = args.mjd
-    elif args.today:
-        args.sjd = sjd.sjd()
-    else:
-        raise argparse.ArgumentError(args.sjd,
-                                     'Must provide -t or -m in arguments')
-    if args.verbose:
-        print(args.sjd)
-    ap_data_dir = ap_dir / '{}'.format(args.sjd)
-    b_data_dir = b_dir / '{}'.format(args.sjd)
+def find_images(sjd, noprogress=False):
+    """Finds the APOGEE and BOSS raw images of a night"""
+    ap_data_dir = ap_dir / '{}'.format(sjd)
+    b_data_dir = b_dir / '{}'.format(sjd)
     ap_images = Path(ap_data_dir).glob('apR-a*.apz')
     try:
         for img in ap_images:
@@ -921,13 +817,272 @@ def main():
         pass
     b_images = Path(b_data_dir).glob('sdR-r1*fit.gz')
 
-    if not args.noprogress:
+    if not noprogress:
         try:
             ap_images = list(ap_images)
             b_images = list(b_images)
         except OSError:  # Stale NFS handle
             ap_images = list(ap_images)
             b_images = list(b_images)
+    return ap_images, b_images
+
+
+def telemetry_sections(args):
+    """The telemetry.Telemetry sections that args prints"""
+    sections = []
+    if args.summary:
+        sections.append('dust')
+    if args.data or args.log_support:
+        sections.append('hartmann')
+    if args.log_support:
+        sections.append('log_support')
+    return sections
+
+
+def text_sections(args, p_apogee, p_boss):
+    """The night_log text sections that args prints"""
+    return [name for name, on in zip(night_log.text_sections,
+                                     (args.summary, args.data, p_apogee,
+                                      p_boss)) if on]
+
+
+def print_images(log, args, p_apogee, p_boss):
+    """Prints the sections that only depend on images, from a
+    night_log.NightLog, which is returned for write_outputs"""
+    with profiling.span('night_log'):
+        night = night_log.NightLog.from_logging(
+            log, text_sections(args, p_apogee, p_boss))
+    with profiling.span('print_images'):
+        night_log.write_text(night, sys.stdout)
+    return night
+
+
+def write_outputs(log, args, p_apogee, p_boss, night=None):
+    """Writes the night log to each path in args.output, from night, or from
+    a new night_log.NightLog of the sections that are printed. Text files get
+    the same sections that are printed"""
+    for path in getattr(args, 'output', []):
+        with profiling.span(f"write {path.suffix}") as counts:
+            if night is None:
+                night = night_log.NightLog.from_logging(
+                    log, text_sections(args, p_apogee, p_boss))
+            night.write(path)
+            if profiling.enabled():
+                counts['written'] = path.stat().st_size
+        if args.verbose:
+            print(f"Wrote {path}")
+
+
+def follow(log, args, p_apogee, p_boss):
+    """Checks for new images every args.follow seconds, and when there are
+    some, reads only those, rebuilds the tables from the records log already
+    has, and reprints the image sections"""
+    try:
+        while True:
+            time.sleep(args.follow)
+            ap_images, b_images = find_images(args.sjd)
+            new_images = set()
+            if args.apogee:
+                new_images.update(ap_images)
+            if args.boss:
+                new_images.update(b_images)
+            unread = new_images - log.read_paths
+            if len(unread) == 0:
+                continue
+            log.ap_images = ap_images
+            log.b_images = b_images
+            # Only the summary and data are reprinted. If the only unread
+            # images are incomplete ones being tried again, the telemetry
+            # waits until one of them is complete
+            sections = [name for name in telemetry_sections(args)
+                        if name != 'log_support']
+            retry = unread <= set(log.ap_incomplete)
+            if not retry:
+                log.telemetry.start(sections)
+            with profiling.span('follow.parse_images'):
+                n_updated = log.parse_images()
+            if n_updated == 0:
+                continue
+            if retry:
+                log.telemetry.start(sections)
+            with profiling.span('follow.sort'):
+                log.sort()
+                log.count_dithers()
+            print('\033[2J\033[H', end='')  # Clears the terminal
+            print(f"Updated at {time.strftime('%H:%M:%S', time.gmtime())}Z,"
+                  f" {len(log.read_paths)} images read\n")
+            night = print_images(log, args, p_apogee, p_boss)
+            write_outputs(log, args, p_apogee, p_boss, night)
+    except KeyboardInterrupt:
+        return
+
+
+def night_summary(log):
+    """A dictionary of the numbers that sum up a night that has been sorted,
+    for the --mjd-range summary"""
+    throughput = None
+    if len(log.ap_data['fRatio']) > 0:
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', RuntimeWarning)
+            throughput = float(np.nanmean(np.array(log.ap_data['fRatio'])))
+        if not np.isfinite(throughput):
+            throughput = None
+    return {'apogee': len(log.ap_table), 'boss': len(log.b_table),
+            'fields': len(log.data.get('dField', [])),
+            'dome_flats': len(log.ap_data['fRatio']),
+            'throughput': throughput}
+
+
+def log_night(sjd, args):
+    """Logs one night of --mjd-range, in a process of the range's pool.
+    Everything it would print goes to its .txt outputs, and it returns its
+    night_summary, or the error that stopped it"""
+    night_args = argparse.Namespace(**vars(args))
+    night_args.mjd = sjd
+    night_args.mjd_range = None
+    night_args.follow = None
+    night_args.noprogress = True
+    night_args.jobs = max(1, args.jobs // args.range_jobs)
+    outputs = [Path(str(path).format(sjd=sjd)) for path in args.output]
+    for path in outputs:
+        path.parent.mkdir(parents=True, exist_ok=True)
+    texts = [path for path in outputs if path.suffix.lower() == '.txt']
+    night_args.output = [path for path in outputs if path not in texts]
+    summary = {'sjd': sjd, 'apogee': 0, 'boss': 0, 'fields': 0,
+               'dome_flats': 0, 'throughput': None, 'seconds': 0.,
+               'outputs': [path.as_posix() for path in outputs],
+               'error': None}
+    t_start = time.perf_counter()
+    buffer = io.StringIO()
+    try:
+        with contextlib.redirect_stdout(buffer):
+            log = run(night_args)
+        summary.update(night_summary(log))
+    except Exception as e:
+        summary['error'] = f"{type(e).__name__}: {e}"
+        traceback.print_exc(file=buffer)
+    for path in texts:
+        path.write_text(buffer.getvalue())
+    summary['seconds'] = round(time.perf_counter() - t_start, 2)
+    return summary
+
+
+# Key, title, width, and format of each column of the --mjd-range summary
+range_columns = [('sjd', 'SJD', 6, ''), ('apogee', 'APOGEE', 6, ''),
+                 ('boss', 'BOSS', 6, ''), ('fields', 'Fields', 6, ''),
+                 ('dome_flats', 'Flats', 5, ''),
+                 ('throughput', 'Thru', 5, '.2f'),
+                 ('seconds', 'Seconds', 7, '.1f')]
+
+
+def format_range(summaries):
+    """The --mjd-range summaries as a text table, one night per line"""
+    lines = [' '.join(f"{title:>{width}}"
+                      for _, title, width, _ in range_columns) + '  Status',
+             '-' * 80]
+    for summary in summaries:
+        row = []
+        for key, _, width, fmt in range_columns:
+            value = summary[key]
+            row.append(' ' * width if value is None
+                       else f"{value:>{width}{fmt}}")
+        lines.append(' '.join(row) + '  ' + (summary['error'] or 'OK'))
+    return '\n'.join(lines)
+
+
+def write_range_summary(summaries, path):
+    """Writes the --mjd-range summaries to path, in the format of its
+    extension"""
+    path = Path(path)
+    if path.suffix.lower() == '.json':
+        path.write_text(json.dumps(summaries, indent=1))
+    elif path.suffix.lower() == '.csv':
+        with path.open('w', newline='') as fp:
+            writer = csv.DictWriter(fp, [c[0] for c in range_columns]
+                                    + ['outputs', 'error'])
+            writer.writeheader()
+            for summary in summaries:
+                writer.writerow(dict(summary,
+                                     outputs=' '.join(summary['outputs'])))
+    else:
+        path.write_text(format_range(summaries) + '\n')
+
+
+def init_night_worker():
+    """Closes the InfluxDB clients of a --mjd-range worker when the pool shuts
+    it down"""
+    import multiprocessing.util
+    from bin import influx_fetch
+    multiprocessing.util.Finalize(None, influx_fetch.close, exitpriority=10)
+
+
+def run_range(args):
+    """Logs every night of args.mjd_range in a pool of args.range_jobs
+    processes, and prints a line as each finishes and then the summary of
+    the range. Each process keeps its own InfluxDB client (see
+    influx_fetch.get_client), so nights in the same process reuse it"""
+    first, last = args.mjd_range
+    sjds = list(range(first, last + 1))
+    summaries = []
+    with profiling.span('mjd_range') as counts:
+        counts['nights'] = len(sjds)
+        workers = max(1, min(args.range_jobs, len(sjds)))
+        with concurrent.futures.ProcessPoolExecutor(
+                workers, initializer=init_night_worker) as pool:
+            futures = [pool.submit(log_night, sjd, args) for sjd in sjds]
+            for future in concurrent.futures.as_completed(futures):
+                summary = future.result()
+                summaries.append(summary)
+                if summary['error']:
+                    print(f"{summary['sjd']} failed: {summary['error']}")
+                else:
+                    print(f"{summary['sjd']} done in"
+                          f" {summary['seconds']:.1f}s, wrote"
+                          f" {', '.join(summary['outputs'])}")
+    summaries.sort(key=lambda s: s['sjd'])
+    print()
+    print(format_range(summaries))
+    if args.range_summary:
+        write_range_summary(summaries, args.range_summary)
+        if args.verbose:
+            print(f"Wrote {args.range_summary}")
+    return summaries
+
+
+def main():
+    args = parse_args()
+    if args.profile_trace or args.cprofile:
+        args.profile = True
+    if args.profile:
+        profiling.enable()
+    profiler = cProfile.Profile() if args.cprofile else None
+    if profiler is not None:
+        profiler.enable()
+    try:
+        if args.mjd_range:
+            return run_range(args)
+        return run(args)
+    finally:
+        if profiler is not None:
+            profiler.disable()
+            profiler.dump_stats(args.cprofile.as_posix())
+        if args.profile:
+            profiling.report()
+        if args.profile_trace:
+            profiling.write_trace(args.profile_trace)
+
+
+def run(args):
+    """Runs every stage that args asks for, in a span each"""
+    if args.mjd:
+        args.sjd = args.mjd
+    elif args.today:
+        args.sjd = sjd.sjd()
+    else:
+        raise argparse.ArgumentError(args.sjd,
+                                     'Must provide -t or -m in arguments')
+    if args.verbose:
+        print(args.sjd)
     p_boss = args.boss
     p_apogee = args.apogee
 
@@ -954,32 +1109,55 @@ def main():
         args.boss = True
         args.apogee = True
 
-    log = Logging(ap_images, b_images, args)
-    log.parse_images()
-    log.sort()
-    log.count_dithers()
-
-    if args.summary:
-        log.p_summary()
-
-    if args.data:
-        log.p_data()
-
-    if p_apogee:
-        log.p_apogee()
-
-    if p_boss:
-        log.p_boss()
+    # Query results are cached with the exposure records
+    from bin import influx_fetch
+    if args.no_cache or not args.cache_dir:
+        influx_fetch.result_cache = None
+    else:
+        influx_fetch.result_cache = query_cache.QueryCache(
+            Path(args.cache_dir) / 'influx')
+
+    # The telemetry queries run while the images are found and read
+    night_telemetry = telemetry.Telemetry(args)
+    night_telemetry.start(telemetry_sections(args))
+    with profiling.span('find_images') as counts:
+        ap_images, b_images = find_images(args.sjd, args.noprogress)
+        if profiling.enabled():
+            ap_images, b_images = list(ap_images), list(b_images)
+            counts['images'] = len(ap_images) + len(b_images)
+
+    with profiling.span('init'):
+        log = Logging(ap_images, b_images, args, night_telemetry)
+    with profiling.span('parse_images'):
+        log.parse_images()
+    with profiling.span('sort') as counts:
+        log.sort()
+        counts['exposures'] = len(log.ap_table) + len(log.b_table)
+        counts['fields'] = len(log.data['dField'])
+    with profiling.span('count_dithers'):
+        log.count_dithers()
+
+    print_images(log, args, p_apogee, p_boss)
 
     if args.log_support:
-        log.log_support()
+        with profiling.span('log_support'):
+            log.log_support()
 
     if args.mirrors:
         # pass
-        log.mirror_numbers()
+        with profiling.span('mirror_numbers'):
+            log.mirror_numbers()
 
     if args.telstatus:
-        log.tel_status()
+        with profiling.span('tel_status'):
+            log.tel_status()
+
+    # A new NightLog, with the notes of log_support
+    write_outputs(log, args, p_apogee, p_boss)
+
+    if args.follow:
+        follow(log, args, p_apogee, p_boss)
+    night_telemetry.close()
     return log
 
 
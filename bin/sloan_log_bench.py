@@ -0,0 +1,155 @@
+#!/usr/bin/env python3
+"""sloan_log_bench.py
+
+Times each stage of sloan_log.py on synthetic nights, so that changes to it
+ can be measured without /data. Nights are written with
+ sdssobstools/synthetic_night.py into a temporary directory (or --dir) that is
+ used as SDSS_DATA, and each stage reports its wall time and the cumulative
+ peak resident memory after it, the largest of this process and of the pool
+ workers that have finished, since the start of the run. It is not the memory
+ of that stage alone. p_summary and p_data query InfluxDB, so they are only
+ timed with --telemetry.
+
+    sloan_log_bench.py -n 100 1000 10000 -j 4
+"""
+import argparse
+import contextlib
+import io
+import os
+import resource
+import sys
+import tempfile
+import time
+
+from pathlib import Path
+
+from sdssobstools import synthetic_night
+
+__version__ = '3.0.0'
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description='Times the stages of sloan_log.py on fake nights')
+    parser.add_argument('-n', '--exposures', type=int, nargs='+',
+                        default=[100, 1000],
+                        help='Sizes of the nights to time, in exposures of'
+                             ' each instrument, default 100 1000')
+    parser.add_argument('-j', '--jobs', type=int, default=4,
+                        help='Processes used to read images, as in'
+                             ' sloan_log.py')
+    parser.add_argument('-m', '--mjd', type=int, default=59730,
+                        help='SJD of the first night, each size gets its own'
+                             ' SJD after it')
+    parser.add_argument('--dir', type=Path,
+                        help='Write the nights here and keep them, instead'
+                             ' of a temporary directory. Existing nights are'
+                             ' reused if they have the same number of'
+                             ' exposures')
+    parser.add_argument('--cache', action='store_true',
+                        help="Use sloan_log's exposure cache, the default is"
+                             " to read every image")
+    parser.add_argument('--telemetry', action='store_true',
+                        help='Also time p_summary and p_data, which need'
+                             ' InfluxDB')
+    return parser.parse_args()
+
+
+def peak_memory_mb():
+    """The cumulative peak resident memory in MB of this process and of its
+    children that have finished, like the pool workers of -j"""
+    peak = max(resource.getrusage(who).ru_maxrss
+               for who in (resource.RUSAGE_SELF, resource.RUSAGE_CHILDREN))
+    # Linux reports KB, macOS bytes
+    return peak / 2 ** 20 if sys.platform == 'darwin' else peak / 2 ** 10
+
+
+def night_size(root, sjd):
+    """The number of APOGEE exposures of a night already in root, or None if
+    there isn't one"""
+    archive = root / f"apogee/archive/{sjd}"
+    if not archive.exists():
+        return None
+    return len(list(archive.glob('apR-a-*.apz')))
+
+
+def bench_night(sloan_log, night_log, sjd, args):
+    """Runs sloan_log on one night and returns a list of (stage, seconds,
+    cumulative peak MB)"""
+    argv = ['-m', str(sjd), '-a', '-b', '-j', str(args.jobs),
+            '--cache-dir', str(args.cache_dir)]
+    if not args.cache:
+        argv.append('--no-cache')
+    log_args = sloan_log.parse_args(argv)
+    log_args.sjd = sjd
+    state = {}
+
+    def make_log():
+        state['log'] = sloan_log.Logging(*state['images'], log_args)
+
+    def write_night_log():
+        night = night_log.NightLog.from_logging(state['log'])
+        for emitter in night_log.emitters.values():
+            emitter(night, io.StringIO())
+
+    stages = [('find_images',
+               lambda: state.update(images=sloan_log.find_images(sjd))),
+              ('init', make_log),
+              ('parse_images', lambda: state['log'].parse_images()),
+              ('sort', lambda: state['log'].sort()),
+              ('count_dithers', lambda: state['log'].count_dithers())]
+    if args.telemetry:
+        stages += [('p_summary', lambda: state['log'].p_summary()),
+                   ('p_data', lambda: state['log'].p_data())]
+    stages += [('p_apogee', lambda: state['log'].p_apogee()),
+               ('p_boss', lambda: state['log'].p_boss()),
+               ('night_log', write_night_log)]
+    results = []
+    for name, stage in stages:
+        t_start = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()):
+            stage()
+        results.append((name, time.perf_counter() - t_start,
+                        peak_memory_mb()))
+    return results
+
+
+def main():
+    args = parse_args()
+    with contextlib.ExitStack() as stack:
+        if args.dir is None:
+            root = Path(stack.enter_context(tempfile.TemporaryDirectory()))
+        else:
+            root = args.dir
+        args.cache_dir = root / 'cache'
+        nights = []
+        for i, n in enumerate(args.exposures):
+            sjd = args.mjd + i
+            size = night_size(root, sjd)
+            if size is None:
+                print(f"Writing {n} exposures for {sjd} in {root}")
+                synthetic_night.write_night(root, sjd, n)
+            elif size != n:
+                sys.exit(f"{root} already has a night of {size} exposures"
+                         f" for {sjd}, use another --dir or -m/--mjd")
+            nights.append((n, sjd))
+
+        # sdss_paths is read when sloan_log is imported
+        os.environ['SDSS_DATA'] = root.as_posix()
+        from bin import sloan_log
+        from sdssobstools import night_log
+
+        print(f"{'Exposures':>9} {'Stage':<14} {'Seconds':>8}"
+              f" {'Cumulative peak MB':>18}")
+        print('-' * 52)
+        for n, sjd in nights:
+            total = 0
+            for name, seconds, peak in bench_night(sloan_log, night_log, sjd,
+                                                   args):
+                total += seconds
+                print(f"{n:>9} {name:<14} {seconds:>8.3f} {peak:>18.1f}")
+            print(f"{n:>9} {'total':<14} {total:>8.3f}")
+
+
+if __name__ == '__main__':
+    main()
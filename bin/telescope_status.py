@@ -1,11 +1,10 @@
 #!/usr/bin/env python3
 import numpy as np
 from pathlib import Path
-from astropy.time import Time
 import multiprocessing
 
 from bin import sjd, influx_fetch
-from sdssobstools import sdss_paths
+from sdssobstools import query_plan, sdss_paths
 
 try:
     import tpmdata
@@ -22,37 +21,40 @@ def get_tpm_packet(out_dict):
         out_dict[key] = val
     return 0
 
-def get_enclosure_state(t_start, t_end, out_dict):
-    enclosure_path = Path(
-        sdss_paths.__file__).parent.parent / "flux/enclosure.flux"
-    with enclosure_path.open('r') as fil:
-        state = influx_fetch.query(fil.read(), t_start, t_end, interval="5m")[0]
+def flux_request(query_name, t_start, t_end, interval):
+    """The query_plan.Request of flux/query_name"""
+    q_path = Path(sdss_paths.__file__).parent.parent / "flux" / query_name
+    with q_path.open('r') as fil:
+        return query_plan.Request(fil.read(), t_start, t_end, interval)
+
+
+def get_enclosure_state(t_start, t_end, out_dict, arrays=None):
+    if arrays is None:
+        arrays = influx_fetch.query_arrays(
+            *flux_request("enclosure.flux", t_start, t_end, "5m")[:4])
     enclosure_hist = ""
     last_state = 0
-    for row in state.records:
-        if row.get_value() > last_state:
-            last_state = row.get_value()
-            t = Time(row.get_time())
-            enclosure_hist += f"Opened at {t.isot[11:19]}\n"
-        elif row.get_value() < last_state:
-            last_state = row.get_value()
-            t = Time(row.get_time())
-            enclosure_hist += f"Closed at {t.isot[11:19]}\n"
+    if len(arrays) != 0:
+        # Only the first field is used
+        times, states = next(iter(arrays.values()))
+        for t, state in zip(influx_fetch.to_time(times), states):
+            if state > last_state:
+                last_state = state
+                enclosure_hist += f"Opened at {t.isot[11:19]}\n"
+            elif state < last_state:
+                last_state = state
+                enclosure_hist += f"Closed at {t.isot[11:19]}\n"
     if enclosure_hist == "":
         enclosure_hist = "Closed all night\n"
     out_dict["enclosure_hist"] = enclosure_hist
 
-def get_chiller_state(t_start, t_end, out_dict):
-    chiller_path = Path(
-        sdss_paths.__file__).parent.parent / "flux/chiller_status.flux"
-    with chiller_path.open('r') as fil:
-        table = influx_fetch.query(fil.read(), t_start, t_end, interval="1m")
+def get_chiller_state(t_start, t_end, out_dict, arrays=None):
+    if arrays is None:
+        arrays = influx_fetch.query_arrays(
+            *flux_request("chiller_status.flux", t_start, t_end, "1m")[:4])
     
-    chiller_vals = {}
-    for col in table:
-        for row in col.records:
-            if row.get_field() not in chiller_vals.keys():
-                chiller_vals[row.get_field()] = row.get_value()
+    chiller_vals = {field: values[0] for field, (_, values) in arrays.items()
+                    if len(values) != 0}
     # print(chiller_vals)
     for k in ["FLOW1", "FLOW2", "STATUS_FLUID_FLOW", "FLOW_USER_SETPOINT",
               "DISPLAY_VALUE"]:
@@ -80,6 +82,7 @@ def get_chiller_state(t_start, t_end, out_dict):
         
 
 def query():
+    from astropy.time import Time
     t_start = Time(sjd.sjd() - 0.3, format="mjd")
     t_end = Time.now()
     
@@ -87,28 +90,27 @@ def query():
         raise ConnectionError("Cannot query the tpm without tpmdata installed")
 
     data = multiprocessing.Manager().dict()
-    encl_thread = multiprocessing.Process(target=get_enclosure_state,
-                                          args=(t_start, t_end, data))
-    chiller_thread = multiprocessing.Process(target=get_chiller_state,
-                                             args=(t_end - 15 / 60 / 24, t_end,
-                                                   data))
     tpm_thread = multiprocessing.Process(target=get_tpm_packet, args=(data,))
-    encl_thread.start()
-    chiller_thread.start()
     tpm_thread.start()
+    results, errors = influx_fetch.gather_queries(
+        {"enclosure": flux_request("enclosure.flux", t_start, t_end, "5m"),
+         "chiller": flux_request("chiller_status.flux",
+                                 t_end - 15 / 60 / 24, t_end, "1m")},
+        deadline=5)
     
     tpm_thread.join(2)
-    chiller_thread.join(5)
-    encl_thread.join(2)
     if tpm_thread.is_alive():
         tpm_thread.kill()
         raise ConnectionError("Could not reach TPM")
-    if chiller_thread.is_alive():
-        chiller_thread.kill()
-        raise ConnectionError("Chiller query timeout")
-    if encl_thread.is_alive():
-        encl_thread.kill()
-        raise ConnectionError("Enclosure query timeout")
+    if "chiller" in errors:
+        raise ConnectionError(f"Chiller query failed: {errors['chiller']!r}")
+    if "enclosure" in errors:
+        raise ConnectionError(
+            f"Enclosure query failed: {errors['enclosure']!r}")
+    data = dict(data)
+    get_enclosure_state(t_start, t_end, data, arrays=results["enclosure"])
+    get_chiller_state(t_end - 15 / 60 / 24, t_end, data,
+                      arrays=results["chiller"])
 
     # print(data.keys())    
     t = Time(data["ctime"], format="unix")
@@ -6,39 +6,37 @@ import sys
 import click
 
 import numpy as np
-import multiprocessing as mp
 
-from astropy.time import Time, TimeDelta
 from pathlib import Path
 
-from bin import sjd, influx_fetch
-from sdssobstools import sdss_paths
+from bin import influx_fetch
+from sdssobstools import query_plan, sdss_paths
 
 
-def get_from_influx(name: str, query_name: str, influx_times,
-                    out_dict: dict = {},
-                    verbose=0):
+def query_request(query_name: str, influx_times):
+    """The query_plan.Request of flux/query_name over influx_times"""
     q_path = Path(sdss_paths.__file__).parent.parent / "flux" / query_name
     if not q_path.exists():
         raise FileNotFoundError(
             f"Couldn't find Flux query {q_path.absolute()}")
     with q_path.open('r') as fil:
-        q_query = fil.read()
+        return query_plan.Request(fil.read(), influx_times.min(),
+                                  influx_times.max())
+
 
-    results = influx_fetch.query(q_query, influx_times.min(),
-                                 influx_times.max(), verbose=verbose - 1)
-    influx_times = []
-    values = []
+def get_from_influx(name: str, query_name: str, influx_times,
+                    out_dict: dict = {},
+                    verbose=0, results=None):
+    from astropy.time import Time
+    if results is None:
+        request = query_request(query_name, influx_times)
+        results = influx_fetch.query_arrays(request.flux_script,
+                                            request.start, request.end,
+                                            verbose=verbose - 1)
     if len(results) != 0:
-        for row in results[0].records:
-            v = row.get_value()
-            # if len(values) >= 1:
-                # if v == values[-1]:
-                    # continue
-            values.append(row.get_value())
-            influx_times.append(row.get_time())
-        influx_times = Time(influx_times)
-        values = np.array(values)
+        # Only the first field is used
+        influx_times, values = next(iter(results.values()))
+        influx_times = influx_fetch.to_time(influx_times)
         sorter = influx_times.argsort()
         influx_times = influx_times[sorter]
         values = values[sorter]
@@ -57,6 +55,7 @@ def get_from_influx(name: str, query_name: str, influx_times,
 # @click.option("-v", "--verbose", count=True,
 #               help="Verbose debugging, can be used multiple times")
 def gen_summary(times, bright_first, no_enclosure, verbose):
+    from astropy.time import Time, TimeDelta
     times = list(times)
     if bright_first:
         k_times = times[2:] + times[0:2]
@@ -76,18 +75,19 @@ def gen_summary(times, bright_first, no_enclosure, verbose):
     if verbose >= 1:
         print(f"Start: {k_times.min().iso}, End: {k_times.max().iso}")
 
-    influx_vals = mp.Manager().dict()
+    queries = {"Enclosure": "enclosure.flux",
+               "Science": "science_exposures.flux"}
     tstart = Time.now()
-    encl_p = mp.Process(target=get_from_influx,
-                        args=("Enclosure", "enclosure.flux", k_times, influx_vals,
-                              verbose - 1))
-    sci_p = mp.Process(target=get_from_influx,
-                       args=("Science", "science_exposures.flux", k_times,
-                             influx_vals, verbose - 1))
-    encl_p.start()
-    sci_p.start()
-    encl_p.join(5)
-    sci_p.join(5)
+    results, errors = influx_fetch.gather_queries(
+        {name: query_request(query_name, k_times)
+         for name, query_name in queries.items()},
+        deadline=5, verbose=verbose - 2)
+    influx_fetch.report(errors)
+    influx_vals = {}
+    for name, query_name in queries.items():
+        # A query that didn't finish counts as empty
+        get_from_influx(name, query_name, k_times, influx_vals, verbose - 1,
+                        results=results.get(name, {}))
     tend = Time.now()
     if verbose >= 1:
         print(f"Influx queries took {(tend - tstart).sec:.1f}s")
@@ -221,6 +221,7 @@ if __name__ == "__main__":
     # the inputs to something more parsible before it's read by click.
     # I tried a constant date, but that means Influx queries a large time 
     # range, so using now seems to cover the bases.
+    from astropy.time import Time
     for i, arg in enumerate(sys.argv):
         if arg == "--":
             sys.argv[i] = (Time.now() + 0.2).iso
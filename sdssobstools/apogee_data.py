@@ -1,9 +1,8 @@
 #!/usr/bin/env python
-import time
 import argparse
+import concurrent.futures
+import functools
 from pathlib import Path
-from astropy.time import Time
-from scipy.optimize import leastsq
 import fitsio
 import numpy as np
 import textwrap
@@ -11,6 +10,226 @@ from . import sdss_paths
 
 __version__ = '3.2.2'
 
+dat_dir = Path(__file__).absolute().parent.parent / "dat"
+if not (dat_dir / "master_dome_flat.fits.gz").exists():
+    dat_dir = Path(__file__).absolute().parent.parent.parent / "dat"
+master_flat_path = dat_dir / "master_dome_flat.fits.gz"
+# The median of the columns 550:910 of the master flat, saved with
+# np.save(master_col_path, master_dome_flat_col(from_fits=True))
+master_col_path = dat_dir / "master_dome_flat_col.npy"
+# Fibers 1-30 are the first bundle, 31-60 the second, and so on
+bundle_size = 30
+
+
+@functools.lru_cache()
+def master_dome_flat_col(ws=(550, 910), from_fits=False):
+    """Returns the median of the master dome flat over the columns
+    ws[0]:ws[1], the master_col that APOGEERaw.ap_test compares to. The
+    default window is read from a small .npy instead of decompressing the
+    master flat, and any result is kept for the next call."""
+    if (tuple(ws) == (550, 910)) and not from_fits and master_col_path.exists():
+        return np.load(master_col_path)
+    master_data = fitsio.read(master_flat_path.as_posix())
+    return np.median(master_data[:, ws[0]:ws[1]], axis=1)
+
+
+def read_quickred(path, rows=slice(None), cols=slice(None)):
+    """Reads only rows and cols (slices) of a quickred image. An apq .fits
+    file keeps the image as the first cell of a table in ext 3, so a fixed
+    size 2D cell is memory-mapped and only the pages under the window are
+    read. Any other cell, like a variable length array in the
+    heap, is read whole by fitsio. An ap1D .fits.fz file is tile compressed,
+    and fitsio only decompresses the tiles the window touches."""
+    path = Path(path)
+    with fitsio.FITS(path.as_posix()) as fits:
+        if path.name.endswith('.fz'):
+            hdu = fits[1]
+            n_rows, n_cols = hdu.get_dims()
+            rows = range(n_rows)[rows]
+            cols = range(n_cols)[cols]
+            if (len(rows) == 0) or (len(cols) == 0):
+                return np.zeros((len(rows), len(cols)), dtype='f4')
+            return hdu[rows.start:rows.stop, cols.start:cols.stop]
+        hdu = fits[3]
+        dtype, _, isvar = hdu.get_rec_dtype()
+        cell, offset = dtype.fields[dtype.names[0]][:2]
+        if isvar[0] or (len(cell.shape) != 2):
+            image = hdu.read_column(dtype.names[0], rows=[0])[0]
+            if image.ndim == 1:
+                # fitsio doesn't shape a variable length array by its TDIM
+                dims = hdu.read_header()['TDIM1'].strip('() ').split(',')
+                image = image.reshape([int(d) for d in reversed(dims)])
+            return np.array(image[rows, cols])
+        offset += hdu.get_offsets()['data_start']
+    image = np.memmap(path, dtype=cell.base, mode='r', offset=offset,
+                      shape=cell.shape)
+    return np.array(image[rows, cols])
+
+
+def format_runs(starts, ends):
+    """A list of a string like '1 - 3' for each run of mask_runs, or an int
+    for a lone fiber"""
+    return [start if start == end else '{} - {}'.format(start, end)
+            for start, end in zip(np.asarray(starts).tolist(),
+                                  np.asarray(ends).tolist())]
+
+
+def classify_fibers(flux_ratio):
+    """The runs of missing (throughput below 0.2) and faint (0.2 to 0.7)
+    fibers of a dome flat's flux ratio to the master flat, fiber 1 first, as
+    two (starts, ends) pairs from mask_runs"""
+    flux_ratio = np.asarray(flux_ratio, dtype=float)
+    missing = flux_ratio < 0.2
+    faint = (flux_ratio < 0.7) & (0.2 <= flux_ratio)
+    return mask_runs(missing)[1:], mask_runs(faint)[1:]
+
+
+def mask_runs(mask):
+    """Run-length encodes the True fibers of each row of a (flats x fibers)
+    mask, or of a 1D mask, into runs of consecutive fibers split at bundle
+    boundaries, and returns the row, first fiber, and last fiber (starting
+    at 1) of each run as int arrays, in order.
+
+    Ex: fibers [1, 2, 3, 5, 29, 30, 31] -> rows [0, 0, 0, 0],
+        firsts [1, 5, 29, 31], lasts [3, 5, 30, 31]
+    """
+    mask = np.atleast_2d(np.asarray(mask, dtype=bool))
+    true = np.flatnonzero(mask)
+    if len(true) == 0:
+        return tuple(np.zeros(0, dtype=int) for _ in range(3))
+    rows, fibers = np.divmod(true, mask.shape[1])
+    fibers += 1
+    # A run ends at a gap, at the end of a bundle, and at the end of a row,
+    # where the next fiber is 1
+    breaks = (np.diff(true) != 1) | ((fibers[1:] - 1) % bundle_size == 0)
+    firsts = np.concatenate(([0], np.flatnonzero(breaks) + 1))
+    lasts = np.concatenate((firsts[1:] - 1, [len(true) - 1]))
+    return rows[firsts], fibers[firsts], fibers[lasts]
+
+
+def dome_flat_results(columns, master_col):
+    """Compares the median columns of many dome flats (flats x fibers, as
+    read from the quickred) to master_col all at once, and classifies every
+    fiber of every flat. Returns a dictionary of flux_ratio (flats x fibers,
+    fiber 1 first), n_missing and n_faint arrays, and missing and faint lists
+    with a format_runs list for each flat"""
+    columns = np.atleast_2d(np.asarray(columns, dtype=float))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        flux_ratio = np.flip(columns / master_col, axis=1)
+    flux_ratio[~np.isfinite(flux_ratio)] = np.nan
+    results = {'flux_ratio': flux_ratio}
+    for key, mask in (('missing', flux_ratio < 0.2),
+                      ('faint', (flux_ratio < 0.7) & (0.2 <= flux_ratio))):
+        rows, starts, ends = mask_runs(mask)
+        splits = np.searchsorted(rows, np.arange(1, len(flux_ratio)))
+        results[key] = [format_runs(row_starts, row_ends)
+                        for row_starts, row_ends in zip(
+                            np.split(starts, splits), np.split(ends, splits))]
+        results[f"n_{key}"] = np.sum(mask, axis=1)
+    return results
+
+
+def read_flat_slabs(paths, ws=(550, 910), jobs=4):
+    """Reads the columns ws[0]:ws[1] of the quickred of every dome flat in
+    paths, in jobs threads, into one (flats x fibers x columns) array. A path
+    of None gives NaNs"""
+    def read(path):
+        if path is None:
+            return None
+        return read_quickred(path, slice(None), slice(ws[0], ws[1]))
+
+    with concurrent.futures.ThreadPoolExecutor(max(jobs, 1)) as pool:
+        slabs = list(pool.map(read, paths))
+    shape = next((slab.shape for slab in slabs if slab is not None),
+                 (300, ws[1] - ws[0]))
+    out = np.full((len(slabs),) + shape, np.nan, dtype='f4')
+    for i, slab in enumerate(slabs):
+        if slab is not None:
+            out[i] = slab
+    return out
+
+
+def plot_flux_ratio(flux_ratio, exp_id):
+    """Plots the throughput of every fiber of a dome flat, colored by whether
+    it's missing, faint, or bright"""
+    import matplotlib.pyplot as plt
+    missing = flux_ratio < 0.2
+    faint = (flux_ratio < 0.7) & (0.2 <= flux_ratio)
+    bright = ~missing & ~faint
+    fig = plt.figure(figsize=(9, 4))
+    ax = fig.gca()
+    x = np.arange(len(flux_ratio)) + 1
+    ax.plot(x[bright], flux_ratio[bright], 'o', c=(0, 0.6, 0.533))
+    ax.plot(x[faint], flux_ratio[faint], 'o', c=(0.933, 0.466, 0.2))
+    ax.plot(x[missing], flux_ratio[missing], 'o', c=(0.8, 0.2, 0.066))
+    ax.set_xlabel('Fiber ID')
+    ax.set_ylabel('Throughput Efficiency')
+    ax.axis([1, 300, -0.2, 1.35])
+    ax.grid(True)
+    ax.axhline(0.7, c=(0, 0.6, 0.533))
+    ax.axhline(0.2, c=(0.933, 0.466, 0.2))
+    ax.set_title('APOGEE Fiber Relative Intensity {}'.format(exp_id), size=15)
+    plt.show()
+
+
+def fit_line_centers(lines, x, w0, sigma, n_iter=50, tol=1e-8):
+    """Fits the center of a line in each row of lines (N exposures by a window
+    of pixels x) at once. Like compute_offset used to with leastsq, it
+    minimizes sum((exp(-0.5 * ((x - w) / sigma) ** 2) - line) ** 2) over w,
+    starting from w0, but the rows take their Newton steps together until
+    each one moves less than tol. A step that doesn't lower a row's cost is
+    halved until it does, which keeps the fit in the same minimum that
+    leastsq finds. Rows with NaNs give NaN.
+    """
+    lines = np.atleast_2d(np.asarray(lines, dtype=float))
+    x = np.broadcast_to(np.asarray(x, dtype=float), lines.shape)
+    good = np.all(np.isfinite(lines), axis=1) & (lines.shape[1] > 0)
+    w = np.full(len(lines), float(w0))
+
+    def cost(rows, w):
+        model = np.exp(-0.5 * ((x[rows] - w[:, None]) / sigma) ** 2)
+        return np.sum((model - lines[rows]) ** 2, axis=1)
+
+    rows = np.flatnonzero(good)
+    f = np.zeros(len(lines))
+    f[rows] = cost(rows, w[rows])
+    for _ in range(n_iter):
+        if len(rows) == 0:
+            break
+        u = (x[rows] - w[rows, None]) / sigma
+        model = np.exp(-0.5 * u ** 2)
+        resid = model - lines[rows]
+        jac = model * u / sigma
+        grad = np.sum(resid * jac, axis=1)
+        hess = np.sum(jac ** 2 + resid * model * (u ** 2 - 1) / sigma ** 2,
+                      axis=1)
+        # Downhill by sigma where the cost isn't convex
+        newton = hess > 0
+        step = np.where(newton, -grad / np.where(newton, hess, 1),
+                        -np.sign(grad) * sigma)
+        step = np.clip(step, -sigma, sigma)
+        f_new = cost(rows, w[rows] + step)
+        worse = (f_new > f[rows]) & (np.abs(step) >= tol)
+        while worse.any():
+            step[worse] /= 2
+            f_new[worse] = cost(rows[worse], w[rows[worse]] + step[worse])
+            worse[worse] = ((f_new[worse] > f[rows[worse]])
+                            & (np.abs(step[worse]) >= tol))
+        better = f_new <= f[rows]
+        w[rows[better]] += step[better]
+        f[rows[better]] = f_new[better]
+        rows = rows[np.abs(step) >= tol]
+    return np.where(good, w, np.nan)
+
+
+def check_offset(exp_id, diff, w0):
+    """Warns about an offset that's too large to be a dither"""
+    if np.abs(diff) > 10:
+        print('A large dither was reported for exposure {}: {:.3f}'
+              '\n  This may mean the zero point needs to be'
+              ' adjusted, currently it is {}'
+              ''.format(exp_id, diff, w0))
+
 
 class APOGEERaw:
     """A class to parse raw data from APOGEE. The purpose of this class is to
@@ -42,7 +261,7 @@ class APOGEERaw:
         else:
             self.dither = '{:.1f}'.format(header['DITHPIX'])
         self.exp_time = header['EXPTIME']
-        self.isot = Time(header['DATE-OBS'])  # Local
+        self.date_obs = header['DATE-OBS']
         if "FIELDID" in header.keys():
             if header["FIELDID"] == "":
                 self.field_id = 0
@@ -97,7 +316,56 @@ class APOGEERaw:
         self.utr_file = ''
         self.utr_data = np.array([[]])
 
-    # noinspection PyTupleAssignmentBalance,PyTypeChecker
+    @property
+    def isot(self):
+        """An astropy Time of DATE-OBS, only made when it is used because
+        creating one for every image is slow"""
+        from astropy.time import Time
+        return Time(self.date_obs)  # Local
+
+    def quickred_path(self):
+        """The apq file of this exposure, or the ap1D file if there is no
+        apq. None if neither exists"""
+        if not sdss_paths.exists(self.quickred_file):
+            self.quickred_file = (sdss_paths.ap_qr
+                                  / 'quickred/{}/ap1D-a-{}.fits.fz'
+                                    ''.format(self.mjd, self.exp_id))
+            if not sdss_paths.exists(self.quickred_file):
+                print(f"Offsets for {self.file.name} could not be read")
+                return None
+        return self.quickred_file
+
+    def quickred_window(self, rows, cols):
+        """Rows and cols (slices) of the quickred image, from quickred_data if
+        it was already read, otherwise from quickred_path. None if there is
+        no quickred file"""
+        if self.quickred_data.size != 0:
+            return self.quickred_data[rows, cols]
+        path = self.quickred_path()
+        if path is None:
+            return None
+        return read_quickred(path, rows, cols)
+
+    def line_profile(self, fibers=(60, 70), w0=1105, dw=40):
+        """The average of fibers over the pixels from w0-dw/2 to w0+dw/2,
+        returned as (pixels, line), or None if it can't be read"""
+        w0 = int(w0)
+        dw = int(dw)
+        lower = w0 - dw // 2
+        upper = w0 + dw // 2
+        # Only the fibers and pixels around the line are read
+        window = self.quickred_window(slice(fibers[0], fibers[1]),
+                                      slice(lower, upper))
+        if window is None:
+            return None
+        try:
+            line = np.average(window, axis=0)
+        except ZeroDivisionError:
+            print(f"Couldn't find dither offsets of image {self.file} with"
+                  f" window shape {window.shape}")
+            return None
+        return np.arange(lower, lower + window.shape[1]), line
+
     def compute_offset(self, fibers=(60, 70), w0: int=1105, dw:int=40, sigma:float=1.2745):
         """This is based off of apogeeThar.OneFileFitting written by Elena. It
         is supposed to generate a float for the pixel offsets of an APOGEE
@@ -105,9 +373,9 @@ class APOGEERaw:
         It opens a quickred file, which is of shape n_fiber*n_dispersion_pixels,
         and then it averages the fibers inside the fibers tuple. It then based
         off of the provided w0 (mean) and sigma, it creates a gaussian function
-        and then creates a function called err_func that compares the gaussian
-        with a slice of the data, from w0-dw/2 to w0+dw/2. It then uses scipy's
-        least squared equation solver to find the difference between w0 given as
+        and fits its center to a slice of the data, from w0-dw/2 to w0+dw/2,
+        by least squares (see fit_line_centers, which can fit many exposures
+        at once) to find the difference between w0 given as
         an input and the actual w0 of the spectral line. This only works if you
         pick a prominent line to go off of. The default parameters are given for
         ThAr lines, but UNe lines could also be used, with the following inputs:
@@ -116,48 +384,12 @@ class APOGEERaw:
         dw: 20
         sigma: 3
         """
-        w0 = int(w0)
-        dw = int(dw)
-        if self.quickred_data.size == 0:
-            try:
-                self.quickred_file.exists()
-            except OSError:
-                pass
-            if self.quickred_file.exists():
-                self.quickred_data = fitsio.read(self.quickred_file, 3)[0][0]
-            else:
-                self.quickred_file = (sdss_paths.ap_qr
-                                      / 'quickred/{}/ap1D-a-{}.fits.fz'
-                                        ''.format(self.mjd, self.exp_id))
-                if not self.quickred_file.exists():
-                    print(f"Offsets for {self.file.name} could not be read")
-                    return np.nan
-                self.quickred_data = fitsio.read(self.quickred_file, 1)
-        lower = w0 - dw // 2
-        upper = w0 + dw // 2
-        line_inds = np.arange(self.quickred_data.shape[1])[lower:upper]
-        try:
-            line = np.average(self.quickred_data[fibers[0]:fibers[1], lower:upper],
-                          axis=0)
-        except ZeroDivisionError:
-            print(f"Couldn't find dither offsets of image {self.file} with"
-                  f" shape {self.quickred_data.shape}")
+        profile = self.line_profile(fibers, w0, dw)
+        if profile is None:
             return np.nan
-
-        def fit_func(w, x):
-            return np.exp(-0.5 * ((x - w) / sigma) ** 2)
-
-        def err_func(w, x, y):
-            return fit_func(w, x) - y
-
-        w_model, success = leastsq(err_func, w0, args=(line_inds, line))
-
-        diff = w_model[0] - w0
-        if np.abs(diff) > 10:
-            print('A large dither was reported for exposure {}: {:.3f}'
-                  '\n  This may mean the zero point needs to be'
-                  ' adjusted, currently it is {}'
-                  ''.format(self.exp_id, diff, w0))
+        line_inds, line = profile
+        diff = fit_line_centers(line, line_inds, int(w0), sigma)[0] - int(w0)
+        check_offset(self.exp_id, diff, int(w0))
         return diff
 
     def ap_test(self, ws=(550, 910), master_col=None, plot=False,
@@ -165,31 +397,15 @@ class APOGEERaw:
         if master_col is None:
             raise ValueError("APTest didn't receive a valid master_col: {}"
                              "".format(master_col))
-        if self.quickred_data.size == 0:
-            if self.quickred_file.exists():
-                self.quickred_data = fitsio.read(self.quickred_file, 3)[0][0]
-            else:
-                self.quickred_file = (sdss_paths.ap_qr
-                                      / 'quickred/{}/ap1D-a-{}.fits.fz'
-                                        ''.format(self.mjd, self.exp_id))
-                if not self.quickred_file.exists():
-                    print(f"Offsets for {self.file.name} could not be read")
-                    return [], [], np.nan
-                self.quickred_data = fitsio.read(self.quickred_file, 1)
-        slc = np.median(self.quickred_data[:, ws[0]:ws[1]], axis=1)
-        flux_ratio = np.flipud(slc / master_col)
-        bad_data = ((flux_ratio == np.inf)
-                    | (flux_ratio == -np.inf)
-                    | np.isnan(flux_ratio))
-        flux_ratio[bad_data] = np.nan
-        missing = flux_ratio < 0.2
-        faint = (flux_ratio < 0.7) & (0.2 <= flux_ratio)
-        bright = ~missing & ~faint
-        i_missing = np.where(missing)[0].astype(int) + 1
-        i_faint = np.where(faint)[0].astype(int) + 1
-        i_bright = np.where(bright)[0].astype(int) + 1
-        missing_bundles = self.create_bundles(i_missing)
-        faint_bundles = self.create_bundles(i_faint)
+        window = self.quickred_window(slice(None), slice(ws[0], ws[1]))
+        if window is None:
+            return [], [], np.nan
+        slc = np.median(window, axis=1)
+        # A batch of one, see dome_flat_results for a night of them
+        results = dome_flat_results(slc, master_col)
+        flux_ratio = results['flux_ratio'][0]
+        missing_bundles = results['missing'][0]
+        faint_bundles = results['faint'][0]
         if print_it:
             print(textwrap.fill('Missing Fibers: {}'.format(missing_bundles),
                                 80))
@@ -197,69 +413,23 @@ class APOGEERaw:
             print()
 
         if plot:
-            import matplotlib.pyplot as plt
-            fig = plt.figure(figsize=(9, 4))
-            ax = fig.gca()
-            x = np.arange(len(flux_ratio)) + 1
-            ax.plot(x[i_bright - 1], flux_ratio[i_bright - 1], 'o',
-                    c=(0, 0.6, 0.533))
-            ax.plot(x[i_faint - 1], flux_ratio[i_faint - 1], 'o',
-                    c=(0.933, 0.466, 0.2))
-            ax.plot(x[i_missing - 1], flux_ratio[i_missing - 1], 'o',
-                    c=(0.8, 0.2, 0.066))
-            ax.set_xlabel('Fiber ID')
-            ax.set_ylabel('Throughput Efficiency')
-            ax.axis([1, 300, -0.2, 1.35])
-            ax.grid(True)
-            ax.axhline(0.7, c=(0, 0.6, 0.533))
-            ax.axhline(0.2, c=(0.933, 0.466, 0.2))
-            ax.set_title('APOGEE Fiber Relative Intensity {}'.format(
-                self.exp_id), size=15)
-            plt.show()
+            plot_flux_ratio(flux_ratio, self.exp_id)
 
         return missing_bundles, faint_bundles, flux_ratio
 
     @staticmethod
     def create_bundles(subset):
         """This method converts an array of ints into a list of strings that
-        describe a large series of fibers and ints for lone fibers.
+        describe a large series of fibers and ints for lone fibers, see
+        mask_runs.
 
         Ex: [1, 2, 3, 5] -> ['1 - 3', 5]
 
         """
-        if len(subset) == 0:
-            return []
-        bundles = [subset[0]]
-        b = 0
-        for fib in subset[1:]:
-            if isinstance(bundles[b], np.int64):
-                if bundles[b] + 1 == fib:
-                    if fib % 30 == 0:
-                        bundles.append(fib)
-                        b += 1
-                    else:
-                        # All strings are created here
-                        bundles[b] = '{} - {}'.format(bundles[b], fib)
-                else:
-                    bundles.append(fib)
-                    b += 1
-            elif isinstance(bundles[b], str):
-                if int(bundles[b].split()[-1]) + 1 == fib:
-                    if fib % 30 == 1:
-                        bundles.append(fib)
-                        b += 1
-                    else:
-                        bundles[b] = '{} - {}'.format(
-                            bundles[b].split()[0], fib)
-                else:
-                    bundles.append(fib)
-                    b += 1
-        # for i, bundle in enumerate(bundles):
-        #     if isinstance(bundle, str):
-        #         low, high = np.array(bundle.split(' - ')).astype(int)
-        #         if ((low - 1) // 30) == ((high - 1) // 30):
-        #             bundles[i] = '{} bundle'.format(low)
-        return bundles
+        subset = np.asarray(subset, dtype=int).reshape(-1)
+        mask = np.zeros(subset.max(initial=0), dtype=bool)
+        mask[subset - 1] = True
+        return format_runs(*mask_runs(mask)[1:])
 
 
 def main():
@@ -274,6 +444,7 @@ def main():
                         help='Show details, can be stacked')
     args = parser.parse_args()
     if args.today:
+        from astropy.time import Time
         mjd_today = int(Time.now().sjd)
         data_dir = sdss_paths.ap_archive / f"{mjd_today}/"
     elif args.self.mjd:
@@ -3,12 +3,76 @@
 A tool to grab a single BOSS image and pull a few items from its header. It is
  used in bin/sloan_log.py, but it could be used directly as well.
 """
-import time
+import gzip
 import argparse
 from pathlib import Path
-from astropy.time import Time
 import fitsio
 
+FITS_BLOCK = 2880
+FITS_CARD = 80
+
+
+def parse_card_value(value):
+    """Converts the value field of a header card (everything after '= ') to a
+    str, bool, int, or float like fitsio does. Strings are returned without
+    their quotes or trailing spaces"""
+    value = value.strip()
+    if value.startswith("'"):
+        out = ''
+        i = 1
+        while i < len(value):
+            if value[i] == "'":
+                if value[i + 1:i + 2] == "'":  # An escaped quote
+                    out += "'"
+                    i += 2
+                    continue
+                break
+            out += value[i]
+            i += 1
+        return out.rstrip()
+    value = value.split('/', 1)[0].strip()
+    if value == '':
+        return None
+    elif value == 'T':
+        return True
+    elif value == 'F':
+        return False
+    try:
+        return int(value)
+    except ValueError:
+        return float(value.replace('D', 'E'))
+
+
+def read_gz_header(fil):
+    """Reads the primary header of a gzipped FITS file like sdR-r1-*.fit.gz.
+    fitsio decompresses the entire image to read a header, but this only
+    inflates 2880 byte blocks until it finds the END card, which is usually in
+    the first few blocks. Returns a dictionary of keyword: value.
+    """
+    header = {}
+    last_key = None
+    with gzip.open(fil, 'rb') as f:
+        while True:
+            block = f.read(FITS_BLOCK)
+            if len(block) < FITS_BLOCK:
+                raise OSError(f"No END card found in the header of {fil}")
+            for i in range(0, FITS_BLOCK, FITS_CARD):
+                card = block[i:i + FITS_CARD].decode('ascii', 'replace')
+                key = card[:8].strip()
+                if key == 'END':
+                    return header
+                if key == 'CONTINUE' and isinstance(header.get(last_key),
+                                                    str):
+                    # Long strings end in & and continue on the next card
+                    header[last_key] = (header[last_key].rstrip('&')
+                                        + parse_card_value(card[8:]))
+                    continue
+                if card[8:10] != '= ':
+                    continue
+                # fitsio keeps the last card of a repeated keyword
+                header[key] = parse_card_value(card[10:])
+                last_key = key
+
 
 class BOSSRaw:
     """A class to parse raw data from APOGEE. The purpose of collecting this
@@ -18,17 +82,24 @@ class BOSSRaw:
 
     def __init__(self, fil):
         self.fil = fil
-        try:
-            header = fitsio.read_header(fil)
-        except OSError:
-            header = fitsio.read_header(fil)
+        if str(fil).endswith('.gz'):
+            try:
+                header = read_gz_header(fil)
+            except (OSError, EOFError, ValueError):
+                # EOFError is a truncated .gz, which fitsio reports itself
+                header = fitsio.read_header(fil)
+        else:
+            try:
+                header = fitsio.read_header(fil)
+            except OSError:
+                header = fitsio.read_header(fil)
             
         if "MGDPOS" in header.keys():  # SDSS-IV
             self.dither = header['MGDPOS']
         else:  # Usually works in SDSS-V
             self.dither = "-"  # header['POINTING'][0]
         self.exp_time = int(header['EXPTIME'])
-        self.isot = Time(header['DATE-OBS'])  # UTC
+        self.date_obs = header['DATE-OBS']
         if "DESIGNID" in header.keys():
             self.design_id = header["DESIGNID"]
         else:
@@ -67,6 +138,12 @@ class BOSSRaw:
         # self.seeing = header['SEEING']
         # self.img_type = header['IMAGETYP']
 
+    @property
+    def isot(self):
+        """DATE-OBS as a Time, made on access"""
+        from astropy.time import Time
+        return Time(self.date_obs)  # UTC
+
 
 def main():
     parser = argparse.ArgumentParser()
@@ -77,6 +154,7 @@ def main():
     parser.add_argument('-v', '--verbose', action='count', default=1,
                         help='Show details, can be stacked')
     if args.today:
+        from astropy.time import Time
         mjd_today = int(Time.now().sjd)
         data_dir = '/data/spectro/{}/'.format(mjd_today)
     elif args.mjd:
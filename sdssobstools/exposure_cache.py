@@ -0,0 +1,102 @@
+#!/usr/bin/env python3
+"""
+A small persistent cache of the exposure records that sloan_log.py reads from
+ raw image headers and quickred files. Each night gets its own SQLite file in
+ the cache directory, and each record is keyed by the image path and
+ invalidated if the size or modification time of that image changes, so a
+ rerun in the middle of the night only reads the new exposures. A file written
+ with another CACHE_VERSION is emptied when it is opened.
+"""
+import json
+import os
+import sqlite3
+
+import numpy as np
+
+from pathlib import Path
+
+__version__ = '3.0.0'
+
+default_dir = Path.home() / ".cache/sdss-obstools"
+# The layout of the cached records, which must be increased whenever what
+# sloan_log.read_apogee or read_boss put in a record changes
+CACHE_VERSION = 2
+
+
+def _encode(obj):
+    """Converts numpy types that json can't handle"""
+    if isinstance(obj, np.ndarray):
+        return {'__ndarray__': obj.tolist(), 'dtype': obj.dtype.str}
+    if isinstance(obj, np.integer):
+        return int(obj)
+    if isinstance(obj, np.floating):
+        return float(obj)
+    if isinstance(obj, np.bool_):
+        return bool(obj)
+    raise TypeError(f"Can't cache an object of type {type(obj)}")
+
+
+def _decode(obj):
+    if '__ndarray__' in obj:
+        return np.array(obj['__ndarray__'], dtype=obj['dtype'])
+    return obj
+
+
+class ExposureCache:
+    """A per-SJD cache of exposure records, stored in
+    <cache_dir>/sloan_log_<sjd>.sqlite
+
+    cache = ExposureCache(cache_dir, sjd)
+    rec = cache.get(path)  # None if missing or out of date
+    cache.put(path, rec)
+    cache.commit()
+    """
+
+    def __init__(self, cache_dir, sjd, rebuild=False):
+        self.path = Path(cache_dir) / f"sloan_log_{sjd}.sqlite"
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.db = sqlite3.connect(self.path.as_posix(), timeout=10)
+        # The version is kept in the file's user_version
+        version = self.db.execute("PRAGMA user_version").fetchone()[0]
+        if version != CACHE_VERSION:
+            self.db.execute("DROP TABLE IF EXISTS exposures")
+            self.db.execute(f"PRAGMA user_version = {CACHE_VERSION:d}")
+        self.db.execute("CREATE TABLE IF NOT EXISTS exposures (path TEXT"
+                        " PRIMARY KEY, size INTEGER, mtime INTEGER,"
+                        " record TEXT)")
+        if rebuild:
+            self.db.execute("DELETE FROM exposures")
+        self.db.commit()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def _stat(path):
+        stat = os.stat(path)
+        return stat.st_size, stat.st_mtime_ns
+
+    def get(self, path):
+        """Returns the cached record for path, or None if it isn't cached or
+        the file has changed since it was cached"""
+        path = Path(path).absolute().as_posix()
+        row = self.db.execute("SELECT size, mtime, record FROM exposures"
+                              " WHERE path = ?", (path,)).fetchone()
+        if row is None or tuple(row[:2]) != self._stat(path):
+            self.misses += 1
+            return None
+        self.hits += 1
+        return json.loads(row[2], object_hook=_decode)
+
+    def put(self, path, record):
+        path = Path(path).absolute().as_posix()
+        size, mtime = self._stat(path)
+        self.db.execute("INSERT OR REPLACE INTO exposures VALUES (?, ?, ?, ?)",
+                        (path, size, mtime,
+                         json.dumps(record, default=_encode)))
+
+    def commit(self):
+        self.db.commit()
+
+    def close(self):
+        self.db.commit()
+        self.db.close()
@@ -0,0 +1,201 @@
+#!/usr/bin/env python3
+"""
+Columnar tables of exposures for sloan_log.py. Exposures are appended to a
+ preallocated NumPy structured array as they are read, and anything per field
+ (first exposure time, designs, configs, ...) is computed after all of them are
+ read with GroupBy, which factorizes the field IDs once and reduces every
+ column with array operations instead of list.index lookups. Times are kept
+ as datetime64[ns] columns, parsed from DATE-OBS in one call per column, and
+ only formatted as strings (or converted to astropy Times) to be printed.
+"""
+import numpy as np
+
+__version__ = '3.0.0'
+
+apogee_dtype = [('exp_id', 'i8'), ('date_obs', 'U32'), ('field_id', 'i8'),
+                ('design_id', 'i8'), ('config_id', 'i8'), ('lead', 'U32'),
+                ('exp_type', 'U16'), ('dither', 'U8'), ('n_read', 'i8'),
+                ('seeing', 'f8'), ('detectors', 'U8')]
+boss_dtype = [('exp_id', 'i8'), ('date_obs', 'U32'), ('field_id', 'i8'),
+              ('design_id', 'i8'), ('config_id', 'i8'), ('lead', 'U32'),
+              ('dither', 'U8'), ('flavor', 'U16'), ('exp_time', 'i8'),
+              ('hartmann', 'U32'), ('detectors', 'U16')]
+
+mjd_epoch = np.datetime64('1858-11-17T00:00:00', 'ns')
+_day = np.timedelta64(86400, 's')
+
+
+def parse_times(date_obs):
+    """Parses a list of ISO DATE-OBS strings to datetime64[ns] in bulk. An
+    empty string is NaT"""
+    return np.asarray(date_obs, dtype=str).astype('M8[ns]')
+
+
+def to_mjd(times):
+    """Float MJDs of datetime64 times"""
+    return (np.asarray(times, dtype='M8[ns]') - mjd_epoch) / _day
+
+
+def from_mjd(mjd):
+    """datetime64[ns] times of float MJDs, NaN is NaT"""
+    mjd = np.asarray(mjd, dtype=float)
+    ns = np.round(np.nan_to_num(mjd) * 86400e9).astype('i8')
+    return np.where(np.isnan(mjd), np.datetime64('NaT', 'ns'),
+                    mjd_epoch + ns.astype('m8[ns]'))
+
+
+def _chars(times):
+    """Times as a 2D array of the characters of YYYY-MM-DDTHH:MM:SS.sss,
+    rounded to the millisecond like astropy"""
+    ms = (np.asarray(times, dtype='M8[ns]').reshape(-1)
+          + np.timedelta64(500_000, 'ns')).astype('M8[ms]')
+    strings = np.datetime_as_string(ms, unit='ms').astype('U23')
+    return strings.view('U1').reshape(-1, 23)
+
+
+def iso(times):
+    """Formats an array of datetime64 times like astropy's Time.iso,
+    YYYY-MM-DD HH:MM:SS.sss"""
+    chars = _chars(times)
+    chars[chars[:, 10] == 'T', 10] = ' '
+    return chars.view('U23')[:, 0]
+
+
+def hms(times):
+    """Formats an array of datetime64 times as HH:MM:SS strings, the same as
+    Time.iso[11:19]"""
+    return np.ascontiguousarray(_chars(times)[:, 11:19]).view('U8')[:, 0]
+
+
+class ExposureTable:
+    """A growable structured array, one row per exposure. Appending a record
+    dictionary copies the fields in dtype into the next row, and the capacity
+    doubles when it's full, so n appends cost O(n).
+
+    table = ExposureTable(apogee_dtype, len(images))
+    table.append(rec)
+    table['field_id']  # A view of the column for the rows appended so far
+    """
+
+    def __init__(self, dtype, capacity=64):
+        self.dtype = np.dtype(dtype)
+        self._rows = np.zeros(max(capacity, 1), dtype=self.dtype)
+        self.n = 0
+
+    def __len__(self):
+        return self.n
+
+    def __getitem__(self, key):
+        return self.rows[key]
+
+    @property
+    def rows(self):
+        return self._rows[:self.n]
+
+    def reserve(self, capacity):
+        """Makes sure capacity rows fit without another allocation"""
+        if capacity > len(self._rows):
+            rows = np.zeros(capacity, dtype=self.dtype)
+            rows[:self.n] = self._rows[:self.n]
+            self._rows = rows
+
+    def append(self, rec):
+        if self.n == len(self._rows):
+            self.reserve(2 * len(self._rows))
+        self._rows[self.n] = tuple(rec[name] for name in self.dtype.names)
+        self.n += 1
+
+    def clear(self):
+        self.n = 0
+
+
+class GroupBy:
+    """Factorizes values (usually field IDs) into groups, in the order each
+    value first appears or in the order of keys, so that columns of the same
+    length can be reduced per group in one pass with np.bincount and ufunc.at.
+
+    groups = GroupBy(table['field_id'])
+    groups.keys  # Unique keys
+    groups.index[key]  # Row of key in groups.keys
+    groups.min(mjds)  # Per-group minimum
+    groups.count(table['dither'] == 'A')  # Per-group number of A dithers
+    groups.members[groups.index[key]]  # Rows of values in the group of key
+    """
+
+    def __init__(self, values, keys=None):
+        values = np.asarray(values).reshape(-1)
+        if keys is None:
+            uniques, first, inverse = np.unique(values, return_index=True,
+                                                return_inverse=True)
+            # np.unique sorts the keys, but the original order is more useful
+            order = np.argsort(first, kind='stable')
+            rank = np.empty_like(order)
+            rank[order] = np.arange(len(order))
+            self.keys = uniques[order]
+            self.first = first[order]
+            self.inverse = rank[inverse.reshape(-1)]
+        else:
+            self.keys = np.asarray(keys).reshape(-1)
+            sorter = np.argsort(self.keys, kind='stable')
+            pos = np.searchsorted(self.keys, values, sorter=sorter)
+            pos[pos == len(self.keys)] = 0
+            if len(values) and ((len(self.keys) == 0)
+                                or np.any(self.keys[sorter[pos]] != values)):
+                raise ValueError("Every value must be in keys")
+            self.inverse = sorter[pos]
+            # A key without any values gets len(values) as its first row
+            self.first = np.full(len(self.keys), len(values))
+            np.minimum.at(self.first, self.inverse, np.arange(len(values)))
+        self.n = len(self.keys)
+        self.index = {key: i for i, key in enumerate(self.keys.tolist())}
+        self._members = None
+
+    def argmin(self, values):
+        """Index of the smallest value in each group, the earliest one wins a
+        tie"""
+        order = np.lexsort((np.asarray(values), self.inverse))
+        starts = np.ones(len(order), dtype=bool)
+        starts[1:] = self.inverse[order][1:] != self.inverse[order][:-1]
+        return order[starts]
+
+    def min(self, values):
+        return np.asarray(values)[self.argmin(values)]
+
+    def count(self, mask=None):
+        """Number of rows in each group, or of rows where mask is True"""
+        inverse = self.inverse if mask is None else self.inverse[mask]
+        return np.bincount(inverse, minlength=self.n)
+
+    def max(self, values, mask=None, fill=0):
+        """Largest value in each group (of the rows where mask is True), or
+        fill for a group without any"""
+        values = np.asarray(values)
+        inverse = self.inverse
+        if mask is not None:
+            values = values[mask]
+            inverse = inverse[mask]
+        out = np.full(self.n, fill, dtype=np.result_type(values, fill))
+        np.maximum.at(out, inverse, values)
+        return out
+
+    @property
+    def members(self):
+        """A list of the rows in each group, in their original order"""
+        if self._members is None:
+            order = np.argsort(self.inverse, kind='stable')
+            self._members = np.split(order, np.cumsum(self.count())[:-1])
+            if self.n == 0:
+                self._members = []
+        return self._members
+
+    def sets(self, values):
+        """A set of the unique values in each group, as an object array"""
+        out = np.empty(self.n, dtype=object)
+        for i in range(self.n):
+            out[i] = set()
+        if self.n == 0:
+            return out
+        pairs = np.unique(np.stack((self.inverse, np.asarray(values))), axis=1)
+        for i, value in zip(pairs[0].tolist(), pairs[1].tolist()):
+            out[i].add(value)
+        return out
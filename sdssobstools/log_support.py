@@ -2,63 +2,74 @@
 
 """A logging tool that is meant to perform the function of LogSupport scripts in
 STUI, but by bypassing STUI and directly accessing telemetry
-
-TODO: Thread these queries
 """
 import argparse
-import multiprocessing
 
 import numpy as np
 
-from astropy.time import Time
 from pathlib import Path
 
 from bin import influx_fetch, sjd
+from sdssobstools import profiling, query_plan
 
 __version__ = '3.3.0'
 
 
-def get_boss_callbacks(tstart, tend, call_dict):
-    out = []
-    boss_exp_path = Path(__file__).parent.parent / \
-        "flux/science_exposures.flux"
-    with boss_exp_path.open('r') as fil:
-        tables = influx_fetch.query(fil.read(), tstart, tend)
-    for table in tables:
-        for row in table.records:
-            out.append(row.get_time())
-
-    call_dict["boss_calls"] = out
-
-
-def get_apogee_callbacks(tstart, tend, call_dict):
-    out = []
-    apog_exp_path = Path(__file__).parent.parent / "flux/apogee_science.flux"
-    with apog_exp_path.open('r') as fil:
-        tables = influx_fetch.query(fil.read(), tstart, tend)
-    for table in tables:
-        for row in table.records:
-            out.append(row.get_time())
-    call_dict["apogee_calls"] = out
-
-
-def get_enclosure_history(tstart, tend, call_dict):
-    out_times = []
-    out_states = []
-    flx_path = Path(__file__).parent.parent / "flux/enclosure.flux"
-    with flx_path.open('r') as fil:
-        tables = influx_fetch.query(fil.read(), tstart, tend)
-    for table in tables:
-        for row in table.records:
-            if row.get_value():
-                out_times.append(row.get_time())
-                out_states.append(row.get_value())
-    call_dict["enclosure_times"] = out_times
-    call_dict["enclosure_states"] = out_states
+# The queries of the callbacks, in flux/, and the seconds they have to finish
+callback_files = {'boss': 'science_exposures.flux',
+                  'apogee': 'apogee_science.flux',
+                  'enclosure': 'enclosure.flux'}
+callback_deadline = 5
+
+
+def callback_request(name, tstart, tend):
+    """The query_plan.Request of callback name"""
+    path = Path(__file__).parent.parent / "flux" / callback_files[name]
+    with path.open('r') as fil:
+        return query_plan.Request(fil.read(), tstart, tend)
+
+
+def _callback_arrays(name, tstart, tend, arrays):
+    if arrays is None:
+        arrays = influx_fetch.query_arrays(
+            callback_request(name, tstart, tend).flux_script, tstart, tend)
+    return influx_fetch.join_fields(arrays)
+
+
+@profiling.traced('log_support.boss_callbacks')
+def get_boss_callbacks(tstart, tend, call_dict, arrays=None):
+    times, _ = _callback_arrays('boss', tstart, tend, arrays)
+    call_dict["boss_calls"] = list(influx_fetch.to_time(times).value)
+
+
+@profiling.traced('log_support.apogee_callbacks')
+def get_apogee_callbacks(tstart, tend, call_dict, arrays=None):
+    times, _ = _callback_arrays('apogee', tstart, tend, arrays)
+    call_dict["apogee_calls"] = list(influx_fetch.to_time(times).value)
+
+
+@profiling.traced('log_support.enclosure')
+def get_enclosure_history(tstart, tend, call_dict, arrays=None):
+    times, states = _callback_arrays('enclosure', tstart, tend, arrays)
+    opened = states != 0
+    call_dict["enclosure_times"] = list(
+        influx_fetch.to_time(times[opened]).value)
+    call_dict["enclosure_states"] = list(states[opened])
+
+
+# The function of each callback, which reads its arrays into a call dict
+callback_functions = {'boss': get_boss_callbacks,
+                      'apogee': get_apogee_callbacks,
+                      'enclosure': get_enclosure_history}
 
 
 class LogSupport:
+    # The query of each section, in flux/
+    flux_files = {'offsets': 'offsets.flux', 'focus': 'focus.flux',
+                  'weather': 'weather.flux', 'hartmann': 'hartmanns.flux'}
+
     def __init__(self, tstart, tend, args):
+        from astropy.time import Time
         self.tstart = Time(tstart)
         self.tend = Time(tend)
         self.args = args
@@ -72,22 +83,28 @@ class LogSupport:
         self.hartmann = ""
 
     def set_callbacks(self):
-        callback_dict = multiprocessing.Manager().dict()
-        boss = multiprocessing.Process(target=get_boss_callbacks,
-                                       args=(self.tstart, self.tend,
-                                             callback_dict,))
-        apogee = multiprocessing.Process(target=get_apogee_callbacks,
-                                         args=(self.tstart, self.tend,
-                                               callback_dict,))
-        enclosure = multiprocessing.Process(target=get_enclosure_history,
-                                            args=(self.tstart, self.tend,
-                                                  callback_dict,))
-        boss.start()
-        apogee.start()
-        enclosure.start()
-        boss.join(5)
-        apogee.join(5)
-        enclosure.join(5)
+        """Queries the three callbacks at once, each with callback_deadline
+        seconds to finish, and sets the call times from those that did"""
+        arrays, errors = influx_fetch.gather_queries(
+            {name: callback_request(name, self.tstart, self.tend)
+             for name in callback_files},
+            deadline=callback_deadline, verbose=self.args.verbose)
+        influx_fetch.report(errors)
+        callback_dict = {}
+        for name, func in callback_functions.items():
+            if name in arrays:
+                func(self.tstart, self.tend, callback_dict,
+                     arrays=arrays[name])
+        self.set_call_times(callback_dict)
+
+    def set_call_times(self, callback_dict):
+        """Sets call_times from the results of the three callback queries,
+        the science exposures that began while the enclosure was open, at
+        least 15 minutes apart. A query that didn't finish counts as empty"""
+        from astropy.time import Time
+        for key in ('boss_calls', 'apogee_calls', 'enclosure_times',
+                    'enclosure_states'):
+            callback_dict.setdefault(key, [])
         if self.args.verbose:
             print(f"BOSS Calls: {len(callback_dict['boss_calls'])}, "
                   f"APOGEE Calls: {len(callback_dict['apogee_calls'])}, "
@@ -130,38 +147,38 @@ class LogSupport:
         # self.call_times = Time(np.arange((self.tstart + 0.3).mjd, self.tend.mjd,
             # 15 * 60 / 86400), format="mjd")
 
-    def get_offsets(self, out_dict={}):
-        start = Time.now()
+    def request(self, name):
+        """The query_plan.Request of section name. Offsets, focus, and weather
+        are aggregated by the minute between the first and last call times,
+        with lowercase fields, and Hartmanns are every point of the window"""
+        path = Path(__file__).parent.parent / "flux" / self.flux_files[name]
+        with path.open('r') as fil:
+            flux_script = fil.read()
+        if name == 'hartmann':
+            return query_plan.Request(flux_script, self.tstart, self.tend)
+        return query_plan.Request(flux_script, self.call_times[0],
+                                  self.call_times[-1], "1m", lower=True)
+
+    def query_sections(self, names):
+        """The arrays of each section in names by name, from as few queries
+        as influx_fetch.query_merged can merge them into"""
+        arrays = influx_fetch.query_merged(
+            [self.request(name) for name in names], verbose=self.args.verbose)
+        return dict(zip(names, arrays))
+
+    @profiling.traced('log_support.offsets')
+    def get_offsets(self, out_dict={}, arrays=None):
+        """Makes the offsets table, from arrays if they were already queried
+        by query_sections"""
         self.offsets = (f"{'Time':<8} {'Field':>6}-{'Design':<6} {'Az':>6}"
                         f" {'Alt':>4} {'Rot':>6} {'RA Off':>6} {'Dec Off':>7}"
                         f" {'Rot Off':>7} {'Guide RMS (um)':>14}\n")
         self.offsets += '=' * 80 + '\n'
-        offsets_tab = {}
-        offsets_tab_path = Path(__file__).parent.parent / "flux/offsets.flux"
-        with offsets_tab_path.open('r') as fil:
-            pre_query = Time.now()
-            off_tables = influx_fetch.query(fil.read(),
-                                            self.call_times[0], self.call_times[-1], interval="1m",
-                                            verbose=self.args.verbose)
-            post_query = Time.now()
-        for table in off_tables:
-            for row in table.records:
-                field = row.get_field().lower()
-                if field in offsets_tab.keys():
-                    offsets_tab[f"t{field}"].append(row.get_time())
-                    offsets_tab[field].append(row.get_value())
-                else:
-                    offsets_tab[f"t{field}"] = [row.get_time()]
-                    offsets_tab[field] = [row.get_value()]
-        post_parse = Time.now()
-        for key in offsets_tab.keys():
-            if key[0] == 't':
-                offsets_tab[key] = Time(offsets_tab[key])
-            else:
-                offsets_tab[key] = np.array(offsets_tab[key])
+        if arrays is None:
+            arrays = self.query_sections(['offsets'])['offsets']
+        offsets_tab = influx_fetch.time_table(arrays)
         if len(offsets_tab) == 0:
             return
-        post_sort = Time.now()
         for t in self.call_times:
             line = [t.isot[11:19]]
             for key in ["configuration_loaded_2", "configuration_loaded_1",
@@ -181,39 +198,18 @@ class LogSupport:
             self.offsets += ("{:<8} {:>6.0f}-{:<6.0f} {:>6.1f} {:>4.1f}"
                              " {:>6.1f} {:>6.3f} {:>7.3f} {:>7.3f} {:>14.3f}"
                              "\n".format(*line))
-        post_print = Time.now()
         out_dict["offsets"] = self.offsets
-        if self.args.verbose:
-            times = Time([start, pre_query, post_query, post_parse, post_sort,
-                          post_print]) - start
-            print(f"Offsets overheads: {np.diff(times.sec)}")
 
-    def get_focus(self, out_dict={}):
+    @profiling.traced('log_support.focus')
+    def get_focus(self, out_dict={}, arrays=None):
         self.focus = (f"{'Time':<8} {'Field':>6}-{'Design':<6} {'M1':>7}"
                       f" {'M2':>7} {'Focus':>5}"
                       f" {'Az':>6} {'Alt':>5} {'Temp':>5} {'Wind':>4}"
                       f" {'Dir':>3}\n")
         self.focus += '=' * 80 + '\n'
-        focus_tab = {}
-        focus_tab_path = Path(__file__).parent.parent / "flux/focus.flux"
-        with focus_tab_path.open('r') as fil:
-            off_tables = influx_fetch.query(fil.read(),
-                                            self.call_times[0], self.call_times[-1], interval="1m",
-                                            verbose=self.args.verbose)
-        for table in off_tables:
-            for row in table.records:
-                field = row.get_field().lower()
-                if field in focus_tab.keys():
-                    focus_tab[f"t{field}"].append(row.get_time())
-                    focus_tab[field].append(row.get_value())
-                else:
-                    focus_tab[f"t{field}"] = [row.get_time()]
-                    focus_tab[field] = [row.get_value()]
-        for key in focus_tab.keys():
-            if key[0] == 't':
-                focus_tab[key] = Time(focus_tab[key])
-            else:
-                focus_tab[key] = np.array(focus_tab[key])
+        if arrays is None:
+            arrays = self.query_sections(['focus'])['focus']
+        focus_tab = influx_fetch.time_table(arrays)
         for t in self.call_times:
             line = [t.isot[11:19]]
             for key in ["configuration_loaded_2", "configuration_loaded_1",
@@ -236,7 +232,8 @@ class LogSupport:
                                *line))
         out_dict["focus"] = self.focus
 
-    def get_weather(self, out_dict={}):
+    @profiling.traced('log_support.weather')
+    def get_weather(self, out_dict={}, arrays=None):
         dust = "1\u03BCm Dust"
         irscs = "IRSC \u03C3"
         irscm = "IRSC \u03BC"
@@ -245,41 +242,23 @@ class LogSupport:
                         f" {'Humid':>5} {'Wind':>5} {'Dir':>3} {dust:>8}"
                         f" {irscs:>6} {irscm:>6}\n")
         self.weather += '=' * 80 + '\n'
-        weather_tab = {}
-        weather_tab_path = Path(__file__).parent.parent / "flux/weather.flux"
-        with weather_tab_path.open('r') as fil:
-            weather_tables = influx_fetch.query(fil.read(),
-                                                self.call_times[0], self.call_times[-1], interval="1m",
-                                                verbose=self.args.verbose)
-
-        for table in weather_tables:
-            for row in table.records:
-                field = row.get_field().lower()
-                if field in weather_tab.keys():
-                    weather_tab[f"t{field}"].append(row.get_time())
-                    weather_tab[field].append(row.get_value())
-                else:
-                    weather_tab[f"t{field}"] = [row.get_time()]
-                    weather_tab[field] = [row.get_value()]
+        if arrays is None:
+            arrays = self.query_sections(['weather'])['weather']
+        weather_arrays = dict(arrays)
 
         # Filter out dpDep values by adding a fake value every time the humidity
         # is above 90
-        for i, h in enumerate(weather_tab["humidpt"]):
-            if h > 90:
-                weather_tab["dustb"].append(np.nan)
-                weather_tab["tdustb"].append(weather_tab["thumidpt"][i])
-        for key in weather_tab.keys():
-            if key[0] == 't':
-                weather_tab[key] = Time(weather_tab[key])
-            else:
-                weather_tab[key] = np.array(weather_tab[key])
+        t_humid, humid = weather_arrays["humidpt"]
+        t_dust, dust_vals = weather_arrays["dustb"]
+        t_dust = np.concatenate([t_dust, t_humid[humid > 90]])
+        dust_vals = np.concatenate([dust_vals.astype(float),
+                                    np.full((humid > 90).sum(), np.nan)])
         # Most data is assumed to be sorted, but because of the dewpoint filter
         # for dust, we need to resort it to put the added values in their
         # proper places
-        weather_tab["dustb"] = weather_tab["dustb"][
-            weather_tab["tdustb"].argsort()]
-        weather_tab["tdustb"] = weather_tab["tdustb"][
-            weather_tab["tdustb"].argsort()]
+        sorter = t_dust.argsort(kind='stable')
+        weather_arrays["dustb"] = (t_dust[sorter], dust_vals[sorter])
+        weather_tab = influx_fetch.time_table(weather_arrays)
         for t in self.call_times:
             line = [t.isot[11:19]]
             for key in ["configuration_loaded_2", "configuration_loaded_1",
@@ -305,7 +284,8 @@ class LogSupport:
                                  *line))
         out_dict["weather"] = self.weather
 
-    def get_hartmann(self, out_dict={}):
+    @profiling.traced('log_support.hartmann')
+    def get_hartmann(self, out_dict={}, arrays=None):
         self.hartmann = (f"{'Time':8} {'Field':>6}-{'Design':<6} {'Temp':>6}"
                          f" {'R off':>6} {'B off':>6} {'Move':>6} {'Resid':>6}"
                          " \n")
@@ -313,34 +293,20 @@ class LogSupport:
         self.harts = {}
         boss_temps = []
         boss_times = []
-        hartmanns_path = Path(__file__).parent.parent / "flux/hartmanns.flux"
         # boss_temps_path = Path(__file__).parent.parent / "flux/boss_temps.flux"
-        with hartmanns_path.open('r') as fil:
-            hart_tables = influx_fetch.query(fil.read(),
-                                             self.tstart, self.tend,
-                                             verbose=self.args.verbose)
+        if arrays is None:
+            arrays = self.query_sections(['hartmann'])['hartmann']
+        hart_arrays = arrays
         # with boss_temps_path.open('r') as fil:
             # boss_tables = influx_fetch.query(fil.read(),
             # self.tstart, self.tend)
-        if len(hart_tables) == 0:
+        self.harts = influx_fetch.time_table(hart_arrays)
+        if len(hart_arrays) == 0:
             return
         # for table in boss_tables:
             # for row in table.records:
             # boss_times.append(row.get_time())
             # boss_temps.append(row.get_value())
-        for table in hart_tables:
-            for row in table.records:
-                if row.get_field() in self.harts.keys():
-                    self.harts[f"t{row.get_field()}"].append(row.get_time())
-                    self.harts[row.get_field()].append(row.get_value())
-                else:
-                    self.harts[f"t{row.get_field()}"] = [row.get_time()]
-                    self.harts[row.get_field()] = [row.get_value()]
-        for key in self.harts.keys():
-            if key[0] == 't':
-                self.harts[key] = Time(self.harts[key])
-            else:
-                self.harts[key] = np.array(self.harts[key])
         # boss_times = Time(boss_times)
         # boss_temps = np.array(boss_temps)
         for t in self.harts["tsp1Residuals_deg"]:
@@ -396,6 +362,7 @@ def main():
                         help='Verbose outputs for debugging')
     args = parser.parse_args()
 
+    from astropy.time import Time
     if args.today:
         now = Time.now()
         start = Time(sjd.sjd(), format='mjd') - 0.3
@@ -425,21 +392,11 @@ def main():
     tel = LogSupport(start, end, args)
     tel.set_callbacks()
 
-    if args.offsets:
-        tel.get_offsets()
-        print(tel.offsets)
-
-    if args.focus:
-        tel.get_focus()
-        print(tel.focus)
-
-    if args.weather:
-        tel.get_weather()
-        print(tel.weather)
-
-    if args.hartmann:
-        tel.get_hartmann()
-        print(tel.hartmann)
+    names = [name for name in tel.flux_files if getattr(args, name)]
+    arrays = tel.query_sections(names)
+    for name in names:
+        getattr(tel, f"get_{name}")(arrays=arrays[name])
+        print(getattr(tel, name))
 
 
 if __name__ == '__main__':
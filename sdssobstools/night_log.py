@@ -0,0 +1,455 @@
+#!/usr/bin/env python3
+"""
+A serializable model of a night parsed by sloan_log.py, and emitters that
+ write it as text, JSON, CSV, or HTML. The model is built once from the sorted
+ Logging tables, so several reports can be written from a single parse.
+
+night = NightLog.from_logging(log)
+night.write('59730.json')  # The format comes from the suffix
+write_text(night, sys.stdout)  # The sections that sloan_log.py prints
+"""
+import csv
+import html
+import json
+import textwrap
+
+import numpy as np
+
+from pathlib import Path
+
+from sdssobstools import apogee_data, exposure_table
+
+__version__ = '3.0.0'
+
+# The order and names of the columns of each table
+apogee_columns = ['sjd', 'time', 'field', 'design', 'config', 'exposure',
+                  'type', 'dither', 'reads', 'arch', 'seeing']
+boss_columns = ['sjd', 'time', 'field', 'design', 'config', 'exposure',
+                'type', 'sos', 'exp_time', 'hartmann']
+field_columns = ['field', 'time', 'lead', 'designs', 'configs', 'apogee',
+                 'boss']
+dome_flat_columns = ['time', 'field', 'design', 'missing', 'faint',
+                     'n_missing', 'n_faint', 'throughput']
+arc_columns = ['time', 'exposure', 'lamp', 'offset']
+object_columns = ['time', 'dither', 'offset']
+hartmann_columns = ['time', 'field', 'r1_steps', 'b1_ring', 'average_move',
+                    'residuals', 'temp']
+# The LogSupport.harts keys of the Hartmann columns after time and field
+hartmann_keys = ['r1PistonMove_steps', 'b1RingMove', 'sp1AverageMove_steps',
+                 'sp1Residuals_deg', 'sp1Temp_median']
+# The sections of the text log, in the order they are written, which are
+# also the names of the Logging args that print them
+text_sections = ['summary', 'data', 'apogee', 'boss']
+
+
+def _plain(obj):
+    """Converts numpy types to built-in ones for json"""
+    if isinstance(obj, np.ndarray):
+        return obj.tolist()
+    if isinstance(obj, np.integer):
+        return int(obj)
+    if isinstance(obj, np.floating):
+        return None if np.isnan(obj) else float(obj)
+    if isinstance(obj, np.bool_):
+        return bool(obj)
+    if isinstance(obj, (set, frozenset)):
+        return sorted(obj)
+    raise TypeError(f"Can't serialize an object of type {type(obj)}")
+
+
+def _scalar(value):
+    """Converts a numpy scalar to a built-in one, and NaN to None, which is
+    null in JSON"""
+    if isinstance(value, np.generic):
+        value = value.item()
+    if isinstance(value, float) and np.isnan(value):
+        return None
+    return value
+
+
+def _cell(value):
+    """Formats a value for a CSV or HTML cell, lists are space separated"""
+    if value is None:
+        return ''
+    if isinstance(value, (list, tuple)):
+        return ' '.join(str(v) for v in value)
+    return str(value)
+
+
+def _num(value):
+    """A number to format, where None (NaN in JSON) is NaN again"""
+    return np.nan if value is None else value
+
+
+def _utc(iso):
+    """HH:MM:SS of an iso time string"""
+    return iso[11:19]
+
+
+def hartmann_moves(harts, time):
+    """The last value of each of hartmann_keys in the two minutes after time
+    (an astropy Time), or NaN, from the harts of LogSupport.get_hartmann"""
+    moves = []
+    for key in hartmann_keys:
+        if 't' + key not in harts:
+            moves.append(np.nan)
+            continue
+        time_delta = (harts['t' + key] - time).sec
+        x = harts[key][(time_delta < 120) & (time_delta > 0)]
+        moves.append(np.nan if len(x) == 0 else x[-1])
+    return moves
+
+
+class NightLog:
+    """A night of exposures as a dictionary of tables, each of which is a
+    dictionary of equal length columns, plus the text notes of log support,
+    a summary of numbers for the text log, and the text sections it was made
+    for.
+
+    Tables:
+        apogee, boss: One row per exposure, in time order
+        fields: One row per field, in the order they were observed
+        dome_flats, arcs, objects: APOGEE dome flat results and dither offsets
+        hartmanns: BOSS Hartmann moves, with the data section
+
+    Summary:
+        dust: Integrated dust counts, with the summary section
+        flat_missing, flat_faint, flat_throughput: The missing and faint
+            fibers and the throughput of the mean of the dome flats
+        morning_exposures: APOGEE exposures of the morning cals, if only they
+            are printed
+    """
+
+    def __init__(self, sjd, tables=None, notes=None, summary=None,
+                 sections=None):
+        self.sjd = int(sjd)
+        self.tables = {} if tables is None else tables
+        self.notes = {} if notes is None else notes
+        self.summary = {} if summary is None else summary
+        self.sections = (list(text_sections) if sections is None
+                         else list(sections))
+
+    @classmethod
+    def from_logging(cls, log, sections=None):
+        """Builds a NightLog from a Logging object after its sort and
+        count_dithers. sections are the text sections to include, by default
+        those that log.args asks for, and the summary and data sections
+        wait for the dust and Hartmann telemetry they need"""
+        if sections is None:
+            sections = [name for name in text_sections
+                        if getattr(log.args, name, False)]
+        ap, b, data = log.ap_data, log.b_data, log.data
+        tables = {}
+        tables['apogee'] = dict(zip(apogee_columns, [
+            np.floor(ap['iMJD'] + 0.3).astype(int),
+            exposure_table.iso(ap['iTime']), ap['iField'], ap['iDesign'],
+            ap['iConfig'], ap['iID'], ap['iEType'], ap['iDither'],
+            ap['iNRead'], ap['iDetector'], ap['iSeeing']]))
+        tables['boss'] = dict(zip(boss_columns, [
+            np.floor(b['iMJD'] + 0.3).astype(int),
+            exposure_table.iso(b['iTime']), b['iField'], b['iDesign'],
+            b['iConfig'], b['iID'], np.char.strip(b['iEType']),
+            b['iDetector'], b['idt'], b['iHart']]))
+        tables['fields'] = dict(zip(field_columns, [
+            data['dField'], exposure_table.iso(data['dTime']),
+            data['cLead'], [sorted(d) for d in data['dDesign']],
+            [sorted(c) for c in data['dConfig']],
+            list(log.design_data['dAPSummary']),
+            list(log.design_data['dBSummary'])]))
+        tables['dome_flats'] = dict(zip(dome_flat_columns, [
+            exposure_table.iso(ap['fTime']), ap['fField'], ap['fDesign'],
+            [list(m) for m in ap['fMissing']],
+            [list(f) for f in ap['fFaint']], ap['fNMissing'], ap['fNFaint'],
+            [np.nanmean(r) if np.size(r) else np.nan for r in ap['fRatio']]]))
+        tables['arcs'] = dict(zip(arc_columns, [
+            exposure_table.iso(ap['aTime']), ap['aID'], ap['aLamp'],
+            ap['aOffset']]))
+        tables['objects'] = dict(zip(object_columns, [
+            exposure_table.iso(ap['oTime']), ap['oDither'], ap['oOffset']]))
+        summary = {}
+        if 'summary' in sections:
+            summary['dust'] = log.telemetry.get('dust')
+            if len(ap['fRatio']) > 0:
+                flux_ratio = np.nanmean(np.array(list(ap['fRatio'])), axis=0)
+                missing_runs, faint_runs = apogee_data.classify_fibers(
+                    flux_ratio)
+                summary['flat_missing'] = apogee_data.format_runs(
+                    *missing_runs)
+                summary['flat_faint'] = apogee_data.format_runs(*faint_runs)
+                summary['flat_throughput'] = _scalar(np.nanmean(flux_ratio))
+        if 'data' in sections:
+            log.support.update(log.telemetry.get('hartmann'))
+            harts = log.support.get('harts', {})
+            times = log.to_time(b['hTime'])
+            moves = [hartmann_moves(harts, t) for t in times]
+            tables['hartmanns'] = dict(zip(hartmann_columns, [
+                exposure_table.iso(b['hTime']), b['hField']]
+                + [[m[i] for m in moves] for i in range(len(hartmann_keys))]))
+        if 'apogee' in sections and log.morning_filter is not None:
+            summary['morning_exposures'] = ap['iID'][log.morning_filter]
+        for table in tables.values():
+            for key, column in table.items():
+                table[key] = [_scalar(v) for v in column]
+        summary = {key: ([_scalar(v) for v in value]
+                         if isinstance(value, np.ndarray) else value)
+                   for key, value in summary.items()}
+        notes = {}
+        for key in ('offsets', 'focus', 'weather', 'hartmann'):
+            if log.support.get(key):
+                notes[key] = log.support[key]
+        return cls(log.args.sjd, tables, notes, summary, sections)
+
+    def rows(self, name):
+        """Yields each row of a table as a dictionary"""
+        table = self.tables.get(name, {})
+        keys = list(table.keys())
+        for values in zip(*table.values()):
+            yield dict(zip(keys, values))
+
+    def to_dict(self):
+        return {'sjd': self.sjd, 'tables': self.tables, 'notes': self.notes,
+                'summary': self.summary, 'sections': self.sections}
+
+    @classmethod
+    def from_dict(cls, d):
+        return cls(d['sjd'], d['tables'], d['notes'], d.get('summary'),
+                   d.get('sections'))
+
+    def by_field(self, name):
+        """The rows of a table as lists by field, in the order of the
+        table, grouped with exposure_table.GroupBy"""
+        rows = list(self.rows(name))
+        groups = exposure_table.GroupBy(
+            self.tables.get(name, {}).get('field', []))
+        return {key: [rows[i] for i in members]
+                for key, members in zip(groups.keys.tolist(), groups.members)}
+
+    def write(self, path):
+        """Writes the night log to path, with the emitter of its suffix"""
+        path = Path(path)
+        try:
+            emitter = emitters[path.suffix.lower()]
+        except KeyError:
+            raise ValueError(f"No night log format for {path.name}, use one"
+                             f" of {', '.join(emitters)}")
+        with path.open('w', newline='', buffering=2 ** 16) as fp:
+            emitter(self, fp)
+
+
+def _banner(title, fp):
+    print('=' * 80, file=fp)
+    print('{:^80}'.format(title), file=fp)
+    print('=' * 80, file=fp)
+
+
+def _write_summary(night, fp):
+    _banner('Observing Summary', fp)
+    print(f"{'Time':>8} {'Field':>6} {'Cadence':<24}"
+          f" {'APOGEE':<9} {'BOSS':<7} {'Completion':<10}", file=fp)
+    for row in night.rows('fields'):
+        print(f"{_utc(row['time']):>8} {row['field']:>6} {'':>24}"
+              f" {row['apogee']:<9} {row['boss']:<7}", file=fp)
+    print(file=fp)
+    if 'flat_throughput' in night.summary:
+        print("APOGEE Dome Flats\n"
+              f"Missing Fibers: {night.summary['flat_missing']}\n"
+              f"Faint fibers: {night.summary['flat_faint']}\n"
+              f"Average Throughput:"
+              f" {_num(night.summary['flat_throughput']):.3f}", file=fp)
+        print(file=fp)
+
+    print('### Notes:\n', file=fp)
+    dust = _num(night.summary.get('dust'))
+    print('- Integrated Dust Counts: ~{:5.0f} dust-hrs'.format(
+        dust - dust % 100), file=fp)
+    print('\n', file=fp)
+
+
+def _write_data(night, fp):
+    _banner('Data Log', fp)
+    print(file=fp)
+    apogee = night.by_field('apogee')
+    boss = night.by_field('boss')
+    flats = night.by_field('dome_flats')
+    hartmanns = night.by_field('hartmanns')
+    for field in night.tables.get('fields', {}).get('field', []):
+        print('### Field {}\n'.format(field), file=fp)
+        if field in apogee:
+            print('# APOGEE', file=fp)
+            print('{:<5} {:<8} {:>}-{:<6} {:<8} {:<12} {:<4} {:<6} {:<5}'
+                  ' {:<4}'.format('MJD', 'UTC', "Design", "Config",
+                                  'Exposure', 'Type', 'Dith', 'Reads',
+                                  'Arch', 'Seeing'), file=fp)
+            print('-' * 80, file=fp)
+            for row in apogee[field]:
+                print('{:<5.0f} {:0>8} {:>6.0f}-{:<6.0f} {:<8.0f} {:<12}'
+                      ' {:<4} {:>5} {:<5}'
+                      ' {:>4.1f}'.format(
+                          row['sjd'], _utc(row['time']), _num(row['design']),
+                          _num(row['config']), _num(row['exposure']),
+                          row['type'], row['dither'], row['reads'],
+                          row['arch'], _num(row['seeing'])), file=fp)
+            print(file=fp)
+            for row in flats.get(field, []):
+                print(row['time'], file=fp)
+                print(textwrap.fill('Missing fibers: {}'.format(
+                    row['missing']), 80), file=fp)
+                print(textwrap.fill('Faint fibers: {}'.format(
+                    row['faint']), 80), file=fp)
+                print(f"Average Throughput: {_num(row['throughput']):.2f}",
+                      file=fp)
+                print(file=fp)
+
+        if field in boss:
+            print('# BOSS', file=fp)
+            print('{:<5} {:<8} {:>6}-{:<6} {:<8} {:<7} {:<5} {:<5} {:<5}'
+                  ''.format('MJD', 'UTC', "Design", "Config", 'Exposure',
+                            'Type', 'SOS', 'ETime', 'Hart'), file=fp)
+            print('-' * 80, file=fp)
+            for row in boss[field]:
+                try:
+                    print('{:<5.0f} {:0>8} {:>6.0f}-{:<6.0f} {:0>8.0f} {:<7}'
+                          ' {:<5} {:>5.0f} {:<5}'.format(
+                              row['sjd'], _utc(row['time']),
+                              _num(row['design']), _num(row['config']),
+                              _num(row['exposure']), row['type'], row['sos'],
+                              _num(row['exp_time']), row['hartmann']),
+                          file=fp)
+                except Exception:
+                    print(row['sjd'], _utc(row['time']), file=fp)
+            for row in hartmanns.get(field, []):
+                moves = [_num(row[key]) for key in hartmann_columns[2:]]
+                print(f"{row['time'][:19].replace(' ', 'T')}\n"
+                      f"r1 Steps: {moves[0]:>5.0f}, b1 Ring: {moves[1]:>4.1f}\n"
+                      f"Average Move:{moves[2]:>5.0f}, Residuals:"
+                      f" {moves[3]:>4.1f}, Temp: {moves[4]:>4.1f}\n", file=fp)
+            print(file=fp)
+
+
+def _write_boss(night, fp):
+    _banner('BOSS Data Summary', fp)
+    print(file=fp)
+    print('{:<5} {:<8} {:<20} {:<8} {:<7} {:<5} {:<5} {:<5}'
+          ''.format('MJD', 'UTC', 'Field-Design-Config', 'Exposure', 'Type',
+                    'SOS', 'ETime', 'Hart'), file=fp)
+    print('-' * 80, file=fp)
+    for row in night.rows('boss'):
+        try:
+            print('{:<5.0f} {:>8} {:>6.0f}-{:>6}-{:<6.0f} {:0>8.0f} {:<7}'
+                  ' {:<5} {:>5.0f} {:<5}'.format(
+                      row['sjd'], _utc(row['time']), _num(row['field']),
+                      _num(row['design']), _num(row['config']),
+                      _num(row['exposure']), row['type'], row['sos'],
+                      _num(row['exp_time']), row['hartmann']), file=fp)
+        except TypeError:
+            continue
+    print(file=fp)
+
+
+def _write_apogee(night, fp):
+    _banner('APOGEE Data Summary', fp)
+    print(file=fp)
+    print('{:<5} {:<8} {:<20} {:<8} {:<12} {:<4} {:<5} {:<5}'
+          ''.format('MJD', 'UTC', ' Field-Design-Config', 'Exposure', 'Type',
+                    'Dith', 'Reads', 'Arch'), file=fp)
+    print('-' * 80, file=fp)
+    morning = night.summary.get('morning_exposures')
+    for row in night.rows('apogee'):
+        if morning is not None and row['exposure'] not in morning:
+            continue
+        print('{:<5.0f} {:>8} {:>6.0f}-{:>6.0f}-{:<6.0f} {:<8.0f} {:<12} {:<4}'
+              ' {:>5} {:<5}'.format(
+                  row['sjd'], _utc(row['time']), _num(row['field']),
+                  _num(row['design']), _num(row['config']),
+                  _num(row['exposure']), row['type'], row['dither'],
+                  row['reads'], row['arch']), file=fp)
+
+    # Usually, there are 4 ThAr and 4 UNe arcs in a night, and they're
+    # assumed to be alternating ThAr UNe ThAr UNe. The offsets of each lamp
+    # are differenced, since only the diffs between two dithers taken back to
+    # back matter.
+    wrapper = textwrap.TextWrapper(80)
+    arcs = night.tables.get('arcs', {})
+    for lamp in ('ThAr', 'UNe'):
+        offsets = np.array([_num(offset) for offset, arc_lamp in zip(
+            arcs.get('offset', []), arcs.get('lamp', [])) if arc_lamp == lamp],
+            dtype=float)
+        print('\n'.join(wrapper.wrap('{} Offsets: {}'.format(
+            lamp, ['{:.2f}'.format(f) for f in np.diff(offsets)]))), file=fp)
+    objects = night.tables.get('objects', {})
+    offsets = np.array([_num(o) for o in objects.get('offset', [])],
+                       dtype=float)
+    if len(offsets) > 1:
+        # Put it under an if in case we didn't open.
+        dithers = np.array(objects['dither'])
+        did_move = dithers[:-1] != dithers[1:]
+        rel_offsets = np.abs(offsets[1:][did_move] - offsets[:-1][did_move])
+        obj_str = ('Object Offsets: Max: {:.2f}, Min: {:.2f}, Mean: {:.2f}'
+                   ''.format(np.nanmax(rel_offsets), np.nanmin(rel_offsets),
+                             np.nanmean(rel_offsets)))
+        print('\n'.join(wrapper.wrap(obj_str)), file=fp)
+    print('\n', file=fp)
+
+
+_text_writers = {'summary': _write_summary, 'data': _write_data,
+                 'apogee': _write_apogee, 'boss': _write_boss}
+
+
+def write_text(night, fp):
+    """Writes the text sections of night.sections, as sloan_log.py prints
+    them"""
+    for name in night.sections:
+        _text_writers[name](night, fp)
+
+
+def write_json(night, fp):
+    """Streams the whole night log as one JSON document"""
+    encoder = json.JSONEncoder(default=_plain)
+    for chunk in encoder.iterencode(night.to_dict()):
+        fp.write(chunk)
+    fp.write('\n')
+
+
+def write_csv(night, fp):
+    """Writes the APOGEE and BOSS exposures as one CSV table, with an
+    instrument column and the union of their columns"""
+    columns = ['instrument'] + apogee_columns + [
+        c for c in boss_columns if c not in apogee_columns]
+    writer = csv.writer(fp)
+    writer.writerow(columns)
+    for instrument in ('apogee', 'boss'):
+        for row in night.rows(instrument):
+            row['instrument'] = instrument
+            writer.writerow([_cell(row.get(c, '')) for c in columns])
+
+
+def write_html(night, fp):
+    """Writes every table and note as a standalone HTML page"""
+    fp.write('<!DOCTYPE html>\n<html>\n<head>\n<meta charset="utf-8">\n'
+             f'<title>SJD {night.sjd} Night Log</title>\n'
+             '<style>table {border-collapse: collapse;} td, th {border:'
+             ' 1px solid #999; padding: 2px 6px;}</style>\n'
+             f'</head>\n<body>\n<h1>SJD {night.sjd} Night Log</h1>\n')
+    for name, table in night.tables.items():
+        fp.write(f'<h2>{html.escape(name.replace("_", " ").title())}</h2>\n'
+                 '<table>\n<tr>')
+        fp.write(''.join(f'<th>{html.escape(key)}</th>' for key in table))
+        fp.write('</tr>\n')
+        for row in night.rows(name):
+            fp.write('<tr>' + ''.join(f'<td>{html.escape(_cell(v))}</td>'
+                                      for v in row.values()) + '</tr>\n')
+        fp.write('</table>\n')
+    if night.summary:
+        fp.write('<h2>Summary</h2>\n<table>\n')
+        for key, value in night.summary.items():
+            fp.write(f'<tr><th>{html.escape(key)}</th>'
+                     f'<td>{html.escape(_cell(value))}</td></tr>\n')
+        fp.write('</table>\n')
+    for name, text in night.notes.items():
+        fp.write(f'<h2>{html.escape(name.title())}</h2>\n'
+                 f'<pre>{html.escape(str(text))}</pre>\n')
+    fp.write('</body>\n</html>\n')
+
+
+emitters = {'.txt': write_text, '.json': write_json, '.csv': write_csv,
+            '.html': write_html}
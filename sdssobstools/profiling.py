@@ -0,0 +1,126 @@
+#!/usr/bin/env python3
+"""
+Named timing spans for sloan_log.py --profile. A span records the wall time
+ of a block and any counts the block adds to it (files read, bytes, rows
+ returned by a query), and spans nest, so the report shows which part of a
+ stage is slow. Profiling is off unless enable is called, and then span costs
+ no more than an empty with statement.
+
+profiling.enable()
+with profiling.span('parse_images') as counts:
+    counts['files'] = len(images)
+profiling.report()  # To stderr
+profiling.write_trace('sloan_log.json')  # For chrome://tracing or Perfetto
+
+A whole function can be timed by decorating it with traced('name').
+"""
+import contextlib
+import functools
+import json
+import os
+import sys
+import threading
+import time
+
+from pathlib import Path
+
+__version__ = '3.0.0'
+
+spans = []
+_enabled = False
+_local = threading.local()  # The depth of nesting in each thread
+
+
+def enable():
+    global _enabled
+    _enabled = True
+
+
+def disable():
+    global _enabled
+    _enabled = False
+
+
+def enabled():
+    return _enabled
+
+
+def clear():
+    spans.clear()
+    _local.depth = 0
+
+
+@contextlib.contextmanager
+def span(name):
+    """Times the block inside it as name, and yields a dictionary of counts
+    for the block to fill in. Spans made in other threads nest among
+    themselves"""
+    if not _enabled:
+        yield {}
+        return
+    depth = getattr(_local, 'depth', 0)
+    rec = {'name': name, 'pid': os.getpid(), 'tid': threading.get_native_id(),
+           'depth': depth, 'start': time.perf_counter(), 'wall': 0.,
+           'counts': {}}
+    spans.append(rec)
+    _local.depth = depth + 1
+    try:
+        yield rec['counts']
+    finally:
+        _local.depth = depth
+        rec['wall'] = time.perf_counter() - rec['start']
+
+
+def traced(name):
+    """Decorates a function so that each call is timed as a span of name"""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with span(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def totals():
+    """The sum of each count over every span"""
+    out = {}
+    for rec in spans:
+        for key, n in rec['counts'].items():
+            out[key] = out.get(key, 0) + n
+    return out
+
+
+def report(fp=None):
+    """Prints every span in the order they started, indented by how deeply
+    they are nested, with their counts, and then the total counts"""
+    fp = sys.stderr if fp is None else fp
+    print(f"{'Span':<40} {'Seconds':>8}  Counts", file=fp)
+    print('-' * 80, file=fp)
+    for rec in sorted(spans, key=lambda s: s['start']):
+        name = '  ' * rec['depth'] + rec['name']
+        counts = ' '.join(f"{k}={v}" for k, v in rec['counts'].items())
+        print(f"{name:<40} {rec['wall']:>8.3f}  {counts}", file=fp)
+    counts = totals()
+    if counts:
+        print('-' * 80, file=fp)
+        print(f"{'Total':<40} {'':>8}  "
+              + ' '.join(f"{k}={v}" for k, v in counts.items()), file=fp)
+
+
+def trace():
+    """The spans as a Chrome trace event dictionary, in microseconds since
+    the first span started"""
+    t0 = min((s['start'] for s in spans), default=0)
+    events = [{'name': s['name'], 'ph': 'X', 'pid': s['pid'],
+               'tid': s.get('tid', 0),
+               'ts': round((s['start'] - t0) * 1e6, 1),
+               'dur': round(s['wall'] * 1e6, 1), 'args': s['counts']}
+              for s in spans]
+    return {'traceEvents': events, 'displayTimeUnit': 'ms',
+            'otherData': {'totals': totals()}}
+
+
+def write_trace(path):
+    with Path(path).open('w') as fp:
+        json.dump(trace(), fp)
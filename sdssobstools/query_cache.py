@@ -0,0 +1,173 @@
+#!/usr/bin/env python3
+"""
+An on-disk cache of the results of influx_fetch.query, so that rebuilding the
+ log of a past night doesn't query InfluxDB again. Each result is a file in
+ the cache directory named by a hash of the Flux script and its window, which
+ holds its tables column by column as gzipped JSON. Times are stored as
+ integer microseconds, and a column with one value in every row is stored
+ once.
+
+The arrays of influx_fetch.query_arrays and query_merged are stored as
+ compressed .npz files instead, one array of times and one of values for each
+ field.
+
+A window that ended more than immutable_minutes before its result was written
+ can't change, so it is kept for good. A more recent window may still be
+ getting data, so its result is only used for ttl seconds.
+
+cache = QueryCache()
+key = cache.key(rendered_script, start.isot, end.isot, interval, 'tables')
+tables = cache.get(key, end.unix)  # None if missing or expired
+cache.put(key, tables)
+"""
+import datetime
+import gzip
+import hashlib
+import json
+import os
+import tempfile
+import time
+
+import numpy as np
+
+from pathlib import Path
+
+from sdssobstools import exposure_cache
+
+__version__ = '3.0.0'
+
+default_dir = exposure_cache.default_dir / "influx"
+immutable_minutes = 30
+ttl = 60  # Seconds
+
+_epoch = datetime.datetime(1970, 1, 1, tzinfo=datetime.timezone.utc)
+
+
+def encode_tables(tables):
+    """A list of FluxTables as a list of dictionaries of columns, for json"""
+    out = []
+    for table in tables:
+        names = []
+        for record in table.records:
+            for name in record.values:
+                if name not in names:
+                    names.append(name)
+        columns = {}
+        times = []
+        for name in names:
+            column = [record.values.get(name) for record in table.records]
+            if any(isinstance(v, datetime.datetime) for v in column):
+                times.append(name)
+                column = [None if v is None
+                          else (v - _epoch) // datetime.timedelta(
+                              microseconds=1) for v in column]
+            if len(column) > 1 and all(v == column[0] for v in column):
+                column = {'repeat': column[0]}
+            columns[name] = column
+        out.append({'rows': len(table.records), 'columns': columns,
+                    'times': times})
+    return out
+
+
+def decode_tables(encoded):
+    """The TableList of FluxTables that encode_tables was given"""
+    from influxdb_client.client.flux_table import (FluxRecord, FluxTable,
+                                                   TableList)
+    tables = TableList()
+    for i, enc in enumerate(encoded):
+        table = FluxTable()
+        columns = {}
+        for name, column in enc['columns'].items():
+            if isinstance(column, dict):
+                column = [column['repeat']] * enc['rows']
+            if name in enc['times']:
+                column = [None if v is None
+                          else _epoch + datetime.timedelta(microseconds=v)
+                          for v in column]
+            columns[name] = column
+        for row in range(enc['rows']):
+            table.records.append(FluxRecord(
+                i, {name: column[row] for name, column in columns.items()}))
+        tables.append(table)
+    return tables
+
+
+def write_arrays(fil, arrays):
+    """Writes a dictionary of (times, values) arrays by field, or by a tuple
+    such as (measurement, field), to fil as an .npz file"""
+    out = {'fields': np.array([list(field) if isinstance(field, tuple)
+                               else field for field in arrays], dtype=str)}
+    for i, (times, values) in enumerate(arrays.values()):
+        out[f"t{i}"] = times
+        out[f"v{i}"] = values
+    np.savez_compressed(fil, **out)
+
+
+def read_arrays(fil):
+    with np.load(fil, allow_pickle=False) as npz:
+        return {(tuple(str(f) for f in field) if np.ndim(field)
+                 else str(field)): (npz[f"t{i}"], npz[f"v{i}"])
+                for i, field in enumerate(npz['fields'])}
+
+
+class QueryCache:
+    """Query results stored in <cache_dir>/<sha256 of the query>.json.gz, or
+    .npz for arrays"""
+
+    def __init__(self, cache_dir=default_dir):
+        self.dir = Path(cache_dir)
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def key(flux_script, start, stop, interval, kind='tables'):
+        """The key of a rendered Flux script, the start, stop, and
+        windowPeriod it was rendered with, and the kind of result, tables or
+        arrays"""
+        text = '\n'.join([flux_script, str(start), str(stop), str(interval),
+                          kind])
+        return hashlib.sha256(text.encode()).hexdigest()
+
+    def path(self, key, kind='tables'):
+        if kind.startswith('arrays'):
+            return self.dir / f"{key}.npz"
+        return self.dir / f"{key}.json.gz"
+
+    def get(self, key, stop, kind='tables'):
+        """The result cached for key, a window that ends at the unix time
+        stop, or None if it isn't cached or has expired"""
+        path = self.path(key, kind)
+        try:
+            written = path.stat().st_mtime
+            if (stop > written - immutable_minutes * 60
+                    and time.time() - written > ttl):
+                self.misses += 1
+                return None
+            if kind.startswith('arrays'):
+                result = read_arrays(path)
+            else:
+                with gzip.open(path, 'rt') as fil:
+                    result = decode_tables(json.load(fil))
+        except (OSError, ValueError, KeyError):
+            self.misses += 1
+            return None
+        self.hits += 1
+        return result
+
+    def put(self, key, result, kind='tables'):
+        """Caches result for key. The file is written under another name and
+        then moved into place, so a reader never sees part of one"""
+        self.dir.mkdir(parents=True, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=self.dir, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as raw:
+                if kind.startswith('arrays'):
+                    write_arrays(raw, result)
+                else:
+                    with gzip.open(raw, 'wt') as fil:
+                        json.dump(encode_tables(result), fil,
+                                  separators=(',', ':'))
+            os.replace(tmp, self.path(key, kind))
+        except BaseException:
+            Path(tmp).unlink(missing_ok=True)
+            raise
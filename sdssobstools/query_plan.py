@@ -0,0 +1,290 @@
+#!/usr/bin/env python3
+"""
+Merges InfluxDB queries that only differ in what they filter, so that the
+ sections of LogSupport share one round trip instead of making one each. A
+ Flux script is split around its filter stage:
+
+import "regexp"
+from(bucket: "actors")
+    |> range(start: v.timeRangeStart, stop: v.timeRangeStop)   <- head
+    |> filter(fn: (r) => ...)                                    <- predicate
+    |> aggregateWindow(every:v.windowPeriod, fn:last, createEmpty: false)
+    |> yield()                                                   <- tail
+
+Requests with the same head, tail, window, and windowPeriod are a group, and
+ the group is one query that filters on all of their predicates joined with
+ or, so a series that several of them want is only sent once. Each series of
+ the result is given to every request whose predicate matches its
+ _measurement and _field, which is evaluated here. Predicates can only use
+ those two columns, with ==, !=, =~, !~, regexp.matchRegexpString, and, or,
+ and not. A script with any other predicate, or with more than one filter, is
+ a group of its own.
+
+requests = [Request(script, start, end, '1m', lower=True), ...]
+for group in plan(requests):
+    arrays = ...  # group.flux_script's arrays by (measurement, field)
+    for i, section in zip(group.members, demux(group, arrays)):
+        ...  # section is request i's arrays by field
+"""
+import collections
+import re
+
+import numpy as np
+
+__version__ = '3.0.0'
+
+# resolution and max_points are given to influx_fetch.window_period when
+# interval is "auto"
+Request = collections.namedtuple(
+    'Request', ['flux_script', 'start', 'end', 'interval', 'lower',
+                'resolution', 'max_points'],
+    defaults=['1s', False, None, None])
+
+_filter = re.compile(r'\|>\s*filter\s*\(\s*fn\s*:\s*\(\s*r\s*\)\s*=>')
+_token = re.compile(r'\s*(?:(?P<string>"(?:\\.|[^"\\])*")'
+                    r'|(?P<regex>/(?:\\.|[^/\\])*/)'
+                    r'|(?P<op>==|!=|=~|!~|[(),:])'
+                    r'|(?P<name>[A-Za-z_][\w.]*))')
+_columns = ('r._measurement', 'r._field')
+
+
+def split(flux_script):
+    """The head, predicate, and tail of flux_script, or None if it doesn't
+    have exactly one filter stage"""
+    starts = list(_filter.finditer(flux_script))
+    if len(starts) != 1:
+        return None
+    depth = 1
+    in_string = False
+    i = starts[0].end()
+    while i < len(flux_script):
+        c = flux_script[i]
+        if in_string:
+            if c == '\\':
+                i += 1
+            elif c == '"':
+                in_string = False
+        elif c == '"':
+            in_string = True
+        elif c == '(':
+            depth += 1
+        elif c == ')':
+            depth -= 1
+            if depth == 0:
+                break
+        i += 1
+    else:
+        return None
+    return (flux_script[:starts[0].start()],
+            flux_script[starts[0].end():i].strip(), flux_script[i + 1:])
+
+
+def tokenize(expr):
+    """The (kind, text) tokens of a Flux predicate"""
+    tokens = []
+    pos = 0
+    while expr[pos:].strip():
+        match = _token.match(expr, pos)
+        if match is None:
+            raise ValueError(f"Can't read a predicate at {expr[pos:]!r}")
+        tokens.append((match.lastgroup, match.group(match.lastgroup)))
+        pos = match.end()
+    return tokens
+
+
+class _Parser:
+    """A recursive descent parser of the predicates that predicate reads,
+    where and binds tighter than or, as in Flux"""
+
+    def __init__(self, expr):
+        self.tokens = tokenize(expr)
+        self.i = 0
+
+    def peek(self):
+        return self.tokens[self.i] if self.i < len(self.tokens) else (None,
+                                                                      None)
+
+    def take(self, kind=None, text=None):
+        token = self.peek()
+        if (token[0] is None or (kind is not None and token[0] != kind)
+                or (text is not None and token[1] != text)):
+            raise ValueError(f"Expected {text or kind}, found {token[1]}")
+        self.i += 1
+        return token[1]
+
+    def parse(self):
+        func = self.either()
+        if self.i != len(self.tokens):
+            raise ValueError(f"Unexpected {self.peek()[1]}")
+        return func
+
+    def either(self):
+        funcs = [self.both()]
+        while self.peek() == ('name', 'or'):
+            self.take()
+            funcs.append(self.both())
+        if len(funcs) == 1:
+            return funcs[0]
+        return lambda cols: any(f(cols) for f in funcs)
+
+    def both(self):
+        funcs = [self.negation()]
+        while self.peek() == ('name', 'and'):
+            self.take()
+            funcs.append(self.negation())
+        if len(funcs) == 1:
+            return funcs[0]
+        return lambda cols: all(f(cols) for f in funcs)
+
+    def negation(self):
+        if self.peek() == ('name', 'not'):
+            self.take()
+            func = self.negation()
+            return lambda cols: not func(cols)
+        return self.term()
+
+    def term(self):
+        if self.peek() == ('op', '('):
+            self.take()
+            func = self.either()
+            self.take('op', ')')
+            return func
+        name = self.take('name')
+        if name == 'regexp.matchRegexpString':
+            self.take('op', '(')
+            kwargs = {}
+            while True:
+                key = self.take('name')
+                self.take('op', ':')
+                kwargs[key] = self.value()
+                if self.peek() != ('op', ','):
+                    break
+                self.take()
+            self.take('op', ')')
+            if set(kwargs) != {'r', 'v'} or kwargs['v'][0] != 'column':
+                raise ValueError("Can't evaluate matchRegexpString on"
+                                 f" {kwargs.get('v')}")
+            return self.compare(kwargs['v'][1], '=~', kwargs['r'])
+        if name not in _columns:
+            raise ValueError(f"Can't evaluate a predicate on {name}")
+        op = self.take('op')
+        if op not in ('==', '!=', '=~', '!~'):
+            raise ValueError(f"Unexpected {op}")
+        return self.compare(name, op, self.value())
+
+    def value(self):
+        """The next string, regex, or column, as (kind, value)"""
+        kind, text = self.peek()
+        self.take()
+        if kind == 'string':
+            return kind, text[1:-1].replace('\\"', '"').replace('\\\\', '\\')
+        if kind == 'regex':
+            try:
+                return kind, re.compile(text[1:-1].replace('\\/', '/'))
+            except re.error as e:
+                raise ValueError(f"Can't compile {text}: {e}")
+        if text in _columns:
+            return 'column', text
+        raise ValueError(f"Can't evaluate a predicate on {text}")
+
+    @staticmethod
+    def compare(column, op, value):
+        kind, value = value
+        column = column[2:]
+        if op in ('=~', '!~'):
+            if kind != 'regex':
+                raise ValueError(f"{op} needs a regex")
+            return lambda cols: (value.search(cols[column])
+                                 is not None) == (op == '=~')
+        if kind != 'string':
+            raise ValueError(f"{op} needs a string")
+        return lambda cols: (cols[column] == value) == (op == '==')
+
+
+def predicate(expr):
+    """A function of a dictionary with _measurement and _field that is True
+    where the Flux predicate expr is. Raises ValueError for a predicate it
+    can't evaluate"""
+    return _Parser(expr).parse()
+
+
+class Group:
+    """Requests that run as one query, flux_script from start to end with a
+    windowPeriod of interval. members are their indices in the list given to
+    plan, and predicates are their predicate functions, or None to take every
+    series"""
+
+    def __init__(self, request, parts):
+        self.flux_script = request.flux_script
+        self.start = request.start
+        self.end = request.end
+        self.interval = request.interval
+        self.parts = parts
+        self.members = []
+        self.requests = []
+        self.predicates = []
+        self.exprs = []
+
+    def add(self, i, request, func, expr):
+        self.members.append(i)
+        self.requests.append(request)
+        self.predicates.append(func)
+        self.exprs.append(expr)
+        if len(self.members) > 1:
+            head, _, tail = self.parts
+            self.flux_script = (
+                f"{head}|> filter(fn: (r) => "
+                + "\n        or ".join(f"({e})" for e in self.exprs)
+                + f"){tail}")
+
+
+def _normal(text):
+    return ' '.join(text.split())
+
+
+def plan(requests):
+    """The Groups that requests can be merged into, in the order of their
+    first members. A group of one request keeps its script as it was"""
+    groups = {}
+    for i, request in enumerate(requests):
+        parts = split(request.flux_script)
+        func = None
+        if parts is not None:
+            try:
+                func = predicate(parts[1])
+            except ValueError:
+                pass
+        if func is None:
+            key = i
+        else:
+            key = (_normal(parts[0]), _normal(parts[2]), request.start.isot,
+                   request.end.isot, request.interval)
+        if key not in groups:
+            groups[key] = Group(request, parts)
+        groups[key].add(i, request, func,
+                        None if parts is None else parts[1])
+    return list(groups.values())
+
+
+def demux(group, arrays):
+    """Splits the arrays of group's query, (times, values) by (measurement,
+    field), into the arrays of each of its requests by field, as
+    influx_fetch.query_arrays would have made them, lowercase if the request
+    is lower"""
+    out = []
+    for request, func in zip(group.requests, group.predicates):
+        section = {}
+        for (measurement, field), (times, values) in arrays.items():
+            if func is not None and not func({'_measurement': measurement,
+                                              '_field': field}):
+                continue
+            if request.lower:
+                field = field.lower()
+            if field in section:
+                section[field] = (
+                    np.concatenate([section[field][0], times]),
+                    np.concatenate([section[field][1], values]))
+            else:
+                section[field] = (times, values)
+        out.append(section)
+    return out
@@ -1,23 +1,30 @@
 #!/usr/bin/env python3
 
+import os
+
 from pathlib import Path
 
-data_path = Path("/data/")  # For hub/normal computers
-if not data_path.exists():
-    data_path = Path("/data_hub/")  # For obs1 and obs2
+if "SDSS_DATA" in os.environ:  # For fake data, see synthetic_night.py
+    data_path = Path(os.environ["SDSS_DATA"])
+else:
+    data_path = Path("/data/")  # For hub/normal computers
     if not data_path.exists():
-        data_path = Path("/Volumes/data/")  # For sdss-obs3
-        if not data_path.exists(): 
-            data_path = Path.home() / "data/"  # For testing, usually on a Mac
+        data_path = Path("/data_hub/")  # For obs1 and obs2
+        if not data_path.exists():
+            data_path = Path("/Volumes/data/")  # For sdss-obs3
             if not data_path.exists():
-                raise FileNotFoundError("Cannot find the SDSS data directory")
-else:
-    ap_utr: Path = data_path / "apogee/utr_cdr"
-    try:
-        ap_utr.exists()
-    except PermissionError:  # This happens on obs1/2 with /data_hub, even
-        # though /data exists, it cannot be read.
-        data_path = Path("/data_hub/")
+                # For testing, usually on a Mac
+                data_path = Path.home() / "data/"
+                if not data_path.exists():
+                    raise FileNotFoundError(
+                        "Cannot find the SDSS data directory")
+    else:
+        ap_utr: Path = data_path / "apogee/utr_cdr"
+        try:
+            ap_utr.exists()
+        except PermissionError:  # This happens on obs1/2 with /data_hub, even
+            # though /data exists, it cannot be read.
+            data_path = Path("/data_hub/")
 
 ap_utr: Path = data_path / "apogee/utr_cdr"
 ap_archive: Path = data_path / "apogee/archive"
@@ -31,3 +38,42 @@ fsc: Path = data_path / "fsc"
 fvc: Path = data_path / "fcam"
 mcp_logs: Path = data_path / "logs/mcp"
 logs: Path = data_path / "logs"
+
+# Names of the files in each directory listed with dir_listing, so that
+# checking if many files exist costs one scandir per directory instead of one
+# stat per file, which adds up quickly over NFS
+_listings = {}
+
+
+def _scandir(path):
+    with os.scandir(path) as it:
+        return {entry.name for entry in it}
+
+
+def dir_listing(path):
+    """Returns a set of the names in the directory path, from a single
+    os.scandir that is reused until refresh_listings is called. A directory
+    that doesn't exist (yet) has no names."""
+    path = Path(path)
+    if path not in _listings:
+        try:
+            names = _scandir(path)
+        except (FileNotFoundError, NotADirectoryError):
+            names = set()
+        except OSError:  # Stale NFS handles usually work the second time
+            names = _scandir(path)
+        _listings[path] = names
+    return _listings[path]
+
+
+def exists(path):
+    """A drop-in for Path.exists that looks in the cached listing of the
+    parent directory"""
+    path = Path(path)
+    return path.name in dir_listing(path.parent)
+
+
+def refresh_listings():
+    """Forgets every cached listing, so the next exists call lists its
+    directory again"""
+    _listings.clear()
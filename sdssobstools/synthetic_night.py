@@ -0,0 +1,248 @@
+#!/usr/bin/env python3
+"""
+Writes a fake night of APOGEE and BOSS data into a directory laid out like
+ sdss_paths (apogee/archive, apogee/quickred, spectro, and boss/sos), so that
+ sloan_log.py can be tested and benchmarked away from /data. Point sdss_paths
+ at it with the SDSS_DATA environment variable.
+
+The night is a series of fields, each with a dome flat, a ThAr and an UNe arc,
+ and four object exposures alternating A and B dithers, and it ends with two
+ 60 read darks and a pair of arcs for the morning cals. Every APOGEE exposure
+ has apR-[abc] archive files, every BOSS exposure an sdR-r1 .fit.gz file and
+ splog stubs. A few detectors and SOS reductions are left out on purpose.
+
+Quickred files are 300x2048 images, so only one is written per exposure type
+ and dither and the rest are hard links to it, which keeps a 10k exposure
+ night to a few hundred MB. Dome flats are the exception, there are
+ flat_variants of them, each with its own dead and faint fibers, and the
+ flats of the night cycle through them so that no two in a row are the same.
+"""
+import argparse
+import gzip
+import os
+import shutil
+
+import numpy as np
+import fitsio
+
+from pathlib import Path
+
+__version__ = '3.0.0'
+
+master_flat_path = Path(__file__).parent.parent / 'dat/master_dome_flat.fits.gz'
+first_exp_id = 40000000
+first_field = 100001
+# A night at APO is from about 02:00Z to 11:00Z, or MJD sjd + 0.08 to 0.46
+night_start = 0.08
+night_length = 0.38
+flat_variants = 8
+
+# Cards that are in real headers but not used by sloan_log, so that reading a
+# header costs about as much as it does on real data
+apogee_filler = {
+    'TELESCOP': 'SDSS 2-5m', 'INSTRUME': 'APOGEE', 'OBSERVER': 'Observer',
+    'LAMPQRTZ': False, 'LAMPTHAR': False, 'LAMPUNE': False, 'FFS': '0 0 0 0',
+    'SHUTTER': 'Open', 'RA': 180.0, 'DEC': 30.0, 'ALT': 70.0, 'AZ': 120.0,
+    'IPA': 10.0, 'FOCUS': 1400.0, 'COLLPIST': 8000.0, 'COLLPITC': 0.0,
+    'COLLYAW': 0.0, 'ARCOFFX': 0.0, 'ARCOFFY': 0.0, 'CALOFFX': 0.0,
+    'CALOFFY': 0.0, 'GUIDOFFX': 0.0, 'GUIDOFFY': 0.0, 'GUIDOFFR': 0.0,
+    'AIRTEMP': 10.0, 'DEWPOINT': -5.0, 'HUMIDITY': 30.0, 'PRESSURE': 21.6,
+    'WINDD': 200.0, 'WINDS': 5.0, 'DUSTA': 100.0, 'DUSTB': 50.0,
+    'BLUETEMP': 78.0, 'GREENTEMP': 78.0, 'REDTEMP': 78.0,
+}
+boss_filler = {
+    'TELESCOP': 'SDSS 2-5m', 'CAMERAS': 'r1', 'OBSERVER': 'Observer',
+    'FF': '0 0 0 0', 'NE': '0 0 0 0', 'HGCD': '0 0 0 0', 'FFS': '0 0 0 0',
+    'RA': 180.0, 'DEC': 30.0, 'RADEG': 180.0, 'DECDEG': 30.0,
+    'ALT': 70.0, 'AZ': 120.0, 'IPA': 10.0, 'FOCUS': 1400.0,
+    'M1PISTON': 0.0, 'M1XTILT': 0.0, 'M1YTILT': 0.0, 'M2PISTON': 1500.0,
+    'M2XTILT': 0.0, 'M2YTILT': 0.0, 'COLLA': 1000, 'COLLB': 1000,
+    'COLLC': 1000, 'MC1TEMDN': 10.0, 'MC1HUMHT': 20.0, 'MC1HUMCO': 20.0,
+    'MC1TBCB': 10.0, 'MC1TBCT': 10.0, 'MC1TRCB': 10.0, 'MC1TRCT': 10.0,
+    'AIRTEMP': 10.0, 'DEWPOINT': -5.0, 'HUMIDITY': 30.0, 'PRESSURE': 21.6,
+    'WINDD': 200.0, 'WINDS': 5.0, 'DUSTA': 100.0, 'DUSTB': 50.0,
+    'GAINA': 1.0, 'GAINB': 1.0, 'GAINC': 1.0, 'GAIND': 1.0,
+    'RDNOISEA': 3.0, 'RDNOISEB': 3.0, 'RDNOISEC': 3.0, 'RDNOISED': 3.0,
+}
+
+
+def schedule(n_exposures):
+    """Returns the exposure type of each exposure of the night, and the
+    index of its field"""
+    kinds = []
+    fields = []
+    n_morning = 4 if n_exposures >= 11 else 0
+    block = ['Domeflat', 'ThAr', 'UNe', 'Object', 'Object', 'Object',
+             'Object']
+    for i in range(n_exposures - n_morning):
+        kinds.append(block[i % len(block)])
+        fields.append(i // len(block))
+    kinds += ['Dark', 'Dark', 'ThAr', 'UNe'][:n_morning]
+    fields += [fields[-1] if fields else 0] * n_morning
+    return kinds, fields
+
+
+def date_obs(sjd, i, n_exposures):
+    mjd = sjd + night_start + night_length * i / max(n_exposures, 1)
+    t = (np.datetime64('1858-11-17', 'ms')
+         + np.timedelta64(int(round(mjd * 86400e3)), 'ms'))
+    return np.datetime_as_string(t, unit='ms')
+
+
+def header_list(cards):
+    return [{'name': key, 'value': value} for key, value in cards.items()]
+
+
+def quickred_image(kind, dither, master_col, rng):
+    """A 300x2048 quickred image of a dome flat with four dead and two faint
+    fibers picked by rng, or of a single line for an arc or object, shifted
+    by dither"""
+    x = np.arange(2048)
+    image = rng.normal(100, 1, (300, 2048)).astype('f4')
+    if kind == 'Domeflat':
+        image[:] = master_col[:, None] * (1 + rng.normal(0, 0.01, (300, 2048)))
+        rows = rng.choice(300, 6, replace=False)
+        image[rows[:4]] *= 0.1
+        image[rows[4:]] *= 0.5
+        return image
+    shift = 0.3 if dither == 'B' else -0.2
+    center = {'ThAr': 1105, 'UNe': 1190, 'Object': 1100}[kind] + shift
+    width = {'ThAr': 1.27, 'UNe': 3, 'Object': 2}[kind]
+    image += 5000 * np.exp(-0.5 * ((x - center) / width) ** 2)
+    return image
+
+
+def write_quickred(path, image):
+    table = np.zeros(1, dtype=[('FLUX', 'f4', image.shape)])
+    table['FLUX'][0] = image
+    with fitsio.FITS(path.as_posix(), 'rw', clobber=True) as fits:
+        fits.write(None)
+        fits.write(np.zeros(2))
+        fits.write(np.zeros(2))
+        fits.write(table)
+
+
+def link_or_copy(src, dst):
+    if dst.exists():
+        dst.unlink()
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copy(src, dst)
+
+
+def write_night(root, sjd, n_exposures, seed=1, quickred=True,
+                boss_shape=(64, 64)):
+    """Writes a fake night of n_exposures APOGEE and n_exposures BOSS
+    exposures under root, and returns a dictionary of the numbers of files
+    written of each type"""
+    root = Path(root)
+    rng = np.random.default_rng(seed)
+    archive = root / f"apogee/archive/{sjd}"
+    quickred_dir = root / f"apogee/quickred/{sjd}"
+    spectro = root / f"spectro/{sjd}"
+    sos = root / f"boss/sos/{sjd}"
+    for directory in (archive, quickred_dir, spectro, sos):
+        directory.mkdir(parents=True, exist_ok=True)
+    master_col = np.median(fitsio.read(master_flat_path.as_posix())[:, 550:910],
+                           axis=1)
+    kinds, field_indices = schedule(n_exposures)
+    templates = {}
+    n_flats = 0
+    field_start = 0
+    counts = {'apR': 0, 'apq': 0, 'sdR': 0, 'splog': 0}
+    for i, (kind, field_i) in enumerate(zip(kinds, field_indices)):
+        exp_id = first_exp_id + i
+        obs_time = date_obs(sjd, i, n_exposures)
+        field = first_field + field_i
+        design = 9000 + field_i
+        config = 5000 + field_i
+        dither = 'B' if i % 2 else 'A'
+        n_read = 60 if kind == 'Dark' else 47
+        ap_cards = dict(apogee_filler)
+        ap_cards.update({
+            'DITHPIX': 13.494 if dither == 'B' else 12.994,
+            'EXPTIME': n_read * 10.6, 'DATE-OBS': obs_time,
+            'FIELDID': str(field), 'PLATEID': 0, 'CONFIGID': config,
+            'DESIGNID': design, 'CARTID': 'FPS-N',
+            'EXPTYPE': {'ThAr': 'ARCLAMP', 'UNe': 'ARCLAMP'}.get(
+                kind, kind.upper()),
+            'LAMPUNE': kind == 'UNe', 'LAMPTHAR': kind == 'ThAr',
+            'OBSCMNT': '', 'NREAD': n_read, 'PLATETYP': 'BHM&MWM',
+            'IMAGETYP': kind, 'SEEING': 1.2 if kind == 'Object' else 0.})
+        ap_header = header_list(ap_cards)
+        for chip in 'abc':
+            if chip == 'c' and i % 11 == 5:  # A detector that didn't write
+                continue
+            path = archive / f"apR-{chip}-{exp_id}.apz"
+            with fitsio.FITS(path.as_posix(), 'rw', clobber=True) as fits:
+                fits.write(None)
+                fits.write(np.zeros((4, 4), dtype='i2'), header=ap_header)
+            counts['apR'] += 1
+        if quickred and kind != 'Dark':
+            key = (kind, dither)
+            if kind == 'Domeflat':
+                key = (kind, n_flats % flat_variants)
+                n_flats += 1
+            path = quickred_dir / f"apq-{exp_id}.fits"
+            if key not in templates:
+                write_quickred(path, quickred_image(kind, dither, master_col,
+                                                    rng))
+                templates[key] = path
+            else:
+                link_or_copy(templates[key], path)
+            counts['apq'] += 1
+
+        # BOSS takes a Hartmann pair at the start of each field
+        if i == 0 or field_i != field_indices[i - 1]:
+            field_start = i
+        i_field = i - field_start
+        hartmann = {0: 'Left', 1: 'Right'}.get(i_field, 'Out')
+        flavor = {0: 'arc', 1: 'arc'}.get(i_field, 'science')
+        b_cards = dict(boss_filler)
+        b_cards.update({'EXPTIME': 900.0 if flavor == 'science' else 4.0,
+                        'DATE-OBS': obs_time, 'DESIGNID': design,
+                        'CONFID': config, 'FIELDID': field, 'CARTID': 'FPS-N',
+                        'HARTMANN': hartmann, 'FLAVOR': flavor})
+        path = spectro / f"sdR-r1-{exp_id:08d}.fit"
+        with fitsio.FITS(path.as_posix(), 'rw', clobber=True) as fits:
+            fits.write(rng.integers(0, 1000, boss_shape).astype('i2'),
+                       header=header_list(b_cards))
+        with path.open('rb') as fi, gzip.open(f"{path}.gz", 'wb') as fo:
+            shutil.copyfileobj(fi, fo)
+        path.unlink()
+        counts['sdR'] += 1
+        for camera in ('r1', 'b1'):
+            if camera == 'b1' and i % 13 == 7:  # An SOS reduction that failed
+                continue
+            (sos / f"splog-{camera}-{exp_id:08d}.log").write_text('')
+            counts['splog'] += 1
+    return counts
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description='Writes a fake night of APOGEE and BOSS data for testing'
+                    ' sloan_log.py')
+    parser.add_argument('root', type=Path,
+                        help='Directory to write the night into, use it as'
+                             ' SDSS_DATA')
+    parser.add_argument('-m', '--mjd', type=int, default=59730,
+                        help='SJD of the night, default 59730')
+    parser.add_argument('-n', '--exposures', type=int, default=100,
+                        help='Number of exposures of each instrument')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--no-quickred', action='store_true',
+                        help="Don't write quickred files")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    counts = write_night(args.root, args.mjd, args.exposures, args.seed,
+                         not args.no_quickred)
+    print(', '.join(f"{n} {name}" for name, n in counts.items()))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,124 @@
+#!/usr/bin/env python3
+"""
+Runs the InfluxDB queries of sloan_log.py's telemetry sections in background
+ threads, so that they wait on the network while the images are being read,
+ instead of one after another once they have been. Each section waits only
+ for its own query when it prints.
+
+telemetry = Telemetry(args)  # args.sjd and args.verbose
+telemetry.start(['dust', 'hartmann', 'log_support'])
+... read the images ...
+dust_sum = telemetry.get('dust')
+
+A section that wasn't started is fetched when it is first asked for, and each
+ result is kept until the section is started again, so p_data and log_support
+ share one Hartmann query. Offsets, focus, and weather are one query, merged by
+ sdssobstools/query_plan.py. The queries are all I/O, so threads are enough, and
+ unlike the processes that LogSupport starts, they don't copy the images
+ already read.
+"""
+import concurrent.futures
+import sys
+import traceback
+
+from sdssobstools import profiling
+
+__version__ = '3.0.0'
+
+def fetch_dust(sjd, verbose=False):
+    """The integrated dust counts of the night, for p_summary"""
+    from astropy.time import Time
+    from bin import get_dust
+    return get_dust.get_dust(Time(sjd, format='mjd'),
+                             Time(sjd + 1, format='mjd'), verbose)
+
+
+def fetch_hartmann(sup):
+    """The Hartmann table of LogSupport sup and the values it was made from,
+    as a dictionary with hartmann and harts, or an empty one if there were no
+    Hartmanns"""
+    out = {}
+    sup.get_hartmann(out)
+    return out
+
+
+def fetch_log_support(sup):
+    """Finds the call times of LogSupport sup, and then queries its offsets,
+    focus, and weather in one merged query. A query or section that fails is
+    printed to stderr and leaves its sections out, as when they ran in their
+    own processes"""
+    sup.set_callbacks()
+
+    out = {}
+    names = ['offsets', 'focus', 'weather']
+    try:
+        arrays = sup.query_sections(names)
+    except Exception:
+        print("The log support query failed:", file=sys.stderr)
+        traceback.print_exc()
+        return out
+    for name in names:
+        try:
+            getattr(sup, f"get_{name}")(out, arrays=arrays[name])
+        except Exception:
+            print(f"The {name} section failed:", file=sys.stderr)
+            traceback.print_exc()
+    return out
+
+
+class Telemetry:
+    """The telemetry of the night args.sjd. Sections are dust (for p_summary),
+    hartmann (for p_data and log_support), and log_support (offsets, focus,
+    and weather)"""
+    sections = ('dust', 'hartmann', 'log_support')
+
+    def __init__(self, args):
+        self.args = args
+        self._pool = None
+        self._futures = {}
+
+    def support(self):
+        """A LogSupport for the night, ending now if the night isn't over"""
+        from astropy.time import Time
+        from sdssobstools import log_support
+        start = Time(self.args.sjd - 0.3, format='mjd')
+        end = Time(self.args.sjd + 0.7, format='mjd')
+        end = Time.now() if Time.now() < end else end
+        return log_support.LogSupport(start, end, self.args)
+
+    def _fetch(self, name, sup):
+        with profiling.span(f"telemetry.{name}"):
+            if name == 'dust':
+                return fetch_dust(self.args.sjd, self.args.verbose)
+            elif name == 'hartmann':
+                return fetch_hartmann(sup)
+            return fetch_log_support(sup)
+
+    def start(self, names):
+        """Starts the query of each section in names in the background, again
+        if it was already started"""
+        names = list(names)
+        for name in names:
+            if name not in self.sections:
+                raise ValueError(f"Unknown telemetry section {name}")
+        if self._pool is None:
+            self._pool = concurrent.futures.ThreadPoolExecutor(
+                len(self.sections), thread_name_prefix='telemetry')
+        sup = None
+        if {'hartmann', 'log_support'} & set(names):
+            sup = self.support()
+        for name in names:
+            self._futures[name] = self._pool.submit(self._fetch, name, sup)
+
+    def get(self, name):
+        """The result of section name, which waits for it to finish, or
+        fetches it now if it wasn't started. Errors are raised here"""
+        if name not in self._futures:
+            self.start([name])
+        return self._futures[name].result()
+
+    def close(self):
+        """Cancels the queries that haven't started"""
+        if self._pool is not None:
+            self._pool.shutdown(wait=False, cancel_futures=True)
+            self._pool = None
@@ -3,7 +3,7 @@ import pytest
 from pathlib import Path
 from bin import ap_test
 import numpy as np
-from sdssobstools import sdss_paths
+from sdssobstools import sdss_paths, apogee_data
 
 
 class Args(object):
@@ -27,6 +27,60 @@ class TestAPTest:
         computer"""
         assert sdss_paths.ap_utr.exists()
 
+    def test_master_col(self):
+        """The shipped master_dome_flat_col.npy should match the master flat"""
+        np.testing.assert_array_equal(
+            apogee_data.master_dome_flat_col(),
+            apogee_data.master_dome_flat_col(from_fits=True))
+
+    def test_read_quickred(self, tmp_path):
+        """Windows of an apq file and of a compressed ap1D file should match
+        the same windows of the whole image"""
+        import fitsio
+        from sdssobstools import synthetic_night
+        image = np.arange(300 * 2048, dtype='f4').reshape(300, 2048)
+        apq = tmp_path / 'apq-1.fits'
+        synthetic_night.write_quickred(apq, image)
+        ap1d = tmp_path / 'ap1D-a-1.fits.fz'
+        with fitsio.FITS(ap1d.as_posix(), 'rw') as fits:
+            fits.write(image, compress='gzip', qlevel=None)
+        for path in (apq, ap1d):
+            for rows, cols in [(slice(60, 70), slice(1085, 1125)),
+                               (slice(None), slice(550, 910)),
+                               (slice(30, 35), slice(2040, 2060)),
+                               (slice(5, 5), slice(0, 10))]:
+                np.testing.assert_array_equal(
+                    apogee_data.read_quickred(path, rows, cols),
+                    image[rows, cols])
+
+    def test_read_quickred_layouts(self, tmp_path):
+        """apq files written by others, a table with more columns written by
+        astropy and a variable length array in the heap, read the same
+        image"""
+        import fitsio
+        from astropy.io import fits as pyfits
+        image = np.arange(300 * 2048, dtype='f4').reshape(300, 2048) % 1000
+        hdus = [pyfits.PrimaryHDU(), pyfits.ImageHDU(np.zeros(2)),
+                pyfits.ImageHDU(np.zeros(2)), pyfits.BinTableHDU.from_columns(
+                    [pyfits.Column('FLUX', '614400E', dim='(2048,300)',
+                                   array=image[None]),
+                     pyfits.Column('ERR', 'E', array=[1.])])]
+        pyfits.HDUList(hdus).writeto(tmp_path / 'apq-astropy.fits')
+        varlen = np.zeros(1, dtype=[('FLUX', 'O')])
+        varlen['FLUX'][0] = image.ravel()
+        with fitsio.FITS((tmp_path / 'apq-var.fits').as_posix(), 'rw') as fits:
+            fits.write(None)
+            fits.write(np.zeros(2))
+            fits.write(np.zeros(2))
+            fits.write(varlen, header=[{'name': 'TDIM1',
+                                        'value': '(2048,300)'}])
+        for name in ('apq-astropy.fits', 'apq-var.fits'):
+            for rows, cols in [(slice(60, 70), slice(1085, 1125)),
+                               (slice(None), slice(550, 910))]:
+                np.testing.assert_array_equal(
+                    apogee_data.read_quickred(tmp_path / name, rows, cols),
+                    image[rows, cols])
+
     def test_plotting(self):
         """Tests the plotting routine"""
         args.plot = True
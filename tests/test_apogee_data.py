@@ -0,0 +1,132 @@
+#!/usr/bin/env python3
+import numpy as np
+import pytest
+
+from scipy.optimize import leastsq
+
+from sdssobstools import apogee_data
+
+
+def leastsq_center(x, line, w0, sigma, **kwargs):
+    """The fit compute_offset did before fit_line_centers"""
+    def err_func(w, x, y):
+        return np.exp(-0.5 * ((x - w) / sigma) ** 2) - y
+    return leastsq(err_func, w0, args=(x, line), **kwargs)[0][0]
+
+
+def fake_lines(w0, dw, sigma, n, rng):
+    """Lines of random heights, widths, and backgrounds within 6 pixels of
+    w0, like the ThAr, UNe, and object windows of sloan_log.read_apogee"""
+    x = np.arange(w0 - dw // 2, w0 + dw // 2)
+    centers = w0 + rng.uniform(-6, 6, (n, 1))
+    widths = sigma * rng.uniform(0.7, 1.5, (n, 1))
+    lines = (rng.uniform(50, 20000, (n, 1))
+             * np.exp(-0.5 * ((x - centers) / widths) ** 2)
+             + rng.uniform(0, 500, (n, 1)) + rng.normal(0, 5, (n, len(x))))
+    return x, lines
+
+
+class TestLineFit():
+
+    @pytest.mark.parametrize('w0, dw, sigma', [(1105, 40, 1.27),
+                                               (1190, 30, 3),
+                                               (1100, 40, 2)])
+    def test_leastsq(self, w0, dw, sigma):
+        """The batch fit should find the minimum leastsq finds, to the
+        precision of leastsq"""
+        x, lines = fake_lines(w0, dw, sigma, 100, np.random.default_rng(1))
+        centers = apogee_data.fit_line_centers(lines, x, w0, sigma)
+        default = [leastsq_center(x, line, w0, sigma) for line in lines]
+        # leastsq stops early with its default ftol, because the cost is
+        # dominated by the flux of the line, which the model can't fit
+        np.testing.assert_allclose(centers, default, rtol=0, atol=0.05)
+        tight = [leastsq_center(x, line, w0, sigma, ftol=1e-15, xtol=1e-12)
+                 for line in lines]
+        np.testing.assert_allclose(centers, tight, rtol=0, atol=1e-4)
+
+    def test_bad_lines(self):
+        x, lines = fake_lines(1105, 40, 1.27, 3, np.random.default_rng(2))
+        lines[1, 5] = np.nan
+        centers = apogee_data.fit_line_centers(lines, x, 1105, 1.27)
+        assert np.isnan(centers[1])
+        assert np.all(np.isfinite(centers[[0, 2]]))
+        assert np.isnan(apogee_data.fit_line_centers(np.zeros((1, 0)), [],
+                                                     1105, 1.27)[0])
+
+
+class TestFiberRuns():
+
+    def test_runs(self):
+        mask = np.zeros(300, dtype=bool)
+        mask[np.array([1, 2, 3, 5, 29, 30, 31, 32, 149, 150]) - 1] = True
+        rows, starts, ends = apogee_data.mask_runs(mask)
+        np.testing.assert_array_equal(rows, 0)
+        np.testing.assert_array_equal(starts, [1, 5, 29, 31, 149])
+        np.testing.assert_array_equal(ends, [3, 5, 30, 32, 150])
+        assert apogee_data.format_runs(starts, ends) == [
+            '1 - 3', 5, '29 - 30', '31 - 32', '149 - 150']
+        assert apogee_data.APOGEERaw.create_bundles(np.array([7])) == [7]
+        assert apogee_data.APOGEERaw.create_bundles(np.array([])) == []
+        for runs in apogee_data.mask_runs(np.zeros((2, 300), dtype=bool)):
+            assert runs.shape == (0,)
+
+    def test_classify(self):
+        """Missing and faint fibers come from the ratio to the master flat,
+        fiber 1 first"""
+        flux_ratio = np.ones(300)
+        flux_ratio[[3, 4, 5, 99, 100]] = 0.1
+        flux_ratio[[148, 149]] = 0.5
+        flux_ratio[200] = np.nan
+        (miss_starts, miss_ends), (faint_starts, faint_ends) = (
+            apogee_data.classify_fibers(flux_ratio))
+        assert apogee_data.format_runs(miss_starts, miss_ends) == [
+            '4 - 6', '100 - 101']
+        assert apogee_data.format_runs(faint_starts, faint_ends) == [
+            '149 - 150']
+        assert np.sum(miss_ends - miss_starts + 1) == 5
+
+
+class TestDomeFlats():
+
+    def test_mask_runs(self):
+        mask = np.zeros((3, 300), dtype=bool)
+        mask[0, [3, 4, 5, 99, 100]] = True
+        mask[2, 28:32] = True
+        mask[2, 299] = True
+        rows, starts, ends = apogee_data.mask_runs(mask)
+        np.testing.assert_array_equal(rows, [0, 0, 2, 2, 2])
+        np.testing.assert_array_equal(starts, [4, 100, 29, 31, 300])
+        np.testing.assert_array_equal(ends, [6, 101, 30, 32, 300])
+
+    def test_batch(self, tmp_path):
+        """A batch of flats should give what ap_test gives for each, and a
+        flat without a quickred file gives NaNs and no fibers"""
+        from sdssobstools import synthetic_night
+        master_col = apogee_data.master_dome_flat_col()
+        rng = np.random.default_rng(3)
+        paths = []
+        for i in range(3):
+            image = synthetic_night.quickred_image('Domeflat', 'A',
+                                                   master_col, rng)
+            image[rng.integers(0, 300, 5)] *= 0.4
+            paths.append(tmp_path / f"apq-{i}.fits")
+            synthetic_night.write_quickred(paths[-1], image)
+        slabs = apogee_data.read_flat_slabs(paths + [None], jobs=2)
+        assert slabs.shape == (4, 300, 360)
+        results = apogee_data.dome_flat_results(np.median(slabs, axis=2),
+                                                master_col)
+        for i, path in enumerate(paths):
+            img = apogee_data.APOGEERaw.__new__(apogee_data.APOGEERaw)
+            img.quickred_data = apogee_data.read_quickred(path)
+            missing, faint, flux_ratio = img.ap_test(master_col=master_col)
+            assert results['missing'][i] == missing
+            assert results['faint'][i] == faint
+            np.testing.assert_allclose(results['flux_ratio'][i], flux_ratio)
+            assert results['n_missing'][i] == np.sum(flux_ratio < 0.2)
+        assert np.all(np.isnan(results['flux_ratio'][3]))
+        assert results['missing'][3] == []
+        assert results['n_faint'][3] == 0
+
+
+if __name__ == '__main__':
+    pytest.main()
@@ -0,0 +1,63 @@
+#!/usr/bin/env python3
+import gzip
+import shutil
+import pytest
+import fitsio
+import numpy as np
+from sdssobstools import boss_data
+
+
+class TestBOSSData():
+
+    def test_gz_header(self, tmp_path):
+        """The streaming header reader should agree with fitsio"""
+        fits_path = tmp_path / "sdR-r1-00012345.fit"
+        cards = [{'name': 'EXPTIME', 'value': 900.0},
+                 {'name': 'DATE-OBS', 'value': '2022-05-30T03:12:34.500'},
+                 {'name': 'FIELDID', 'value': 100001},
+                 {'name': 'HARTMANN', 'value': 'Out'},
+                 {'name': 'FLAVOR', 'value': "sci'ence"},
+                 {'name': 'LAMPHEAR', 'value': False}]
+        fitsio.write(fits_path.as_posix(),
+                     np.zeros((100, 100), dtype='i2'), header=cards)
+        with fits_path.open('rb') as fi, gzip.open(
+                fits_path.as_posix() + '.gz', 'wb') as fo:
+            shutil.copyfileobj(fi, fo)
+        gz_path = fits_path.as_posix() + '.gz'
+        header = boss_data.read_gz_header(gz_path)
+        expected = fitsio.read_header(gz_path)
+        for card in cards:
+            assert header[card['name']] == expected[card['name']]
+            assert type(header[card['name']]) == type(expected[card['name']])
+
+    def test_gz_header_edge_cases(self, tmp_path):
+        """A repeated keyword keeps its last value, as in fitsio, and a
+        truncated file falls back to fitsio instead of raising EOFError"""
+        cards = ["SIMPLE  =                    T",
+                 "BITPIX  =                    8",
+                 "NAXIS   =                    0",
+                 "EXPTIME =                  1.0",
+                 "EXPTIME =                  2.0", "END"]
+        raw = ''.join(card.ljust(80) for card in cards).ljust(2880).encode()
+        gz_path = tmp_path / "sdR-r1-00012345.fit.gz"
+        gz_path.write_bytes(gzip.compress(raw))
+        assert boss_data.read_gz_header(gz_path)['EXPTIME'] == 2.0
+        assert fitsio.read_header(gz_path.as_posix())['EXPTIME'] == 2.0
+
+        truncated = gzip.compress(raw)
+        gz_path.write_bytes(truncated[:len(truncated) // 2])
+        with pytest.raises(EOFError):
+            boss_data.read_gz_header(gz_path)
+        with pytest.raises(OSError):
+            boss_data.BOSSRaw(gz_path)
+
+    def test_card_values(self):
+        assert boss_data.parse_card_value("'Closed  '  / comment") == 'Closed'
+        assert boss_data.parse_card_value("'it''s'") == "it's"
+        assert boss_data.parse_card_value("                   T") is True
+        assert boss_data.parse_card_value("  42 / answer") == 42
+        assert boss_data.parse_card_value("  1.5D2") == 150.
+
+
+if __name__ == '__main__':
+    pytest.main()
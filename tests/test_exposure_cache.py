@@ -0,0 +1,63 @@
+#!/usr/bin/env python3
+import os
+import pytest
+import numpy as np
+from sdssobstools import exposure_cache
+
+
+class TestExposureCache():
+
+    def test_round_trip(self, tmp_path):
+        """A record should come back the same as it was put in"""
+        image = tmp_path / "sdR-r1-00012345.fit.gz"
+        image.write_bytes(b"0" * 2880)
+        rec = {'exp_id': np.int64(12345), 'offset': np.float64(0.25),
+               'missing': [np.int64(3), '5 - 9'],
+               'flux_ratio': np.array([1., np.nan, 0.5])}
+        cache = exposure_cache.ExposureCache(tmp_path / "cache", 59730)
+        assert cache.get(image) is None
+        cache.put(image, rec)
+        cache.close()
+
+        cache = exposure_cache.ExposureCache(tmp_path / "cache", 59730)
+        cached = cache.get(image)
+        assert cached['exp_id'] == 12345
+        assert cached['offset'] == 0.25
+        assert cached['missing'] == [3, '5 - 9']
+        np.testing.assert_array_equal(cached['flux_ratio'], rec['flux_ratio'])
+
+    def test_invalidation(self, tmp_path):
+        """A changed file or a rebuild should not return the old record"""
+        image = tmp_path / "apR-a-12345678.apz"
+        image.write_bytes(b"0" * 2880)
+        cache = exposure_cache.ExposureCache(tmp_path, 59730)
+        cache.put(image, {'exp_id': 12345678})
+        cache.commit()
+        assert cache.get(image) is not None
+        stat = image.stat()
+        os.utime(image, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+        assert cache.get(image) is None
+
+        cache.put(image, {'exp_id': 12345678})
+        cache.close()
+        cache = exposure_cache.ExposureCache(tmp_path, 59730, rebuild=True)
+        assert cache.get(image) is None
+
+    def test_version(self, tmp_path, monkeypatch):
+        """Records cached by another CACHE_VERSION should not be returned"""
+        image = tmp_path / "apR-a-12345678.apz"
+        image.write_bytes(b"0" * 2880)
+        cache = exposure_cache.ExposureCache(tmp_path, 59730)
+        cache.put(image, {'exp_id': 12345678})
+        cache.close()
+        cache = exposure_cache.ExposureCache(tmp_path, 59730)
+        assert cache.get(image) is not None
+        cache.close()
+        monkeypatch.setattr(exposure_cache, 'CACHE_VERSION',
+                            exposure_cache.CACHE_VERSION + 1)
+        cache = exposure_cache.ExposureCache(tmp_path, 59730)
+        assert cache.get(image) is None
+
+
+if __name__ == '__main__':
+    pytest.main()
@@ -0,0 +1,67 @@
+#!/usr/bin/env python3
+import pytest
+import numpy as np
+from astropy.time import Time
+from sdssobstools import exposure_table
+
+
+class TestGroupBy():
+
+    def test_reductions(self):
+        """Counts, maxima, and members should match per-field masks"""
+        fields = np.array([3, 1, 3, 2, 1, 3])
+        dithers = np.array(['A', 'B', 'B', 'A', 'A', 'A'])
+        times = np.array([600, 900, 900, 300, 450, 900])
+        groups = exposure_table.GroupBy(fields, keys=[1, 2, 3, 4])
+        for i, field in enumerate(groups.keys):
+            window = fields == field
+            assert groups.count()[i] == np.sum(window)
+            assert groups.count(dithers == 'A')[i] == np.sum(
+                window & (dithers == 'A'))
+            assert groups.max(times, dithers == 'A')[i] == np.max(
+                times[window & (dithers == 'A')], initial=0)
+            np.testing.assert_array_equal(groups.members[i],
+                                          np.where(window)[0])
+
+    def test_first_appearance(self):
+        groups = exposure_table.GroupBy([3, 1, 3, 2])
+        np.testing.assert_array_equal(groups.keys, [3, 1, 2])
+        np.testing.assert_array_equal(groups.first, [0, 1, 3])
+        assert groups.index[2] == 2
+        np.testing.assert_array_equal(groups.min([5, 4, 2, 1]), [2, 4, 1])
+        with pytest.raises(ValueError):
+            exposure_table.GroupBy([3, 5], keys=[3])
+
+
+class TestTimes():
+
+    def test_against_astropy(self):
+        """The bulk time columns should match astropy's Time"""
+        date_obs = ['2022-05-28T21:36:59.9996', '2022-05-29T01:02:03.4',
+                    '2022-05-29T10:00:00']
+        times = exposure_table.parse_times(date_obs)
+        np.testing.assert_allclose(exposure_table.to_mjd(times),
+                                   Time(date_obs).mjd, rtol=0, atol=1e-9)
+        assert list(exposure_table.iso(times)) == list(Time(date_obs).iso)
+        assert list(exposure_table.hms(times)) == [
+            t[11:19] for t in Time(date_obs).iso]
+        # A float MJD is good to about a microsecond
+        round_trip = exposure_table.from_mjd(exposure_table.to_mjd(times))
+        assert np.all(np.abs(round_trip - times) < np.timedelta64(1, 'us'))
+        assert len(exposure_table.hms(exposure_table.parse_times([]))) == 0
+
+
+class TestExposureTable():
+
+    def test_append(self):
+        table = exposure_table.ExposureTable([('exp_id', 'i8'),
+                                              ('dither', 'U8')], 1)
+        for i in range(5):
+            table.append({'exp_id': i, 'dither': 'AB'[i % 2], 'extra': 0})
+        assert len(table) == 5
+        np.testing.assert_array_equal(table['exp_id'], np.arange(5))
+        assert table['dither'][-1] == 'A'
+
+
+if __name__ == '__main__':
+    pytest.main()
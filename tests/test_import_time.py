@@ -0,0 +1,55 @@
+#!/usr/bin/env python3
+import json
+import os
+import subprocess
+import sys
+
+import pytest
+
+from pathlib import Path
+
+root = Path(__file__).parent.parent
+
+# Entry points that must start without the heavy modules
+modules = ['bin.sjd', 'bin.sloan_log', 'sdssobstools.apogee_data',
+           'sdssobstools.boss_data', 'bin.influx_fetch', 'bin.get_dust',
+           'sdssobstools.log_support', 'bin.telescope_status',
+           'bin.time_summary', 'bin.list_collisions', 'bin.get_tel_positions',
+           'bin.help']
+# Packages an entry point needs that may not be installed
+requires = {'bin.time_summary': ['click'], 'bin.list_collisions': ['click'],
+            'bin.get_tel_positions': ['click']}
+# Modules that are only imported by the functions that need them
+heavy = ['scipy', 'astropy.time', 'influxdb_client', 'matplotlib']
+
+
+def imported(module, tmp_path):
+    """Imports module in a new interpreter, and returns the names of every
+    module in its sys.modules afterwards"""
+    env = dict(os.environ, PYTHONPATH=root.as_posix(),
+               SDSS_DATA=tmp_path.as_posix())
+    proc = subprocess.run(
+        [sys.executable, '-c', f'import json, sys, {module};'
+                               ' print(json.dumps(list(sys.modules)))'],
+        env=env, cwd=tmp_path, capture_output=True, text=True, check=True)
+    return set(json.loads(proc.stdout.splitlines()[-1]))
+
+
+class TestImportTime():
+
+    @pytest.mark.parametrize('module', modules)
+    def test_lazy(self, module, tmp_path):
+        """Each entry point must import without the modules that are imported
+        lazily"""
+        for package in requires.get(module, []):
+            pytest.importorskip(package)
+        assert not [m for m in heavy if m in imported(module, tmp_path)]
+
+    def test_sloan_log_lazy(self, tmp_path):
+        """sloan_log imports the telemetry scripts when it needs them"""
+        assert 'bin.telescope_status' not in imported('bin.sloan_log',
+                                                      tmp_path)
+
+
+if __name__ == '__main__':
+    pytest.main()
@@ -1,11 +1,109 @@
 #!/usr/bin/env python3
+import asyncio
+import csv
+import io
+import socket
+import sys
+
+import numpy as np
+
 import pytest
 from pathlib import Path
 import subprocess as sub
 from astropy.time import Time
 from bin import influx_fetch
+from sdssobstools import query_plan
     
+# Two tables of the same field in different cases, a long field with an empty
+# value, and a string field, as InfluxDB sends them
+annotated_csv = """\
+#datatype,string,long,dateTime:RFC3339,dateTime:RFC3339,dateTime:RFC3339,double,string,string
+#group,false,false,true,true,false,false,true,true
+#default,_result,,,,,,,
+,result,table,_start,_stop,_time,_value,_field,_measurement
+,,0,2022-05-31T00:00:00Z,2022-05-31T12:00:00Z,2022-05-31T02:00:00Z,1.5,axePos_alt,tcc
+,,0,2022-05-31T00:00:00Z,2022-05-31T12:00:00Z,2022-05-31T02:00:01.25Z,2.5,axePos_alt,tcc
+,,1,2022-05-31T00:00:00Z,2022-05-31T12:00:00Z,2022-05-31T02:00:02Z,3.5,axepos_alt,tcc
+
+#datatype,string,long,dateTime:RFC3339,dateTime:RFC3339,dateTime:RFC3339,long,string,string
+#group,false,false,true,true,false,false,true,true
+#default,_result,,,,,,,
+,result,table,_start,_stop,_time,_value,_field,_measurement
+,,2,2022-05-31T00:00:00Z,2022-05-31T12:00:00Z,2022-05-31T02:00:00.000000001Z,12345,configuration_loaded_1,jaeger
+,,2,2022-05-31T00:00:00Z,2022-05-31T12:00:00Z,2022-05-31T03:00:00Z,,configuration_loaded_1,jaeger
+
+#datatype,string,long,dateTime:RFC3339,dateTime:RFC3339,dateTime:RFC3339,string,string,string
+#group,false,false,true,true,false,false,true,true
+#default,_result,,,,,,,
+,result,table,_start,_stop,_time,_value,_field,_measurement
+,,3,2022-05-31T00:00:00Z,2022-05-31T12:00:00Z,2022-05-31T02:00:00Z,Open,state,enclosure
+
+"""
+
+
+class FakeAsyncClient:
+    """Answers query_raw with annotated_csv, after 2s for a slow query"""
+
+    def __init__(self):
+        self.cancelled = []
+        self.closed = False
+
+    def query_api(self):
+        return self
+
+    async def query_raw(self, query, org=None):
+        if 'fail' in query:
+            raise ConnectionError('Connection refused')
+        try:
+            await asyncio.sleep(2 if 'slow' in query else 0)
+        except asyncio.CancelledError:
+            self.cancelled.append(query)
+            raise
+        return annotated_csv
+
+    async def close(self):
+        self.closed = True
+
+
 class TestInfluxFetch():
+
+    def test_parse_csv(self):
+        """Annotated CSV is read into typed arrays by field"""
+        rows = csv.reader(io.StringIO(annotated_csv))
+        arrays = influx_fetch.parse_csv(rows)
+        assert list(arrays) == ['axePos_alt', 'axepos_alt',
+                                'configuration_loaded_1', 'state']
+        times, values = arrays['axePos_alt']
+        assert times.dtype == np.int64
+        assert list(times - times[0]) == [0, 1_250_000_000]
+        assert values.dtype == float and list(values) == [1.5, 2.5]
+        times, values = arrays['configuration_loaded_1']
+        assert (influx_fetch.to_time(times[:1]).isot[0]
+                == '2022-05-31T02:00:00.000')
+        assert times[0] % 10 ** 9 == 1
+        assert values[0] == 12345 and np.isnan(values[1])
+        assert arrays['state'][1].tolist() == ['Open']
+
+        lower = influx_fetch.parse_csv(csv.reader(io.StringIO(annotated_csv)),
+                                       lower=True)
+        assert list(lower['axepos_alt'][1]) == [1.5, 2.5, 3.5]
+        table = influx_fetch.time_table(lower)
+        assert table['taxepos_alt'][-1].isot == '2022-05-31T02:00:02.000'
+        times, values = influx_fetch.join_fields(lower)
+        assert len(times) == len(values) == 6
+        # Across a leap second
+        leap = influx_fetch.to_time(influx_fetch.to_ns(
+            ['2016-12-31T23:59:59.5Z', '2017-01-01T00:00:00Z']))
+        assert leap[0].isot == '2016-12-31T23:59:59.500'
+        assert (leap[1] - leap[0]).sec == pytest.approx(1.5)
+
+    def test_parse_csv_error(self):
+        """An error in the response is raised"""
+        rows = csv.reader(io.StringIO(
+            "#datatype,string,string\n,error,reference\n,query failed,\n"))
+        with pytest.raises(RuntimeError):
+            influx_fetch.parse_csv(rows)
+
     def test_known_date(self):
         dust = Path(__file__).parent.parent / "flux/dust.flux"
         with dust.open('r') as fil:
@@ -19,6 +117,94 @@ class TestInfluxFetch():
         user_id, org_id, token = influx_fetch.get_key()
         client = influx_fetch.get_client(org_id, token)
 
+    def test_pooled_client(self, monkeypatch):
+        """The first server that accepts a connection is chosen once, and
+        clients are reused until close"""
+        with socket.socket() as server:
+            server.bind(('127.0.0.1', 0))
+            server.listen()
+            url = f"http://127.0.0.1:{server.getsockname()[1]}"
+            with socket.socket() as closed:
+                closed.bind(('127.0.0.1', 0))
+                dead = f"http://127.0.0.1:{closed.getsockname()[1]}"
+            assert influx_fetch.reachable(url)
+            assert not influx_fetch.reachable(dead)
+            monkeypatch.setattr(influx_fetch, 'servers', [dead, url, dead])
+            influx_fetch.close()
+            assert influx_fetch.get_url() == url
+        monkeypatch.setattr(influx_fetch, 'servers', [dead])
+        assert influx_fetch.get_url() == url  # Not probed again
+        api = influx_fetch.get_client('org', 'token')
+        assert influx_fetch.get_client('org', 'token')._influxdb_client is (
+            api._influxdb_client)
+        assert influx_fetch.get_client('org', 'other')._influxdb_client is not (
+            api._influxdb_client)
+        influx_fetch.close()
+        assert influx_fetch.get_url() == dead
+        influx_fetch.close()
+
+    def test_gather_queries(self, monkeypatch):
+        """Queries run at once, one that misses its deadline is cancelled,
+        and the results of the rest are returned with the errors"""
+        client = FakeAsyncClient()
+        monkeypatch.setattr(influx_fetch, 'result_cache', None)
+        monkeypatch.setattr(influx_fetch, 'get_key', lambda: ('', '', ''))
+        monkeypatch.setattr(influx_fetch, 'get_async_client',
+                            lambda org, token, timeout: client)
+        start = Time('2022-05-31T00:00:00')
+        end = Time('2022-05-31T12:00:00')
+        requests = {name: query_plan.Request(f"// {name}", start, end)
+                    for name in ['fast', 'slow', 'fail', 'fast2']}
+        results, errors = influx_fetch.gather_queries(
+            requests, deadline={'fast': 1, 'slow': 0.2, 'fail': 1,
+                                'fast2': None})
+        assert list(results) == ['fast', 'fast2']
+        assert (results['fast']['axePos_alt'][1] == [1.5, 2.5]).all()
+        assert isinstance(errors['slow'], asyncio.TimeoutError)
+        assert isinstance(errors['fail'], ConnectionError)
+        assert client.cancelled == ['// slow']
+        assert client.closed
+        out = io.StringIO()
+        influx_fetch.report(errors, out)
+        assert 'slow query missed its deadline' in out.getvalue()
+        assert 'fail query failed' in out.getvalue()
+
+    def test_window_period(self):
+        """auto keeps short windows at every second and long ones within
+        the point budget, but no finer than the resolution asked for"""
+        start = Time('2022-05-31T00:00:00')
+        assert influx_fetch.window_period(start, start + 600 / 86400) == '1s'
+        assert influx_fetch.window_period(start, start + 0.5) == '1m'
+        assert influx_fetch.window_period(start, start + 0.5,
+                                          max_points=5000) == '10s'
+        assert influx_fetch.window_period(start, start + 0.5,
+                                          resolution='5m') == '5m'
+        assert influx_fetch.window_period(start, start + 0.01,
+                                          resolution=90) == '2m'
+        assert influx_fetch.window_period(start, start + 1000) == '1d'
+        assert influx_fetch.duration_seconds('1m30s') == 90
+        with pytest.raises(ValueError):
+            influx_fetch.duration_seconds('soon')
+        with pytest.raises(ValueError):
+            influx_fetch.window_period(start, start + 1, max_points=0)
+        assert influx_fetch.resolve_interval('auto', start, start + 0.5,
+                                             max_points=5000) == '10s'
+        assert influx_fetch.resolve_interval('auto', start, start + 0.5,
+                                             resolution='5m') == '5m'
+        assert influx_fetch.resolve_interval('1m', start, start + 0.5,
+                                             max_points=5000) == '1m'
+        script = 'aggregateWindow(every: v.windowPeriod, fn: last)'
+        assert influx_fetch.render(script, start, start + 0.5, 'auto') == (
+            influx_fetch.render(script, start, start + 0.5, '1m'))
+
+    def test_no_default_cache(self):
+        """Importing influx_fetch doesn't turn on the query cache"""
+        out = sub.run([sys.executable, '-c', 'from bin import influx_fetch;'
+                       ' print(influx_fetch.result_cache)'],
+                      cwd=Path(influx_fetch.__file__).parent.parent,
+                      capture_output=True, text=True, check=True).stdout
+        assert out.strip() == 'None'
+
     def test_help(self):
         """"Prints the help if -h is provided"""
         sub.call('{} -h'.format(influx_fetch.__file__), shell=True)
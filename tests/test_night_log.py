@@ -0,0 +1,87 @@
+#!/usr/bin/env python3
+import csv
+import io
+import json
+import pytest
+from sdssobstools import night_log
+
+
+def small_night():
+    tables = {'apogee': {'sjd': [59730], 'time': ['2022-05-30 21:36:00.000'],
+                         'field': [100001], 'exposure': [40000000],
+                         'type': ['Object'], 'arch': ['a-b-c']},
+              'boss': {'sjd': [59730, 59730], 'field': [100001, 100001],
+                       'exposure': [1, 2], 'type': ['Science', 'Arc'],
+                       'sos': ['r1-b1', 'r1-xx']},
+              'dome_flats': {'field': [100001], 'missing': [['4 - 6', 9]],
+                             'throughput': [None]}}
+    return night_log.NightLog(59730, tables, {'weather': '<b>Windy</b>'})
+
+
+class TestNightLog():
+
+    def test_json(self, tmp_path):
+        night = small_night()
+        night.write(tmp_path / "night.json")
+        with (tmp_path / "night.json").open() as fil:
+            loaded = night_log.NightLog.from_dict(json.load(fil))
+        assert loaded.to_dict() == night.to_dict()
+
+    def test_csv(self, tmp_path):
+        small_night().write(tmp_path / "night.csv")
+        with (tmp_path / "night.csv").open(newline='') as fil:
+            rows = list(csv.DictReader(fil))
+        assert [row['instrument'] for row in rows] == ['apogee', 'boss',
+                                                        'boss']
+        assert rows[0]['arch'] == 'a-b-c'
+        assert rows[2]['sos'] == 'r1-xx'
+
+    def test_html(self, tmp_path):
+        small_night().write(tmp_path / "night.html")
+        page = (tmp_path / "night.html").read_text()
+        assert page.count('<table>') == 3
+        assert '<td>4 - 6 9</td>' in page
+        assert '&lt;b&gt;Windy&lt;/b&gt;' in page
+
+    def test_text(self, tmp_path):
+        """The text log has the sections of the night, and only the morning
+        exposures if they are given"""
+        night = small_night()
+        night.tables['apogee'].update({'design': [9000], 'config': [5000],
+                                       'dither': ['A'], 'reads': [47]})
+        night.tables['boss'].update({
+            'time': ['2022-05-30 21:36:00.000', '2022-05-30 21:43:12.000'],
+            'design': [9000, 9000], 'config': [5000, 5000],
+            'exp_time': [900., None], 'hartmann': ['Out', 'Left']})
+        night.sections = ['apogee', 'boss']
+        night.write(tmp_path / "night.txt")
+        text = (tmp_path / "night.txt").read_text()
+        assert text.index('APOGEE Data Summary') < text.index(
+            'BOSS Data Summary')
+        assert 'Observing Summary' not in text
+        assert '59730 21:36:00 100001-  9000-5000   40000000 Object' in text
+        assert '00000002 Arc     r1-xx   nan Left' in text
+        night.summary['morning_exposures'] = [40000001]
+        night.sections = ['apogee']
+        out = io.StringIO()
+        night_log.write_text(night, out)
+        assert '40000000' not in out.getvalue()
+
+    def test_by_field(self):
+        """Rows are grouped by field in the order the fields first appear,
+        and keep their order within a field"""
+        night = night_log.NightLog(59730, {'boss': {
+            'field': [7, 3, 7, 3, 9], 'exposure': [1, 2, 3, 4, 5]}})
+        groups = night.by_field('boss')
+        assert list(groups) == [7, 3, 9]
+        assert [[row['exposure'] for row in rows]
+                for rows in groups.values()] == [[1, 3], [2, 4], [5]]
+        assert night.by_field('apogee') == {}
+
+    def test_unknown_format(self, tmp_path):
+        with pytest.raises(ValueError):
+            small_night().write(tmp_path / "night.xlsx")
+
+
+if __name__ == '__main__':
+    pytest.main()
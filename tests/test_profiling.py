@@ -0,0 +1,71 @@
+#!/usr/bin/env python3
+import io
+import json
+
+import pytest
+
+from sdssobstools import profiling
+
+
+@profiling.traced('child')
+def child(n):
+    with profiling.span('child.query') as counts:
+        counts['rows'] = n
+    return n
+
+
+@pytest.fixture
+def enabled():
+    profiling.clear()
+    profiling.enable()
+    yield
+    profiling.disable()
+    profiling.clear()
+
+
+class TestProfiling():
+
+    def test_disabled(self):
+        profiling.clear()
+        with profiling.span('stage') as counts:
+            counts['files'] = 1
+        assert profiling.spans == []
+
+    def test_spans(self, enabled):
+        with profiling.span('parse_images') as counts:
+            counts['files'] = 2
+            with profiling.span('read_apogee') as counts:
+                counts['files'] = 3
+        assert [s['name'] for s in profiling.spans] == ['parse_images',
+                                                        'read_apogee']
+        assert [s['depth'] for s in profiling.spans] == [0, 1]
+        assert profiling.spans[0]['wall'] >= profiling.spans[1]['wall']
+        assert profiling.totals() == {'files': 5}
+        fp = io.StringIO()
+        profiling.report(fp)
+        assert '  read_apogee' in fp.getvalue()
+        assert 'files=5' in fp.getvalue()
+
+    def test_trace(self, enabled, tmp_path):
+        with profiling.span('sort') as counts:
+            counts['exposures'] = 10
+        profiling.write_trace(tmp_path / 'trace.json')
+        trace = json.loads((tmp_path / 'trace.json').read_text())
+        event = trace['traceEvents'][0]
+        assert event['name'] == 'sort'
+        assert event['ph'] == 'X'
+        assert event['args'] == {'exposures': 10}
+        assert trace['otherData']['totals'] == {'exposures': 10}
+
+    def test_traced(self, enabled):
+        """A traced function is timed as a span, and the spans it makes are
+        nested in it"""
+        with profiling.span('log_support'):
+            assert child(4) == 4
+        assert [s['name'] for s in profiling.spans] == ['log_support',
+                                                        'child', 'child.query']
+        assert [s['depth'] for s in profiling.spans] == [0, 1, 2]
+        assert profiling.totals() == {'rows': 4}
+
+if __name__ == '__main__':
+    pytest.main()
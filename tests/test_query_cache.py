@@ -0,0 +1,95 @@
+#!/usr/bin/env python3
+import datetime
+import os
+import time
+
+import numpy as np
+import pytest
+
+from astropy.time import Time
+from influxdb_client.client.flux_table import FluxRecord, FluxTable
+
+from bin import influx_fetch
+from sdssobstools import query_cache
+
+
+def make_tables(n):
+    t0 = datetime.datetime(2022, 5, 31, 2, tzinfo=datetime.timezone.utc)
+    tables = []
+    for i, field in enumerate(['dustb', 'humidpt']):
+        table = FluxTable()
+        for j in range(n):
+            table.records.append(FluxRecord(i, {
+                'result': '_result', 'table': i, '_measurement': 'weather',
+                '_field': field, '_value': 0.5 * j if j != 2 else None,
+                '_time': t0 + datetime.timedelta(seconds=61, microseconds=j)
+                * j}))
+        tables.append(table)
+    return tables
+
+
+class TestQueryCache():
+
+    def test_round_trip(self, tmp_path):
+        """Cached tables have the same records, including their times"""
+        cache = query_cache.QueryCache(tmp_path)
+        tables = make_tables(5)
+        key = cache.key('from(bucket: "actors")', 'a', 'b', '1m')
+        assert key != cache.key('from(bucket: "actors")', 'a', 'b', '5m')
+        cache.put(key, tables)
+        cached = cache.get(key, time.time() - 3600)
+        assert len(cached) == 2
+        for table, cached_table in zip(tables, cached):
+            assert len(cached_table.records) == 5
+            for rec, cached_rec in zip(table.records, cached_table.records):
+                assert cached_rec.values == rec.values
+                assert cached_rec.get_time() == rec.get_time()
+                assert cached_rec.get_field() == rec.get_field()
+
+    def test_arrays(self, tmp_path):
+        """query_arrays results are cached as arrays"""
+        cache = query_cache.QueryCache(tmp_path)
+        arrays = {'axePos_alt': (np.arange(3, dtype=np.int64), np.ones(3)),
+                  'state': (np.arange(2, dtype=np.int64),
+                            np.array(['Open', 'Closed']))}
+        cache.put('k', arrays, 'arrays')
+        assert cache.path('k', 'arrays').suffix == '.npz'
+        cached = cache.get('k', time.time() - 3600, 'arrays')
+        assert list(cached) == list(arrays)
+        for field, (times, values) in arrays.items():
+            assert (cached[field][0] == times).all()
+            assert (cached[field][1] == values).all()
+        assert cache.get('k', time.time() - 3600) is None
+
+    def test_expiry(self, tmp_path):
+        """Recent windows expire after the TTL, but old ones don't"""
+        cache = query_cache.QueryCache(tmp_path)
+        cache.put('old', make_tables(3))
+        cache.put('recent', make_tables(3))
+        written = time.time() - 10 * query_cache.ttl
+        for key in ('old', 'recent'):
+            os.utime(cache.path(key), (written, written))
+        assert cache.get('old', written - 3600) is not None
+        assert cache.get('recent', written - 60) is None
+        assert cache.get('missing', written - 3600) is None
+        assert (cache.hits, cache.misses) == (1, 2)
+
+    def test_offline_query(self, tmp_path, monkeypatch):
+        """influx_fetch.query answers a cached past window without a key or a
+        server"""
+        cache = query_cache.QueryCache(tmp_path)
+        monkeypatch.setattr(influx_fetch, 'result_cache', cache)
+        start = Time('2022-05-31T00:00:00')
+        end = Time('2022-05-31T12:00:00')
+        script = ('from(bucket: "actors") |> range(start: v.timeRangeStart,'
+                  ' stop: v.timeRangeStop)')
+        rendered = (f'from(bucket: "actors") |> range(start: {start.isot}Z,'
+                    f' stop: {end.isot}Z)')
+        cache.put(cache.key(rendered, start.isot, end.isot, '1m'),
+                  make_tables(4))
+        tables = influx_fetch.query(script, start, end, interval='1m')
+        assert [len(table.records) for table in tables] == [4, 4]
+
+
+if __name__ == '__main__':
+    pytest.main()
@@ -0,0 +1,119 @@
+#!/usr/bin/env python3
+import numpy as np
+import pytest
+
+from astropy.time import Time
+from pathlib import Path
+
+from bin import influx_fetch
+from sdssobstools import query_cache, query_plan
+
+flux_dir = Path(__file__).parent.parent / "flux"
+start = Time('2022-05-31T00:00:00')
+end = Time('2022-05-31T12:00:00')
+
+csv_text = """#datatype,string,long,dateTime:RFC3339,double,string,string
+#group,false,false,false,false,true,true
+#default,_result,,,,,
+,result,table,_time,_value,_field,_measurement
+,,0,2022-05-31T01:00:00Z,1.5,axePos_alt,tcc
+,,0,2022-05-31T01:01:00Z,2.5,axePos_alt,tcc
+,,1,2022-05-31T01:00:00Z,10,airTempPT,apo
+,,2,2022-05-31T01:00:00Z,50,humidPT,apo
+"""
+
+
+def section_requests():
+    return [query_plan.Request((flux_dir / f"{name}.flux").read_text(),
+                               start, end, "1m", lower=True)
+            for name in ('offsets', 'focus', 'weather')]
+
+
+class FakeQueryApi:
+    def __init__(self):
+        self.queries = []
+
+    def query_csv(self, query, org=None):
+        self.queries.append(query)
+        return iter([line.split(',') for line in csv_text.splitlines()])
+
+
+class TestQueryPlan():
+
+    def test_predicate(self):
+        """Predicates are evaluated with and binding tighter than or, as the
+        Hartmann query relies on"""
+        head, expr, tail = query_plan.split(
+            (flux_dir / "hartmanns.flux").read_text())
+        assert 'residuals = from' in head
+        assert tail.strip() == '|> yield()'
+        func = query_plan.predicate(expr)
+        for measurement, field, match in [
+                ('jaeger', 'configuration_loaded_1', True),
+                ('jaeger', 'configuration_loaded_3', False),
+                ('boss', 'sp1Temp_median', True),
+                ('boss', 'sp2Temp_median', False),
+                ('hartmann', 'sp1Residuals_deg', True),
+                ('tcc', 'b1RingMove', True)]:
+            assert func({'_measurement': measurement,
+                         '_field': field}) == match
+        func = query_plan.predicate('not r._field !~ /^a/ and r._field != "ab"')
+        assert func({'_measurement': '', '_field': 'ac'})
+        assert not func({'_measurement': '', '_field': 'ab'})
+        for expr in ['r.host == "a"', 'r._field == 1', 'r._field == "a" or']:
+            with pytest.raises(ValueError):
+                query_plan.predicate(expr)
+
+    def test_plan(self):
+        """Offsets, focus, and weather are one query, Hartmanns, with another
+        window and no aggregation, are another, and a script that can't be
+        split runs as it is"""
+        hartmann = query_plan.Request(
+            (flux_dir / "hartmanns.flux").read_text(), start, end)
+        other = query_plan.Request('from(bucket: "actors") |> yield()', start,
+                                   end, "1m")
+        groups = query_plan.plan(section_requests() + [hartmann, other])
+        assert [group.members for group in groups] == [[0, 1, 2], [3], [4]]
+        assert groups[1].flux_script == hartmann.flux_script
+        assert groups[2].predicates == [None]
+        merged = groups[0].flux_script
+        assert merged.count('|> filter(') == 1
+        assert merged.count('aggregateWindow') == 1
+        assert query_plan.split(merged) is not None
+
+    def test_query_merged(self, tmp_path, monkeypatch):
+        """One query is made for the three sections, a series two of them
+        want goes to both, and the result is cached"""
+        api = FakeQueryApi()
+        monkeypatch.setattr(influx_fetch, 'result_cache',
+                            query_cache.QueryCache(tmp_path))
+        monkeypatch.setattr(influx_fetch, 'get_key', lambda: ('', '', ''))
+        monkeypatch.setattr(influx_fetch, 'get_client', lambda **kw: api)
+        offsets, focus, weather = influx_fetch.query_merged(
+            section_requests())
+        assert len(api.queries) == 1
+        assert list(offsets) == ['axepos_alt']
+        assert list(focus) == ['axepos_alt', 'airtemppt']
+        assert list(weather) == ['airtemppt', 'humidpt']
+        assert (offsets['axepos_alt'][1] == [1.5, 2.5]).all()
+        assert offsets['axepos_alt'][0].dtype == np.int64
+        cached = influx_fetch.query_merged(section_requests())
+        assert len(api.queries) == 1
+        assert list(cached[1]) == list(focus)
+        assert (cached[1]['airtemppt'][1] == focus['airtemppt'][1]).all()
+
+    def test_auto_interval(self, monkeypatch):
+        """An auto Request gets the windowPeriod of its own max_points"""
+        api = FakeQueryApi()
+        monkeypatch.setattr(influx_fetch, 'result_cache', None)
+        monkeypatch.setattr(influx_fetch, 'get_key', lambda: ('', '', ''))
+        monkeypatch.setattr(influx_fetch, 'get_client', lambda **kw: api)
+        requests = [request._replace(interval='auto', max_points=5000)
+                    for request in section_requests()]
+        influx_fetch.query_merged(requests)
+        assert len(api.queries) == 1
+        assert 'every:10s' in api.queries[0].replace(' ', '')
+
+
+if __name__ == '__main__':
+    pytest.main()
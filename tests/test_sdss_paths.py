@@ -0,0 +1,23 @@
+#!/usr/bin/env python3
+import pytest
+from sdssobstools import sdss_paths
+
+
+class TestDirListing():
+
+    def test_exists(self, tmp_path):
+        """exists should match Path.exists until a file changes, and then
+        again after refresh_listings"""
+        (tmp_path / "splog-r1-00012345.log").write_text('')
+        assert sdss_paths.exists(tmp_path / "splog-r1-00012345.log")
+        assert not sdss_paths.exists(tmp_path / "splog-b1-00012345.log")
+        assert not sdss_paths.exists(tmp_path / "missing/apq-1.fits")
+
+        (tmp_path / "splog-b1-00012345.log").write_text('')
+        assert not sdss_paths.exists(tmp_path / "splog-b1-00012345.log")
+        sdss_paths.refresh_listings()
+        assert sdss_paths.exists(tmp_path / "splog-b1-00012345.log")
+
+
+if __name__ == '__main__':
+    pytest.main()
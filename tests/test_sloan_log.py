@@ -1,7 +1,15 @@
 #!/usr/bin/env python3
+import io
+import json
+import os
+import subprocess
+import sys
+
+import numpy as np
 import pytest
 from pathlib import Path
 from bin import sloan_log, sjd
+from sdssobstools import night_log, sdss_paths, synthetic_night
 
 
 class Args:
@@ -116,6 +124,138 @@ class TestSloanLog():
         log.count_dithers()
         log.p_apogee()
 
+    def test_parallel_parse(self, tmp_path):
+        """Checks that reading headers in a process pool gives the same log
+        as reading them serially, on a synthetic night in a new interpreter
+        so that sdss_paths uses tmp_path"""
+        synthetic_night.write_night(tmp_path, 59730, 24)
+        root = Path(__file__).parent.parent
+        env = dict(os.environ, PYTHONPATH=root.as_posix(),
+                   SDSS_DATA=tmp_path.as_posix())
+        nights = []
+        for jobs in ('1', '4'):
+            subprocess.run(
+                [sys.executable, (root / 'bin/sloan_log.py').as_posix(), '-m',
+                 '59730', '-a', '-b', '-n', '-j', jobs, '--no-cache', '-o',
+                 f'night_{jobs}.json'],
+                env=env, cwd=tmp_path, capture_output=True, text=True,
+                check=True)
+            nights.append(json.loads(
+                (tmp_path / f'night_{jobs}.json').read_text()))
+        serial, parallel = nights
+        assert len(serial['tables']['apogee']['exposure']) == 24
+        assert len(serial['tables']['boss']['exposure']) == 24
+        assert serial['tables']['dome_flats']['missing']
+        assert serial == parallel
+
+    def test_ragged_flats(self, tmp_path, monkeypatch):
+        """Dome flats with different numbers of missing and faint runs are
+        sorted, and their fibers stay ints in the night log"""
+        args = Args()
+        args.sjd = 59730
+        args.boss = False
+        args.apogee = True
+        args.morning = False
+        args.verbose = False
+        args.jobs = 1
+        log = sloan_log.Logging(['a0', 'f1', 'f2'], [], args)
+        log.cache = None
+        master = log.ap_master
+        ratios = []
+        for missing, faint in (([1, 2, 3, 7, 101], []), ([12], range(40, 46))):
+            ratio = np.ones(len(master))
+            ratio[np.array(missing, dtype=int) - 1] = 0.05
+            ratio[np.array(faint, dtype=int) - 1] = 0.5
+            ratios.append(ratio)
+
+        def read_apogee(image, args):
+            rec = {'file': image, 'exp_id': int(image[1:]),
+                   'date_obs': f'2022-05-31T0{image[1]}:00:00',
+                   'field_id': 100, 'design_id': 200, 'config_id': 300,
+                   'lead': 'APOGEE', 'exp_type': 'Object', 'dither': 'A',
+                   'n_read': 47, 'seeing': 1.2, 'kind': None,
+                   'detectors': 'a-b-c'}
+            if image[0] == 'f':
+                rec['kind'] = 'Domeflat'
+                rec['exp_type'] = 'Domeflat'
+                rec['quickred'] = tmp_path / f"apq-{image}.fits"
+                column = master * np.flip(ratios[int(image[1]) - 1])
+                synthetic_night.write_quickred(
+                    rec['quickred'], np.repeat(column[:, None], 2048, axis=1))
+            return rec
+
+        monkeypatch.setattr(sloan_log, 'read_apogee', read_apogee)
+        log.parse_images()
+        log.sort()
+        assert list(log.ap_data['fMissing']) == [['1 - 3', 7, 101], [12]]
+        assert list(log.ap_data['fFaint']) == [[], ['40 - 45']]
+        flats = night_log.NightLog.from_logging(log).tables['dome_flats']
+        assert flats['missing'][0] == ['1 - 3', 7, 101]
+        assert isinstance(flats['missing'][0][2], int)
+
+    def test_follow_quickred(self, tmp_path, monkeypatch):
+        """A dome flat read before its quickred file is written is read again
+        by --follow once it is, and only then is the log reprinted"""
+        synthetic_night.write_night(tmp_path, 59730, 12)
+        monkeypatch.setattr(sdss_paths, 'ap_qr', tmp_path / 'apogee/quickred')
+        monkeypatch.setattr(sloan_log, 'ap_dir', tmp_path / 'apogee/archive')
+        monkeypatch.setattr(sloan_log, 'b_dir', tmp_path / 'spectro')
+        kinds, _ = synthetic_night.schedule(12)
+        flats = [synthetic_night.first_exp_id + i
+                 for i, kind in enumerate(kinds) if kind == 'Domeflat']
+        quickred = tmp_path / 'apogee/quickred/59730'
+        held = tmp_path / 'held'
+        held.mkdir()
+        for exp_id in flats:
+            (quickred / f"apq-{exp_id}.fits").rename(
+                held / f"apq-{exp_id}.fits")
+
+        class Telemetry:
+            def start(self, names):
+                pass
+
+        args = Args()
+        args.sjd = 59730
+        args.apogee = True
+        args.boss = False
+        args.morning = False
+        args.verbose = False
+        args.noprogress = True
+        args.jobs = 1
+        args.follow = 0
+        args.summary = False
+        args.data = False
+        args.log_support = False
+        ap_images, _ = sloan_log.find_images(59730)
+        log = sloan_log.Logging(ap_images, [], args, Telemetry())
+        log.parse_images()
+        assert len(log.ap_incomplete) == len(flats)
+        assert not any(f"{exp_id}" in str(p) for p in log.read_paths
+                       for exp_id in flats)
+
+        polls = []
+
+        def sleep(seconds):
+            polls.append(seconds)
+            if len(polls) == 2:  # The quickred is written after the first
+                for exp_id in flats:
+                    (held / f"apq-{exp_id}.fits").rename(
+                        quickred / f"apq-{exp_id}.fits")
+            elif len(polls) > 2:
+                raise KeyboardInterrupt
+
+        printed = []
+        monkeypatch.setattr(sloan_log.time, 'sleep', sleep)
+        monkeypatch.setattr(sloan_log, 'print_images',
+                            lambda log, *a: printed.append(len(polls)))
+        monkeypatch.setattr(sloan_log, 'write_outputs', lambda *a: None)
+        sloan_log.follow(log, args, True, False)
+        assert printed == [2]
+        assert log.ap_incomplete == {}
+        assert set(log.read_paths) == set(ap_images)
+        log.sort()
+        assert list(log.ap_data['fNMissing']) == [4] * len(flats)
+
     def test_log_support(self):
         """Runs on an old dataset that I know used to run successfully"""
 
@@ -265,6 +405,63 @@ class TestSloanLog():
         log.count_dithers()
         log.p_data()
 
+    def test_mjd_range(self, tmp_path):
+        """Logs two synthetic nights and one without data with --mjd-range,
+        in a new interpreter so that sdss_paths uses tmp_path"""
+        for night in (59730, 59731):
+            synthetic_night.write_night(tmp_path, night, 12, seed=night)
+        root = Path(__file__).parent.parent
+        env = dict(os.environ, PYTHONPATH=root.as_posix(),
+                   SDSS_DATA=tmp_path.as_posix())
+        proc = subprocess.run(
+            [sys.executable, (root / 'bin/sloan_log.py').as_posix(),
+             '--mjd-range', '59729', '59731', '-a', '-b', '--range-jobs', '2',
+             '-o', 'out/{sjd}.txt', 'out/{sjd}.json', '--range-summary',
+             'out/range.json', '--cache-dir', 'cache'],
+            env=env, cwd=tmp_path, capture_output=True, text=True, check=True)
+        summaries = json.loads((tmp_path / 'out/range.json').read_text())
+        assert [s['sjd'] for s in summaries] == [59729, 59730, 59731]
+        assert [s['apogee'] for s in summaries] == [0, 12, 12]
+        assert [s['boss'] for s in summaries] == [0, 12, 12]
+        assert [s['dome_flats'] for s in summaries] == [0, 2, 2]
+        assert all(s['error'] is None for s in summaries)
+        assert '59731' in proc.stdout
+        report = (tmp_path / 'out/59730.txt').read_text()
+        assert 'APOGEE Data Summary' in report
+        assert '59731' not in report
+        night = json.loads((tmp_path / 'out/59731.json').read_text())
+        assert night
+
+    def test_text_output(self, tmp_path):
+        """The printed log, the text output, and the text rendered from the
+        JSON output are the same"""
+        synthetic_night.write_night(tmp_path, 59730, 12)
+        root = Path(__file__).parent.parent
+        env = dict(os.environ, PYTHONPATH=root.as_posix(),
+                   SDSS_DATA=tmp_path.as_posix())
+        proc = subprocess.run(
+            [sys.executable, (root / 'bin/sloan_log.py').as_posix(), '-m',
+             '59730', '-a', '-b', '-n', '--no-cache', '-o', 'night.txt',
+             'night.json'],
+            env=env, cwd=tmp_path, capture_output=True, text=True, check=True)
+        text = (tmp_path / 'night.txt').read_text()
+        assert 'APOGEE Data Summary' in text
+        assert text in proc.stdout
+        night = night_log.NightLog.from_dict(
+            json.loads((tmp_path / 'night.json').read_text()))
+        assert night.sections == ['apogee', 'boss']
+        out = io.StringIO()
+        night_log.write_text(night, out)
+        assert out.getvalue() == text
+
+    def test_mjd_range_outputs(self):
+        """Each night needs its own output files"""
+        with pytest.raises(SystemExit):
+            sloan_log.parse_args(['--mjd-range', '59730', '59731', '-o',
+                                  'night.txt'])
+        args = sloan_log.parse_args(['--mjd-range', '59730', '59731'])
+        assert args.output == [Path('sloan_log_{sjd}.txt')]
+
 
 if __name__ == '__main__':
     pytest.main()
@@ -0,0 +1,52 @@
+#!/usr/bin/env python3
+import numpy as np
+import pytest
+from sdssobstools import synthetic_night, apogee_data, boss_data
+
+
+class Args:
+    verbose = False
+
+
+class TestSyntheticNight():
+
+    def test_write_night(self, tmp_path):
+        """A small night should have every file type and readable headers"""
+        counts = synthetic_night.write_night(tmp_path, 59730, 12)
+        assert counts['sdR'] == 12
+        assert counts['apR'] == 3 * 12 - 1  # One missing c detector
+        assert counts['apq'] == 10  # No quickred for the 2 darks
+        ap = apogee_data.APOGEERaw(
+            tmp_path / "apogee/archive/59730/apR-a-40000001.apz", Args())
+        assert ap.exp_type == 'ThAr Arc'
+        assert ap.field_id == 100001
+        assert ap.dither == 'B'
+        b = boss_data.BOSSRaw(
+            tmp_path / "spectro/59730/sdR-r1-40000000.fit.gz")
+        assert b.hartmann == 'Left'
+        assert b.date_obs.startswith('2022-05-31T01:55')
+
+    def test_flats_differ(self, tmp_path):
+        """Consecutive dome flats are different images with different dead
+        fibers"""
+        synthetic_night.write_night(tmp_path, 59730, 24)
+        kinds, _ = synthetic_night.schedule(24)
+        master_col = apogee_data.master_dome_flat_col()
+        missing = []
+        for i, kind in enumerate(kinds):
+            if kind != 'Domeflat':
+                continue
+            path = (tmp_path / "apogee/quickred/59730"
+                    / f"apq-{synthetic_night.first_exp_id + i}.fits")
+            assert path.stat().st_nlink == 1
+            slab = apogee_data.read_flat_slabs([path])
+            results = apogee_data.dome_flat_results(
+                np.median(slab, axis=2), master_col)
+            assert results['n_missing'][0] == 4
+            missing.append(results['missing'][0])
+        assert len(missing) == 3
+        assert missing[0] != missing[1] != missing[2]
+
+
+if __name__ == '__main__':
+    pytest.main()
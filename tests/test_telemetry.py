@@ -0,0 +1,57 @@
+#!/usr/bin/env python3
+import threading
+import time
+
+import pytest
+
+from sdssobstools import telemetry
+
+
+class Args:
+    sjd = 59730
+    verbose = False
+
+
+class TestTelemetry():
+
+    def test_background(self, monkeypatch):
+        """A started section runs while the caller works, and its result is
+        kept until it is started again"""
+        calls = []
+        release = threading.Event()
+
+        def fetch_dust(sjd, verbose=False):
+            calls.append(sjd)
+            release.wait(5)
+            return 1234. * len(calls)
+
+        monkeypatch.setattr(telemetry, 'fetch_dust', fetch_dust)
+        tel = telemetry.Telemetry(Args())
+        tel.start(['dust'])
+        time.sleep(0.1)
+        assert calls == [59730]  # Started before anyone asked for it
+        release.set()
+        assert tel.get('dust') == 1234.
+        assert tel.get('dust') == 1234.
+        assert len(calls) == 1
+        tel.start(['dust'])
+        assert tel.get('dust') == 2468.
+        tel.close()
+
+    def test_errors(self, monkeypatch):
+        """A section that isn't started is fetched when asked for, and its
+        errors are raised by get"""
+        def fetch_dust(sjd, verbose=False):
+            raise FileNotFoundError('.influx.key')
+
+        monkeypatch.setattr(telemetry, 'fetch_dust', fetch_dust)
+        tel = telemetry.Telemetry(Args())
+        with pytest.raises(FileNotFoundError):
+            tel.get('dust')
+        with pytest.raises(ValueError):
+            tel.start(['mirrors'])
+        tel.close()
+
+
+if __name__ == '__main__':
+    pytest.main()